@@ -0,0 +1,157 @@
+import collections
+import logging
+import queue
+import threading
+
+DEFAULT_PAGE_SIZE = 4096  # bytes
+DEFAULT_CACHE_BYTES = 64 * 2**20  # 64MiB
+DEFAULT_READAHEAD_BYTES = 128 * 2**10  # 128KiB
+# number of back-to-back reads on a stream before we start prefetching
+SEQUENTIAL_THRESHOLD = 2
+# most streams we track for sequential detection before forgetting the
+# least recently read one
+MAX_STREAMS = 1024
+
+
+class PageCache(object):
+    """
+    LRU cache of fixed-size pages of the backing block file
+
+    Pages are keyed by their offset in the backing file rather than by volume
+    so that any volumes resolving to the same blocks share cached pages.
+    Misses and invalidations both happen under the backing file lock, which
+    keeps a concurrent write from racing a fill and leaving a stale page.
+    """
+    def __init__(self,
+                 f,
+                 f_lock,
+                 budget=DEFAULT_CACHE_BYTES,
+                 page_size=DEFAULT_PAGE_SIZE,
+                 readahead=DEFAULT_READAHEAD_BYTES,
+                 max_streams=MAX_STREAMS):
+        self._f = f
+        self._f_lock = f_lock
+        self._page_size = page_size
+        self._capacity = max(budget // page_size, 1)
+        self._readahead = readahead
+        self._pages = collections.OrderedDict()
+        self._lock = threading.Lock()
+        # stream -> (end offset of last read, number of sequential reads)
+        self._streams = collections.OrderedDict()
+        self._max_streams = max_streams
+        self._prefetching = set()
+        self._prefetch_queue = queue.Queue()
+        self.hits = 0
+        self.misses = 0
+        threading.Thread(target=self._prefetch_loop, daemon=True).start()
+
+    def read(self, offset, length, stream=None):
+        if length == 0:
+            return b''
+        first = offset // self._page_size
+        last = (offset + length - 1) // self._page_size
+        pages = self._get_pages(first, last)
+        data = b''.join(pages)
+        start = offset - first * self._page_size
+        if stream is not None:
+            self._track(stream, offset, length)
+        return data[start:start + length]
+
+    def invalidate(self, offset, length):
+        """
+        Drop any cached pages overlapping the given range -- callers must
+        hold the backing file lock
+        """
+        if length == 0:
+            return
+        first = offset // self._page_size
+        last = (offset + length - 1) // self._page_size
+        with self._lock:
+            if last - first + 1 > len(self._pages):
+                stale = [p for p in self._pages if first <= p <= last]
+            else:
+                stale = [p for p in range(first, last + 1) if p in self._pages]
+            for page in stale:
+                del self._pages[page]
+
+    def _get_pages(self, first, last):
+        found = {}
+        with self._lock:
+            for page in range(first, last + 1):
+                data = self._pages.get(page)
+                if data is not None:
+                    self._pages.move_to_end(page)
+                    found[page] = data
+            self.hits += len(found)
+            self.misses += (last - first + 1) - len(found)
+        if len(found) < last - first + 1:
+            found.update(self._fill(first, last, skip=found))
+        return [found[page] for page in range(first, last + 1)]
+
+    def _fill(self, first, last, skip=()):
+        """
+        Load every page in [first, last] not in `skip`, reading contiguous
+        runs of missing pages with a single seek/read
+        """
+        loaded = {}
+        with self._f_lock:
+            page = first
+            while page <= last:
+                if page in skip:
+                    page += 1
+                    continue
+                run_end = page
+                while run_end + 1 <= last and run_end + 1 not in skip:
+                    run_end += 1
+                self._f.seek(page * self._page_size)
+                data = self._f.read((run_end - page + 1) * self._page_size)
+                for i in range(page, run_end + 1):
+                    rel = (i - page) * self._page_size
+                    loaded[i] = data[rel:rel + self._page_size]
+                page = run_end + 1
+            with self._lock:
+                for i, data in loaded.items():
+                    self._pages[i] = data
+                    self._pages.move_to_end(i)
+                while len(self._pages) > self._capacity:
+                    self._pages.popitem(last=False)
+        return loaded
+
+    def _track(self, stream, offset, length):
+        with self._lock:
+            last_end, run = self._streams.get(stream, (None, 0))
+            run = run + 1 if offset == last_end else 0
+            self._streams[stream] = (offset + length, run)
+            self._streams.move_to_end(stream)
+            while len(self._streams) > self._max_streams:
+                self._streams.popitem(last=False)
+        if run >= SEQUENTIAL_THRESHOLD and self._readahead:
+            self._schedule_prefetch(offset + length)
+
+    def _schedule_prefetch(self, offset):
+        first = offset // self._page_size
+        last = (offset + self._readahead - 1) // self._page_size
+        with self._lock:
+            if all(p in self._pages for p in range(first, last + 1)):
+                return
+            if first in self._prefetching:
+                return
+            self._prefetching.add(first)
+        self._prefetch_queue.put((first, last))
+
+    def _prefetch_loop(self):
+        while True:
+            first, last = self._prefetch_queue.get()
+            try:
+                with self._lock:
+                    cached = {
+                        p
+                        for p in range(first, last + 1) if p in self._pages
+                    }
+                self._fill(first, last, skip=cached)
+            except Exception:
+                logging.exception("Failed to prefetch pages {} - {}".format(
+                    first, last))
+            finally:
+                with self._lock:
+                    self._prefetching.discard(first)
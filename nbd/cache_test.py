@@ -0,0 +1,117 @@
+import io
+import threading
+import time
+import unittest
+
+from nbd.cache import PageCache, SEQUENTIAL_THRESHOLD
+
+PAGE = 16
+
+
+class CountingFile(io.BytesIO):
+    """
+    In-memory backing file that counts the reads the cache makes
+    """
+    def __init__(self, data):
+        super().__init__(data)
+        self.reads = 0
+
+    def read(self, *args):
+        self.reads += 1
+        return super().read(*args)
+
+
+class TestPageCache(unittest.TestCase):
+    def make_cache(self, pages=64, budget_pages=4, readahead=0, **kwargs):
+        self.data = bytes(i % 251 for i in range(pages * PAGE))
+        self.f = CountingFile(self.data)
+        self.f_lock = threading.Lock()
+        return PageCache(self.f,
+                         self.f_lock,
+                         budget=budget_pages * PAGE,
+                         page_size=PAGE,
+                         readahead=readahead,
+                         **kwargs)
+
+    def wait_for_prefetch(self, cache):
+        deadline = time.time() + 5
+        while time.time() < deadline:
+            with cache._lock:
+                if not cache._prefetching and cache._prefetch_queue.empty():
+                    return
+            time.sleep(.01)
+        self.fail("prefetch did not finish")
+
+    def test_read_spans_pages(self):
+        cache = self.make_cache()
+        self.assertEqual(self.data[5:40], cache.read(5, 35))
+        self.assertEqual(3, cache.misses)
+        self.assertEqual(self.data[20:30], cache.read(20, 10))
+        self.assertEqual(1, cache.hits)
+
+    def test_lru_eviction(self):
+        cache = self.make_cache(budget_pages=2)
+        cache.read(0, PAGE)
+        cache.read(PAGE, PAGE)
+        # touch page 0 so page 1 becomes the least recently used
+        cache.read(0, PAGE)
+        cache.read(2 * PAGE, PAGE)
+        self.assertEqual([0, 2], sorted(cache._pages))
+        reads = self.f.reads
+        cache.read(0, PAGE)
+        self.assertEqual(reads, self.f.reads)
+        cache.read(PAGE, PAGE)
+        self.assertEqual(reads + 1, self.f.reads)
+
+    def test_invalidate_on_write(self):
+        cache = self.make_cache()
+        self.assertEqual(self.data[:PAGE], cache.read(0, PAGE))
+        with self.f_lock:
+            self.f.seek(4)
+            self.f.write(b'new!')
+            cache.invalidate(4, 4)
+        self.assertEqual(b'new!', cache.read(4, 4))
+
+    def test_invalidate_only_overlapping_pages(self):
+        cache = self.make_cache()
+        cache.read(0, 3 * PAGE)
+        with self.f_lock:
+            cache.invalidate(PAGE + 1, 1)
+        self.assertEqual([0, 2], sorted(cache._pages))
+
+    def test_readahead_on_sequential_reads(self):
+        cache = self.make_cache(budget_pages=32, readahead=4 * PAGE)
+        for i in range(SEQUENTIAL_THRESHOLD + 1):
+            cache.read(i * PAGE, PAGE, stream='vol')
+        self.wait_for_prefetch(cache)
+        end = SEQUENTIAL_THRESHOLD + 1
+        self.assertTrue(
+            all(p in cache._pages for p in range(end, end + 4)))
+
+    def test_no_readahead_on_random_reads(self):
+        cache = self.make_cache(budget_pages=32, readahead=4 * PAGE)
+        for page in (10, 3, 20, 7, 30):
+            cache.read(page * PAGE, PAGE, stream='vol')
+        self.wait_for_prefetch(cache)
+        self.assertEqual([3, 7, 10, 20, 30], sorted(cache._pages))
+
+    def test_no_readahead_without_stream(self):
+        cache = self.make_cache(budget_pages=32, readahead=4 * PAGE)
+        for i in range(SEQUENTIAL_THRESHOLD + 2):
+            cache.read(i * PAGE, PAGE)
+        self.wait_for_prefetch(cache)
+        self.assertEqual(list(range(SEQUENTIAL_THRESHOLD + 2)),
+                         sorted(cache._pages))
+
+    def test_streams_are_bounded(self):
+        cache = self.make_cache(max_streams=2)
+        for stream in ('a', 'b', 'c'):
+            cache.read(0, PAGE, stream=stream)
+        self.assertEqual(['b', 'c'], list(cache._streams))
+        cache.read(PAGE, PAGE, stream='b')
+        cache.read(0, PAGE, stream='d')
+        self.assertEqual(['b', 'd'], list(cache._streams))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -11,9 +11,14 @@ class MagicValues(object):
     RequestKindRead = b"\x00\x00"
     RequestKindWrite = b"\x00\x01"
     RequestKindClose = b"\x00\x02"
+    RequestKindFlush = b"\x00\x03"
     ResponsePrefix = b"\x67\x44\x66\x98"
     HandshakeMagic = b"NBDMAGICIHAVEOPT"
     HandshakeMinimalFlags = b"\x00\x01"
+    TransmissionHasFlags = 1 << 0
+    TransmissionReadOnly = 1 << 1
+    TransmissionSendFlush = 1 << 2
+    TransmissionCanMultiConn = 1 << 8
 
 
 Option = collections.namedtuple("Option", ("kind", "data"))
@@ -21,11 +26,17 @@ TransmissionRequest = collections.namedtuple(
     "TransmissionRequest",
     ("kind", "handle", "offset", "length", "data"),
 )
+TransmissionResponse = collections.namedtuple(
+    "TransmissionResponse",
+    ("handle", "error", "data"),
+)
 
 
 class NBDInterpreter(object):
     def __init__(self, cxn, client=False):
         self._cxn = cxn
+        # set to a trace.SessionRecorder to record the requests served
+        self.trace = None
         if not client:
             self._handshake()
 
@@ -57,10 +68,18 @@ class NBDInterpreter(object):
         self._cxn.sendall(MagicValues.OptionUnsupported)
         self._cxn.sendall(b"\x00" * 4)
 
-    def send_export_response(self, size):
+    def send_export_response(self, size, read_only=False, multi_conn=False):
         self._cxn.sendall(size.to_bytes(byteorder="big", length=8))
         # transmission flags
-        self._cxn.sendall(b"\x00\x01")
+        flags = MagicValues.TransmissionHasFlags
+        if read_only:
+            flags |= MagicValues.TransmissionReadOnly
+        if multi_conn:
+            # a flush on any connection covers writes completed on all of
+            # them so clients may open several
+            flags |= MagicValues.TransmissionSendFlush | \
+                MagicValues.TransmissionCanMultiConn
+        self._cxn.sendall(flags.to_bytes(byteorder="big", length=2))
         # Later versions of the nbd kernel module seem to ignore the zero padding even if NBD_OPT_GO
         # is rejected so disabling for now
         #
@@ -88,14 +107,19 @@ class NBDInterpreter(object):
             data = None
             if req_type == MagicValues.RequestKindWrite and length > 0:
                 data = next_n_bytes(self._cxn, length)
-            yield TransmissionRequest(req_type, handle, offset, length, data)
+            req = TransmissionRequest(req_type, handle, offset, length, data)
+            if self.trace:
+                self.trace.start(req)
+            yield req
 
-    def send_transmission_response(self, handle, data=None):
+    def send_transmission_response(self, handle, data=None, error=0):
         self._cxn.sendall(MagicValues.ResponsePrefix)
-        self._cxn.sendall(b"\x00\x00\x00\x00")
+        self._cxn.sendall(error.to_bytes(byteorder="big", length=4))
         self._cxn.sendall(handle)
         if data:
             self._cxn.sendall(data)
+        if self.trace:
+            self.trace.finish(handle, error)
 
     def start_session(self, dev_name):
         magic = next_n_bytes(self._cxn, len(MagicValues.HandshakeMagic))
@@ -111,6 +135,50 @@ class NBDInterpreter(object):
         self._cxn.sendall(len(dev_name).to_bytes(byteorder="big", length=4))
         self._cxn.sendall(dev_name)
 
+    def get_export_response(self):
+        """
+        Client side: read the export's size and transmission flags
+        """
+        size = int.from_bytes(next_n_bytes(self._cxn, 8), byteorder="big")
+        flags = int.from_bytes(next_n_bytes(self._cxn, 2), byteorder="big")
+        return size, flags
+
+    def send_transmission_request(self,
+                                  kind,
+                                  handle,
+                                  offset,
+                                  length,
+                                  data=None):
+        self._cxn.sendall(b''.join([
+            MagicValues.RequestPrefix,
+            b"\x00\x00",  # flags
+            kind,
+            handle,
+            offset.to_bytes(byteorder="big", length=8),
+            length.to_bytes(byteorder="big", length=4),
+            data or b'',
+        ]))
+
+    def get_transmission_response(self, read_length):
+        """
+        Client side: read the next reply, or None once the server has gone
+        away -- read_length(handle) gives the number of bytes of data that
+        follow a successful reply to the request with that handle
+        """
+        prefix = next_n_bytes(self._cxn, 4)
+        if prefix == None:
+            return None
+        if prefix != MagicValues.ResponsePrefix:
+            raise ValueError("Unknown reply prefix: {}".format(prefix))
+        error = int.from_bytes(next_n_bytes(self._cxn, 4), byteorder="big")
+        handle = next_n_bytes(self._cxn, 8)
+        data = None
+        if error == 0:
+            length = read_length(handle)
+            if length:
+                data = next_n_bytes(self._cxn, length)
+        return TransmissionResponse(handle, error, data)
+
 
 def next_n_bytes(cxn, n):
     data = b''
@@ -1,19 +1,269 @@
 import json
 import logging
 import os
-import random
 import socket
+import threading
 import _thread
+import urllib.parse
+import urllib.request
+import zlib
 
 from nbd.iptr import NBDInterpreter, MagicValues
 
 PROXY_BUFFER_SIZE = 1024
+DEFAULT_STRIPE_SIZE = 2**16  # 64KiB, a multiple of the servers' extent size
+LAYOUT_PORT = 8080  # the shard replicas' HTTP port
+LAYOUT_TIMEOUT = 5.  # seconds
+
+
+def stripe_segments(offset, length, stripe_size, shard_count):
+    """
+    Split a range of a striped volume into (shard position, shard offset,
+    length, offset into the range) segments
+
+    Stripe i lives on the shard at position i % shard_count, packed after
+    the shard's earlier stripes so each shard only needs 1/shard_count of
+    the volume's size.
+    """
+    segments = []
+    pos = offset
+    end = offset + length
+    while pos < end:
+        stripe = pos // stripe_size
+        seg_end = min((stripe + 1) * stripe_size, end)
+        shard = stripe % shard_count
+        shard_offset = (stripe // shard_count) * stripe_size + \
+            pos - stripe * stripe_size
+        prev = segments[-1] if segments else None
+        if prev and prev[0] == shard and prev[1] + prev[2] == shard_offset:
+            segments[-1] = (shard, prev[1], prev[2] + seg_end - pos, prev[3])
+        else:
+            segments.append((shard, shard_offset, seg_end - pos, pos - offset))
+        pos = seg_end
+    return segments
+
+
+def home_shard(volume, shard_count):
+    """
+    The shard an unstriped volume lives on, which also settles its layout
+    """
+    # hash() is salted per process so would differ between balancers
+    return zlib.crc32(volume) % shard_count
+
+
+class VolumeLayouts(object):
+    """
+    Layout of every volume, kept in the volume catalog of its home shard
+
+    A volume's layout is fixed the first time any balancer serves it -- None
+    if it lives wholly on one shard or {"stripe_size": ..., "shards": ...} if
+    it's striped -- since reading a volume with any other layout returns
+    garbage. Turning striping on or off only changes the layout of volumes
+    created afterwards. The shard's Raft log picks the first layout proposed
+    so every balancer agrees on it, and as it never changes after that it's
+    cached here.
+    """
+    def __init__(self, shards, port=LAYOUT_PORT):
+        self.shards = shards
+        self.port = port
+        self.lock = threading.Lock()
+        self.layouts = {}
+
+    def get(self, volume, default):
+        """
+        The volume's layout, recording default for a volume not seen before
+        """
+        with self.lock:
+            if volume in self.layouts:
+                return self.layouts[volume]
+        layout = self._claim(volume, default)
+        with self.lock:
+            return self.layouts.setdefault(volume, layout)
+
+    def _claim(self, volume, default):
+        shard_ix = home_shard(volume, len(self.shards))
+        body = json.dumps(default).encode("utf-8")
+        for replica in self.shards[shard_ix]:
+            url = "http://{}:{}/volumes/{}/layout".format(
+                replica, self.port, urllib.parse.quote(volume, safe=""))
+            try:
+                with urllib.request.urlopen(url, data=body,
+                                            timeout=LAYOUT_TIMEOUT) as resp:
+                    return json.loads(resp.read())
+            except OSError:
+                # including a replica that can't reach its leader
+                logging.exception(
+                    "Failed to get layout of volume {} from replica {}".format(
+                        volume, replica))
+        raise ConnectionError(
+            "No replica of shard {} is reachable".format(shard_ix))
+
+
+class _StripedRequest(object):
+    __slots__ = ("handle", "remaining", "data", "error")
+
+    def __init__(self, handle, remaining, data):
+        self.handle = handle
+        self.remaining = remaining
+        self.data = data
+        self.error = 0
+
+
+class StripedSession(object):
+    """
+    Serve one client connection from a volume striped across every shard
+
+    Requests from the client are split by stripe and sent to each shard's
+    replica without waiting on one another, and replies are gathered by
+    handle so the client sees one reply per request. The export is as big
+    as every shard's share put together, so a striped volume is n times
+    the size of an unstriped one across n shards.
+    """
+    def __init__(self, lb, cxn, iptr, volume, stripe_size):
+        self.cxn = cxn
+        self.iptr = iptr
+        self.volume = volume
+        self.stripe_size = stripe_size
+        # rotate the shard order by volume so stripe 0 of every volume
+        # doesn't land on the same shard
+        first = lb.shard_for(volume)
+        shard_ixs = [(first + i) % len(lb.shards)
+                     for i in range(len(lb.shards))]
+        self.shard_socks = [
+            lb.connect_replica(volume, shard_ix) for shard_ix in shard_ixs
+        ]
+        self.shard_iptrs = [
+            NBDInterpreter(sock, client=True) for sock in self.shard_socks
+        ]
+        self.closed = False
+        self.lock = threading.Lock()
+        self.client_lock = threading.Lock()
+        # handle sent to a shard -> (request, offset into it, length, read)
+        self.sub_requests = {}
+        self.next_handle = 0
+
+    def run(self):
+        sizes = []
+        read_only = False
+        multi_conn = True
+        for shard_iptr in self.shard_iptrs:
+            shard_iptr.start_session(self.volume)
+            size, flags = shard_iptr.get_export_response()
+            sizes.append(size)
+            read_only = read_only or bool(
+                flags & MagicValues.TransmissionReadOnly)
+            multi_conn = multi_conn and bool(
+                flags & MagicValues.TransmissionCanMultiConn)
+        # flushes can only be passed on if every shard takes them
+        self.iptr.send_export_response(min(sizes) * len(sizes),
+                                       read_only=read_only,
+                                       multi_conn=multi_conn)
+        for shard in range(len(self.shard_iptrs)):
+            _thread.start_new_thread(self._relay_replies, (shard, ))
+
+        for req in self.iptr.get_transmission_requests():
+            if req.kind in (MagicValues.RequestKindRead,
+                            MagicValues.RequestKindWrite):
+                segments = stripe_segments(req.offset, req.length,
+                                           self.stripe_size,
+                                           len(self.shard_iptrs))
+                self._submit(req, segments)
+            elif req.kind == MagicValues.RequestKindFlush:
+                self._submit(req, [(shard, 0, 0, 0)
+                                   for shard in range(len(self.shard_iptrs))])
+            elif req.kind == MagicValues.RequestKindClose:
+                break
+            else:
+                raise ValueError("Unknown request type: {}".format(req.kind))
+        self.close()
+
+    def close(self):
+        self.closed = True
+        for shard_iptr in self.shard_iptrs:
+            try:
+                shard_iptr.send_transmission_request(
+                    MagicValues.RequestKindClose, b"\x00" * 8, 0, 0)
+            except OSError:
+                pass
+        self.cxn.close()
+
+    def _submit(self, req, segments):
+        is_read = req.kind == MagicValues.RequestKindRead
+        request = _StripedRequest(req.handle, len(segments),
+                                  bytearray(req.length) if is_read else None)
+        if not segments:
+            self._reply(request)
+            return
+        sends = []
+        # register every piece before sending any as replies can come back
+        # on other threads straight away
+        with self.lock:
+            for shard, shard_offset, length, rel in segments:
+                handle = self.next_handle.to_bytes(byteorder="big", length=8)
+                self.next_handle = (self.next_handle + 1) % 2**64
+                self.sub_requests[handle] = (request, rel, length, is_read)
+                data = None
+                if req.kind == MagicValues.RequestKindWrite:
+                    data = memoryview(req.data)[rel:rel + length]
+                sends.append((shard, handle, shard_offset, length, data))
+        for shard, handle, shard_offset, length, data in sends:
+            self.shard_iptrs[shard].send_transmission_request(
+                req.kind, handle, shard_offset, length, data)
+
+    def _reply_length(self, handle):
+        with self.lock:
+            _, _, length, is_read = self.sub_requests[handle]
+        return length if is_read else 0
+
+    def _relay_replies(self, shard):
+        shard_iptr = self.shard_iptrs[shard]
+        while True:
+            resp = shard_iptr.get_transmission_response(self._reply_length)
+            if resp is None:
+                break
+            with self.lock:
+                request, rel, length, _ = self.sub_requests.pop(resp.handle)
+                if resp.error:
+                    request.error = request.error or resp.error
+                elif request.data is not None:
+                    request.data[rel:rel + length] = resp.data
+                request.remaining -= 1
+                done = request.remaining == 0
+            if done:
+                self._reply(request)
+        self.shard_socks[shard].close()
+        if self.closed:
+            return
+        # the client can't carry on without every shard
+        logging.info("Shard {} of volume {} went away".format(
+            shard, self.volume))
+        try:
+            self.cxn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def _reply(self, request):
+        data = None
+        if not request.error and request.data is not None:
+            data = bytes(request.data)
+        with self.client_lock:
+            self.iptr.send_transmission_response(request.handle,
+                                                 data,
+                                                 error=request.error)
 
 
 class NBDLoadBalancer(object):
-    def __init__(self, shards, socket_descriptor=('0.0.0.0', 2000)):
+    def __init__(self,
+                 shards,
+                 socket_descriptor=('0.0.0.0', 2000),
+                 stripe_size=None,
+                 layouts=None):
         self.shards = shards
         self.socket_descriptor = socket_descriptor
+        # when set every new volume is striped across all shards rather
+        # than living wholly on one
+        self.stripe_size = stripe_size
+        self.layouts = layouts or VolumeLayouts(shards)
 
     def listen_forever(self):
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -37,19 +287,64 @@ class NBDLoadBalancer(object):
                 # we don't support any extra options
                 logging.info("Ignoring client option: {}".format(opt.kind))
                 iptr.send_option_unsupported(opt)
-        shard_ix = (hash(volume) % len(self.shards))
-        random.seed()
-        replica = random.choice(self.shards[shard_ix])
-        logging.info(
-            "Sending client to replica {} shard {} for volume {}".format(
-                replica, shard_ix, volume))
-        repl_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        repl_sock.connect((replica, 2000))
+        default = None
+        if self.stripe_size:
+            default = {
+                "stripe_size": self.stripe_size,
+                "shards": len(self.shards)
+            }
+        try:
+            layout = self.layouts.get(volume, default)
+        except OSError:
+            logging.exception(
+                "Failed to settle layout of volume {}".format(volume))
+            cxn.close()
+            return
+        if layout is not None:
+            if layout["shards"] != len(self.shards):
+                # its stripes would be looked for on the wrong shards
+                logging.error(
+                    "Refusing volume {} striped across {} shards with {} "
+                    "configured".format(volume, layout["shards"],
+                                        len(self.shards)))
+                cxn.close()
+                return
+            StripedSession(self, cxn, iptr, volume,
+                           layout["stripe_size"]).run()
+            return
+        repl_sock = self.connect_replica(volume, self.shard_for(volume))
         repl_iptr = NBDInterpreter(repl_sock, client=True)
         repl_iptr.start_session(volume)
         _thread.start_new_thread(self.proxy, (cxn, repl_sock))
         self.proxy(repl_sock, cxn)
 
+    def shard_for(self, volume):
+        return home_shard(volume, len(self.shards))
+
+    def connect_replica(self, volume, shard_ix):
+        """
+        Connect to the volume's preferred replica in the shard, or the next
+        one along if it's down
+
+        The choice depends only on the volume name so that every connection
+        to a volume, through any balancer, lands on the same replica and
+        sees the writes acked on its other connections.
+        """
+        replicas = self.shards[shard_ix]
+        preferred = zlib.crc32(volume) // len(self.shards) % len(replicas)
+        for i in range(len(replicas)):
+            replica = replicas[(preferred + i) % len(replicas)]
+            logging.info(
+                "Sending client to replica {} shard {} for volume {}".format(
+                    replica, shard_ix, volume))
+            try:
+                return socket.create_connection((replica, 2000))
+            except OSError:
+                logging.exception(
+                    "Failed to connect to replica {}".format(replica))
+        raise ConnectionError(
+            "No replica of shard {} is reachable".format(shard_ix))
+
     def proxy(self, src_sock, dest_sock):
         while True:
             payload = src_sock.recv(PROXY_BUFFER_SIZE)
@@ -65,7 +360,13 @@ def main():
                         filename='/proc/self/fd/2',
                         filemode='w')
     shards = json.loads(os.environ["NBD_SHARDS"])
-    lb = NBDLoadBalancer(shards)
+    stripe_size = None
+    if os.environ.get("NBD_STRIPE", "") not in ("", "0"):
+        stripe_size = int(
+            os.environ.get("NBD_STRIPE_SIZE", DEFAULT_STRIPE_SIZE))
+    # striped volumes are 1/n the size on each of n shards so n times the
+    # size of an unstriped volume overall
+    lb = NBDLoadBalancer(shards, stripe_size=stripe_size)
     lb.listen_forever()
 
 
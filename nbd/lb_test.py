@@ -0,0 +1,409 @@
+import errno
+import random
+import socket
+import threading
+import unittest
+import urllib.error
+import urllib.request
+from http.server import ThreadingHTTPServer
+from unittest import mock
+
+from nbd import lb, server
+from nbd.iptr import NBDInterpreter, MagicValues
+from nbd.lb import NBDLoadBalancer, StripedSession, VolumeLayouts, \
+    stripe_segments
+
+STRIPE = 16
+
+
+class StripedVolume(object):
+    """
+    In-memory shards written and read through stripe_segments
+    """
+    def __init__(self, shard_count, size):
+        self.shards = [
+            bytearray(size // shard_count) for _ in range(shard_count)
+        ]
+
+    def write(self, offset, data):
+        for shard, shard_offset, length, rel in stripe_segments(
+                offset, len(data), STRIPE, len(self.shards)):
+            self.shards[shard][shard_offset:shard_offset + length] = \
+                data[rel:rel + length]
+
+    def read(self, offset, length):
+        data = bytearray(length)
+        for shard, shard_offset, seglen, rel in stripe_segments(
+                offset, length, STRIPE, len(self.shards)):
+            data[rel:rel + seglen] = \
+                self.shards[shard][shard_offset:shard_offset + seglen]
+        return bytes(data)
+
+
+class TestStripeSegments(unittest.TestCase):
+    def test_within_one_stripe(self):
+        self.assertEqual([(1, 2, 10, 0)], stripe_segments(18, 10, STRIPE, 3))
+
+    def test_across_stripe_boundary(self):
+        self.assertEqual([(0, 12, 4, 0), (1, 0, 6, 4)],
+                         stripe_segments(12, 10, STRIPE, 3))
+
+    def test_wraps_to_next_row_of_stripes(self):
+        # stripes 2 and 3 live on shards 2 and 0, the latter in its second
+        # stripe
+        self.assertEqual([(2, 8, 8, 0), (0, 16, 8, 8)],
+                         stripe_segments(40, 16, STRIPE, 3))
+
+    def test_single_shard_is_contiguous(self):
+        self.assertEqual([(0, 5, 100, 0)], stripe_segments(5, 100, STRIPE, 1))
+
+    def test_empty_range(self):
+        self.assertEqual([], stripe_segments(7, 0, STRIPE, 3))
+
+    def test_segments_cover_range_once(self):
+        segments = stripe_segments(3, 200, STRIPE, 4)
+        self.assertEqual(200, sum(length for _, _, length, _ in segments))
+        rels = [rel for _, _, _, rel in segments]
+        self.assertEqual(sorted(rels), rels)
+        for shard, shard_offset, length, _ in segments:
+            # never crosses into the shard's next stripe, which belongs to
+            # a different part of the volume
+            self.assertEqual(shard_offset // STRIPE,
+                             (shard_offset + length - 1) // STRIPE)
+
+    def test_round_trip(self):
+        rng = random.Random(3)
+        size = STRIPE * 3 * 8
+        volume = StripedVolume(3, size)
+        flat = bytearray(size)
+        for _ in range(200):
+            offset = rng.randrange(size)
+            data = rng.randbytes(rng.randrange(1, min(5 * STRIPE,
+                                                      size - offset) + 1))
+            volume.write(offset, data)
+            flat[offset:offset + len(data)] = data
+            offset = rng.randrange(size)
+            length = rng.randrange(min(5 * STRIPE, size - offset) + 1)
+            self.assertEqual(bytes(flat[offset:offset + length]),
+                             volume.read(offset, length))
+        self.assertEqual(bytes(flat), volume.read(0, size))
+
+    def test_shards_hold_equal_shares(self):
+        volume = StripedVolume(4, STRIPE * 4 * 2)
+        volume.write(0, b'\xff' * STRIPE * 4 * 2)
+        for shard in volume.shards:
+            self.assertEqual(b'\xff' * STRIPE * 2, bytes(shard))
+
+
+class FakeCatalog(object):
+    """
+    A shard's volume catalog, where every claim is applied straight away
+    """
+    def __init__(self):
+        self.layouts = {}
+        self.claims = 0
+
+    def claim_layout(self, volume, layout, sync=False):
+        self.claims += 1
+        return self.layouts.setdefault(volume, layout)
+
+
+class TestVolumeLayouts(unittest.TestCase):
+    STRIPED = {"stripe_size": STRIPE, "shards": 3}
+
+    def setUp(self):
+        self.catalog = FakeCatalog()
+        patch = mock.patch.object(server.HealthHandler, 'catalog',
+                                  self.catalog)
+        patch.start()
+        self.addCleanup(patch.stop)
+        httpd = ThreadingHTTPServer(('127.0.0.1', 0), server.HealthHandler)
+        self.addCleanup(httpd.server_close)
+        self.addCleanup(httpd.shutdown)
+        threading.Thread(target=httpd.serve_forever,
+                         kwargs={'poll_interval': .01},
+                         daemon=True).start()
+        self.port = httpd.server_address[1]
+
+    def layouts(self, replicas=("127.0.0.1", )):
+        # one shard so every volume's layout lives on it
+        return VolumeLayouts([list(replicas)], port=self.port)
+
+    def test_first_layout_sticks(self):
+        layouts = self.layouts()
+        self.assertIsNone(layouts.get(b'old', None))
+        # striping turned on later leaves the existing volume alone
+        self.assertIsNone(layouts.get(b'old', self.STRIPED))
+        self.assertEqual(self.STRIPED, layouts.get(b'new', self.STRIPED))
+        self.assertEqual(self.STRIPED, layouts.get(b'new', None))
+
+    def test_balancers_agree(self):
+        first, second = self.layouts(), self.layouts()
+        self.assertEqual(self.STRIPED, first.get(b'vol', self.STRIPED))
+        self.assertEqual(self.STRIPED, second.get(b'vol', None))
+        self.assertIsNone(second.get(b'other', None))
+        self.assertIsNone(first.get(b'other', self.STRIPED))
+        self.assertEqual({b'vol': self.STRIPED, b'other': None},
+                         self.catalog.layouts)
+
+    def test_layouts_are_cached(self):
+        layouts = self.layouts()
+        layouts.get(b'vol', None)
+        layouts.get(b'vol', self.STRIPED)
+        self.assertEqual(1, self.catalog.claims)
+
+    def test_any_volume_name(self):
+        layouts = self.layouts()
+        self.assertEqual(self.STRIPED, layouts.get(b'a/b?\xff', self.STRIPED))
+        self.assertEqual({b'a/b?\xff': self.STRIPED}, self.catalog.layouts)
+
+    def test_falls_over_to_next_replica(self):
+        # nothing listens on the first
+        layouts = self.layouts(("127.0.0.2", "127.0.0.1"))
+        with self.assertLogs(level='ERROR'):
+            self.assertIsNone(layouts.get(b'vol', None))
+
+    def test_no_replica_reachable(self):
+        layouts = self.layouts(("127.0.0.2", ))
+        with self.assertLogs(level='ERROR'):
+            with self.assertRaises(ConnectionError):
+                layouts.get(b'vol', None)
+
+    def test_rejects_malformed_layout(self):
+        url = "http://127.0.0.1:{}/volumes/vol/layout".format(self.port)
+        with self.assertRaises(urllib.error.HTTPError) as cm:
+            urllib.request.urlopen(url, data=b'{"stripes": 3}', timeout=5)
+        self.assertEqual(400, cm.exception.code)
+        self.assertEqual({}, self.catalog.layouts)
+
+
+class FakeLayouts(object):
+    def __init__(self, layouts=None):
+        self.layouts = dict(layouts or {})
+
+    def get(self, volume, default):
+        return self.layouts.setdefault(volume, default)
+
+
+class TestLayoutChoice(unittest.TestCase):
+    """
+    Which layout the balancer serves a volume with
+    """
+    def process(self, balancer, volume):
+        client, cxn = socket.socketpair()
+        self.addCleanup(client.close)
+        client.settimeout(5)
+        session = threading.Thread(target=balancer.process_cxn,
+                                   args=(cxn, ),
+                                   daemon=True)
+        session.start()
+        NBDInterpreter(client, client=True).start_session(volume)
+        session.join(5)
+        self.assertFalse(session.is_alive())
+        return client
+
+    def make_balancer(self, layouts, stripe_size=STRIPE):
+        balancer = NBDLoadBalancer([["a"], ["b"], ["c"]],
+                                   stripe_size=stripe_size,
+                                   layouts=layouts)
+        balancer.connect_replica = mock.Mock()
+        balancer.proxy = mock.Mock()
+        return balancer
+
+    def test_new_volume_is_striped(self):
+        with mock.patch.object(lb, 'StripedSession') as session:
+            self.process(self.make_balancer(FakeLayouts()), b'vol')
+        self.assertEqual(STRIPE, session.call_args[0][4])
+        session.return_value.run.assert_called_once_with()
+
+    def test_unstriped_volume_stays_unstriped(self):
+        balancer = self.make_balancer(FakeLayouts({b'vol': None}))
+        replica, lb_end = socket.socketpair()
+        self.addCleanup(replica.close)
+        self.addCleanup(lb_end.close)
+        replica.sendall(MagicValues.HandshakeMagic +
+                        MagicValues.HandshakeMinimalFlags)
+        balancer.connect_replica.return_value = lb_end
+        with mock.patch.object(lb, 'StripedSession') as session:
+            self.process(balancer, b'vol')
+        session.assert_not_called()
+        balancer.connect_replica.assert_called_once_with(
+            b'vol', balancer.shard_for(b'vol'))
+
+    def test_striped_volume_keeps_its_stripe_size(self):
+        layouts = FakeLayouts(
+            {b'vol': {"stripe_size": 2 * STRIPE, "shards": 3}})
+        with mock.patch.object(lb, 'StripedSession') as session:
+            self.process(self.make_balancer(layouts, stripe_size=None),
+                         b'vol')
+        self.assertEqual(2 * STRIPE, session.call_args[0][4])
+
+    def test_hangs_up_without_layout(self):
+        layouts = mock.Mock()
+        layouts.get.side_effect = ConnectionError("no replica")
+        balancer = self.make_balancer(layouts)
+        with self.assertLogs(level='ERROR'):
+            client = self.process(balancer, b'vol')
+        balancer.connect_replica.assert_not_called()
+        self.assertEqual(b'', client.recv(1))
+
+    def test_refuses_volume_striped_over_other_shards(self):
+        layouts = FakeLayouts({b'vol': {"stripe_size": STRIPE, "shards": 2}})
+        with mock.patch.object(lb, 'StripedSession') as session:
+            client = self.process(self.make_balancer(layouts), b'vol')
+        session.assert_not_called()
+        # the balancer hung up
+        self.assertEqual(b'', client.recv(1))
+
+
+class FakeShard(object):
+    """
+    NBD server for one shard's share of a striped volume that fails every
+    request once broken
+    """
+    def __init__(self, sock, size):
+        self.data = bytearray(size)
+        self.requests = []
+        self.broken = False
+        self.thread = threading.Thread(target=self._serve,
+                                       args=(sock, ),
+                                       daemon=True)
+        self.thread.start()
+
+    def _serve(self, sock):
+        iptr = NBDInterpreter(sock)
+        for _ in iptr.get_client_options():
+            pass
+        iptr.send_export_response(len(self.data), multi_conn=True)
+        for req in iptr.get_transmission_requests():
+            self.requests.append((req.kind, req.offset, req.length))
+            if req.kind == MagicValues.RequestKindClose:
+                break
+            end = req.offset + req.length
+            if self.broken:
+                iptr.send_transmission_response(req.handle,
+                                                     error=errno.EIO)
+                continue
+            data = None
+            if req.kind == MagicValues.RequestKindRead:
+                data = bytes(self.data[req.offset:end])
+            elif req.kind == MagicValues.RequestKindWrite:
+                self.data[req.offset:end] = req.data
+            iptr.send_transmission_response(req.handle, data)
+        sock.close()
+
+
+class TestStripedSession(unittest.TestCase):
+    SHARD_SIZE = 8 * STRIPE
+
+    def setUp(self):
+        shards = [["a"], ["b"], ["c"]]
+        balancer = NBDLoadBalancer(shards, layouts=FakeLayouts())
+        self.shards = {}
+
+        def connect_replica(volume, shard_ix):
+            ours, theirs = socket.socketpair()
+            self.addCleanup(ours.close)
+            self.addCleanup(theirs.close)
+            self.shards[shard_ix] = FakeShard(theirs, self.SHARD_SIZE)
+            return ours
+
+        balancer.connect_replica = connect_replica
+        client, cxn = socket.socketpair()
+        client.settimeout(5)
+        self.addCleanup(client.close)
+
+        def run():
+            # as the balancer does before handing over to the session
+            iptr = NBDInterpreter(cxn)
+            for _ in iptr.get_client_options():
+                pass
+            StripedSession(balancer, cxn, iptr, b'vol', STRIPE).run()
+
+        self.thread = threading.Thread(target=run, daemon=True)
+        self.thread.start()
+        self.client = NBDInterpreter(client, client=True)
+        self.client.start_session(b'vol')
+        self.size, _ = self.client.get_export_response()
+        # stripes start on the volume's own shard
+        first = balancer.shard_for(b'vol')
+        self.order = [self.shards[(first + i) % 3] for i in range(3)]
+        self.handles = 0
+        self.addCleanup(self.close)
+
+    def close(self):
+        if self.thread.is_alive():
+            self.client.send_transmission_request(
+                MagicValues.RequestKindClose, b'\x00' * 8, 0, 0)
+        self.thread.join(5)
+        for shard in self.order:
+            shard.thread.join(5)
+        self.assertFalse(self.thread.is_alive())
+
+    def request(self, kind, offset=0, length=0, data=None):
+        self.handles += 1
+        handle = self.handles.to_bytes(byteorder="big", length=8)
+        self.client.send_transmission_request(kind, handle, offset, length,
+                                              data)
+        resp = self.client.get_transmission_response(
+            lambda handle: length if kind == MagicValues.RequestKindRead
+            else 0)
+        self.assertEqual(handle, resp.handle)
+        return resp
+
+    def write(self, offset, data):
+        return self.request(MagicValues.RequestKindWrite, offset, len(data),
+                            data)
+
+    def read(self, offset, length):
+        return self.request(MagicValues.RequestKindRead, offset, length)
+
+    def test_export_is_every_share(self):
+        self.assertEqual(3 * self.SHARD_SIZE, self.size)
+
+    def test_reassembles_reads_across_shards(self):
+        data = bytes(range(256))[:5 * STRIPE + 7]
+        self.assertEqual(0, self.write(3, data).error)
+        resp = self.read(3, len(data))
+        self.assertEqual(0, resp.error)
+        self.assertEqual(data, resp.data)
+        # and each shard holds its own stripes
+        volume = bytearray(3 * self.SHARD_SIZE)
+        volume[3:3 + len(data)] = data
+        for i, shard in enumerate(self.order):
+            for row in range(self.SHARD_SIZE // STRIPE):
+                stripe = row * 3 + i
+                self.assertEqual(
+                    volume[stripe * STRIPE:(stripe + 1) * STRIPE],
+                    shard.data[row * STRIPE:(row + 1) * STRIPE])
+
+    def test_shard_error_fails_whole_request(self):
+        self.write(0, b'x' * 3 * STRIPE)
+        self.order[1].broken = True
+        resp = self.read(0, 3 * STRIPE)
+        self.assertEqual(errno.EIO, resp.error)
+        self.assertIsNone(resp.data)
+        self.assertEqual(errno.EIO, self.write(STRIPE, b'y').error)
+        # requests missing the bad shard are unaffected
+        resp = self.read(0, STRIPE)
+        self.assertEqual(0, resp.error)
+        self.assertEqual(b'x' * STRIPE, resp.data)
+
+    def test_flush_goes_to_every_shard(self):
+        self.assertEqual(0, self.request(MagicValues.RequestKindFlush).error)
+        for shard in self.order:
+            self.assertEqual([(MagicValues.RequestKindFlush, 0, 0)],
+                             shard.requests)
+        self.order[2].broken = True
+        self.assertEqual(errno.EIO,
+                         self.request(MagicValues.RequestKindFlush).error)
+
+    def test_close_reaches_every_shard(self):
+        self.close()
+        for shard in self.order:
+            self.assertEqual(MagicValues.RequestKindClose,
+                             shard.requests[-1][0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,3 +1,4 @@
 #! /usr/bin/sh
 
-nbd-client localhost 2000 /dev/nbd1 -nonetlink
+# NBD_CONNECTIONS opens several sockets to the device for parallel requests
+nbd-client localhost 2000 /dev/nbd1 -nonetlink -connections "${NBD_CONNECTIONS:-1}"
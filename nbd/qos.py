@@ -0,0 +1,143 @@
+import contextlib
+import heapq
+import itertools
+import threading
+import time
+
+DEFAULT_WEIGHT = 1.
+DEFAULT_STORE_CONCURRENCY = 2  # requests reading from the block store at once
+# writes in flight through the Raft log and the write sharer at once
+DEFAULT_REPLICATION_CONCURRENCY = 16
+# charge every request for at least a page so small ones aren't free
+OP_COST_BYTES = 4096
+
+
+class TokenBucket(object):
+    """
+    Refills at `rate` tokens a second up to `burst`
+
+    Takes are never refused -- the balance is allowed to go negative and the
+    taker is told how long to wait for it to be paid back, so requests
+    bigger than the burst still get through at the configured rate.
+    """
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = rate if burst is None else burst
+        self._tokens = self.burst
+        self._updated_at = time.monotonic()
+
+    def take(self, n):
+        """
+        Take n tokens and return the seconds until the balance is positive
+        """
+        now = time.monotonic()
+        self._tokens = min(self.burst,
+                           self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+        self._tokens -= n
+        return max(-self._tokens / self.rate, 0.)
+
+
+class FairQueue(object):
+    """
+    Admits up to `concurrency` requests at a time, picking between waiting
+    volumes by start-time fair queuing
+
+    Each request is tagged with a virtual start time no earlier than the
+    finish of the volume's previous request, where a request finishes
+    cost / weight after it starts. Waiting requests go in order of start
+    tag, so a volume with a deep queue only gets its weighted share while
+    others are waiting and a volume that was idle can't save up credit.
+    """
+    def __init__(self, concurrency):
+        self._cv = threading.Condition()
+        self._free = concurrency
+        self._vtime = 0.
+        self._finish = {}  # volume -> finish tag of its last request
+        self._waiting = []  # heap of (start tag, arrival)
+        self._arrivals = itertools.count()
+
+    def acquire(self, volume, cost, weight=DEFAULT_WEIGHT):
+        with self._cv:
+            start = max(self._vtime, self._finish.get(volume, 0.))
+            self._finish[volume] = start + (cost + OP_COST_BYTES) / weight
+            ticket = (start, next(self._arrivals))
+            heapq.heappush(self._waiting, ticket)
+            self._cv.wait_for(
+                lambda: self._free > 0 and self._waiting[0] == ticket)
+            heapq.heappop(self._waiting)
+            self._free -= 1
+            self._vtime = start
+            # the next in line may be able to go too
+            self._cv.notify_all()
+
+    def release(self):
+        with self._cv:
+            self._free += 1
+            self._cv.notify_all()
+
+    @contextlib.contextmanager
+    def slot(self, volume, cost, weight=DEFAULT_WEIGHT):
+        self.acquire(volume, cost, weight)
+        try:
+            yield
+        finally:
+            self.release()
+
+
+class QoS(object):
+    """
+    Per-volume IOPS and bandwidth limits plus the fair queues in front of
+    the block store and replication
+
+    Limits are a dict of "iops", "bps" and "weight", where a missing or
+    None limit means unlimited. A volume's own limits from the catalog
+    override the node-wide defaults.
+    """
+    def __init__(self,
+                 defaults=None,
+                 catalog=None,
+                 store_concurrency=DEFAULT_STORE_CONCURRENCY,
+                 replication_concurrency=DEFAULT_REPLICATION_CONCURRENCY):
+        self.defaults = defaults or {}
+        self.catalog = catalog
+        self.store = FairQueue(store_concurrency)
+        self.replication = FairQueue(replication_concurrency)
+        self._lock = threading.Lock()
+        # volume -> (limits, IOPS bucket, bandwidth bucket)
+        self._buckets = {}
+
+    def limits(self, volume):
+        limits = dict(self.defaults)
+        if self.catalog is not None:
+            limits.update(self.catalog.qos(volume))
+        return limits
+
+    def weight(self, volume):
+        return self.limits(volume).get("weight") or DEFAULT_WEIGHT
+
+    def throttle(self, volume, length):
+        """
+        Block until the volume's limits allow another request of `length`
+        bytes
+        """
+        limits = self.limits(volume)
+        with self._lock:
+            entry = self._buckets.get(volume)
+            if entry is None or entry[0] != limits:
+                # limits changed since we last saw the volume so start over
+                entry = (limits, _bucket(limits.get("iops")),
+                         _bucket(limits.get("bps")))
+                self._buckets[volume] = entry
+            _, iops, bps = entry
+            delay = 0.
+            if iops:
+                delay = max(delay, iops.take(1))
+            if bps:
+                delay = max(delay, bps.take(length))
+        if delay:
+            time.sleep(delay)
+
+
+def _bucket(rate):
+    return TokenBucket(rate) if rate else None
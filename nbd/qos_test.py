@@ -0,0 +1,95 @@
+import threading
+import time
+import types
+import unittest
+from unittest import mock
+
+from nbd import qos
+from nbd.qos import FairQueue, TokenBucket, OP_COST_BYTES
+
+COST = 4096 - OP_COST_BYTES  # so every request is charged 4096
+
+
+class TestTokenBucket(unittest.TestCase):
+    def setUp(self):
+        self.now = 0.
+        patch = mock.patch.object(
+            qos, 'time', types.SimpleNamespace(monotonic=lambda: self.now))
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_within_burst_is_free(self):
+        bucket = TokenBucket(100)
+        self.assertEqual(0., bucket.take(60))
+        self.assertEqual(0., bucket.take(40))
+        self.assertAlmostEqual(.01, bucket.take(1))
+
+    def test_larger_than_burst_goes_into_debt(self):
+        bucket = TokenBucket(100, burst=50)
+        # paid back at the configured rate
+        self.assertAlmostEqual(2.5, bucket.take(300))
+        self.now = 1.
+        self.assertAlmostEqual(1.5, bucket.take(0))
+        self.now = 2.5
+        self.assertEqual(0., bucket.take(0))
+
+    def test_refill_is_capped_at_burst(self):
+        bucket = TokenBucket(100, burst=50)
+        self.now = 10.
+        self.assertEqual(0., bucket.take(50))
+        self.assertAlmostEqual(.5, bucket.take(50))
+
+
+class TestFairQueue(unittest.TestCase):
+    def run_waiters(self, queue, volumes, weights=None):
+        """
+        Queue a request for each of volumes in turn behind one holding the
+        only slot and return the order they're let through in
+        """
+        weights = weights or {}
+        order = []
+
+        def run(volume):
+            queue.acquire(volume, COST, weights.get(volume, 1.))
+            order.append(volume)
+            queue.release()
+
+        threads = []
+        for i, volume in enumerate(volumes):
+            thread = threading.Thread(target=run, args=(volume, ), daemon=True)
+            thread.start()
+            threads.append(thread)
+            deadline = time.time() + 5
+            while len(queue._waiting) <= i and time.time() < deadline:
+                time.sleep(.001)
+        queue.release()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(len(volumes), len(order))
+        return order
+
+    def test_orders_by_weighted_start_time(self):
+        queue = FairQueue(1)
+        queue.acquire('holder', COST)
+        order = self.run_waiters(queue,
+                                 ['heavy'] * 4 + ['light'] * 2,
+                                 weights={'heavy': 2.})
+        # the heavy volume's requests finish in half the virtual time so it
+        # gets two goes for each of the light volume's
+        self.assertEqual(
+            ['heavy', 'light', 'heavy', 'heavy', 'light', 'heavy'], order)
+
+    def test_idle_volume_resumes_at_current_virtual_time(self):
+        queue = FairQueue(1)
+        for _ in range(10):
+            with queue.slot('busy', COST):
+                pass
+        queue.acquire('busy', COST)
+        order = self.run_waiters(queue, ['busy'] * 3 + ['idle'] * 3)
+        # no credit saved up from while it was idle to go three in a row
+        self.assertEqual(['idle', 'busy', 'idle', 'busy', 'idle', 'busy'],
+                         order)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,430 @@
+import logging
+import os
+import socket
+import _thread
+import threading
+import uuid
+
+from nbd.iptr import next_n_bytes
+from nbd.state import LocalState, DEFAULT_DEVICE_SIZE, DEFAULT_EXTENT_SIZE
+from pysyncobj import SyncObjConsumer
+from pysyncobj.batteries import ReplList
+from pysyncobj.syncobj import AsyncResult, replicated
+
+
+class ReplBlocks(ReplList):
+    @replicated
+    def setslicesubset(self, i, j, sequence):
+        self.rawData()[i:j] = sequence
+
+    @replicated
+    def extend_zeros(self, count):
+        self.rawData().extend([b'\x00'] * count)
+
+    # Break up the write, otherwise it may pickle beyond the size of one packet
+    # and PySyncObj isn't set up for that
+    def setslice(self, i, j, sequence):
+        size = 2**12
+        asyncs = []
+        offset = i
+        while offset < j:
+            end = min(offset + size, j)
+            asc = AsyncResult()
+            self.setslicesubset(offset,
+                                end,
+                                sequence[offset - i:end - i],
+                                callback=asc.onResult)
+            asyncs.append(asc)
+            offset += size
+
+        for asc in asyncs:
+            asc.event.wait(None)
+
+    def __setitem__(self, k, v):
+        if isinstance(k, slice):
+            self.setslice(k.start, k.stop, v)
+        else:
+            super()[k] = v
+
+
+class LoglessCache(object):
+    def __init__(self, capacity=100):
+        self._roundrobin = [b''] * capacity
+        self._uuid2write = {}
+        self._lock = threading.Lock()
+        self._ix = 0
+
+    def set(self, newuuid, val):
+        with self._lock:
+            curuuid = self._roundrobin[self._ix]
+            if curuuid in self._uuid2write:
+                del self._uuid2write[curuuid]
+            self._roundrobin[self._ix] = newuuid
+            self._uuid2write[newuuid] = val
+            self._ix = (self._ix + 1) % len(self._roundrobin)
+
+    def get(self, write_uuid):
+        with self._lock:
+            return self._uuid2write.get(write_uuid, b'')
+
+
+class WriteSharer(object):
+    def __init__(self, peers, cache):
+        self.peers = peers
+        self.locks = {peer: threading.Lock() for peer in self.peers}
+        self.cache = cache
+        self.clients = {}
+
+    def listen_for_asks(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(("0.0.0.0", 2002))
+        sock.setblocking(True)
+        sock.listen(1)
+        while True:
+            cxn, _client = sock.accept()
+            _thread.start_new_thread(self._handle_asks, (cxn, ))
+
+    def _handle_asks(self, cxn):
+        while True:
+            write_uuid_len = int.from_bytes(next_n_bytes(cxn, 4),
+                                            byteorder="big")
+            write_uuid = next_n_bytes(cxn, write_uuid_len)
+            write = self.cache.get(write_uuid)
+            cxn.sendall(len(write).to_bytes(byteorder="big", length=4))
+            cxn.sendall(write)
+
+    def get_write(self, write_uuid, check_first):
+        peers = list(self.peers)
+        if check_first in peers:
+            peers.remove(check_first)
+            peers.insert(0, check_first)
+        write = self.cache.get(write_uuid)
+        if write != b'':
+            return write
+        for peer in peers:
+            with self.locks[peer]:
+                client = self.clients.get(peer)
+                if client is None:
+                    client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                    client.connect((peer, 2002))
+                    self.clients[peer] = client
+                client.sendall(
+                    len(write_uuid).to_bytes(byteorder="big", length=4))
+                client.sendall(write_uuid)
+                write_len = int.from_bytes(next_n_bytes(client, 4),
+                                           byteorder="big")
+                if write_len != 0:
+                    return next_n_bytes(client, write_len)
+        raise ValueError("Write not found", write_uuid)
+
+
+class ReplFile(SyncObjConsumer):
+    def __init__(self, extent_size=DEFAULT_EXTENT_SIZE):
+        super(ReplFile, self).__init__()
+        self.__extent_size = extent_size
+        # extent of the block file -> number of writes applied to it, which
+        # is the same on every replica at the same point in the log
+        self.__generations = {}
+
+    @replicated
+    def write(self, originator, offset, write_uuid, volume=None, length=None):
+        try:
+            write = LocalState.write_sharer.get_write(write_uuid, originator)
+        except ValueError:
+            write = None
+        if length is None:
+            if write is None:
+                logging.error(
+                    "Failed to write {} to offset {} -- block not found among "
+                    "peers".format(write_uuid, offset))
+                return
+            length = len(write)
+        with LocalState.lock:
+            if volume is not None:
+                # resolve the volume offset as the write is applied rather
+                # than when it was issued so that a snapshot taken in
+                # between can't end up with the write
+                offset = LocalState.catalog.prepare_write(
+                    volume, offset, length)
+                if offset is None:
+                    return
+            # count the write even if we couldn't get hold of it so that the
+            # scrubber sees this replica's extents as stale
+            self.__touch(offset, length)
+            if write is None:
+                logging.error(
+                    "Failed to write {} to offset {} -- block not found among "
+                    "peers, leaving it to the scrubber".format(
+                        write_uuid, offset))
+                return
+            logging.info("Writing {} to offset {}".format(write_uuid, offset))
+            LocalState.f.seek(offset)
+            LocalState.f.write(write)
+            if LocalState.cache:
+                LocalState.cache.invalidate(offset, len(write))
+
+    @replicated
+    def write_zeros(self, offset, length):
+        with LocalState.lock:
+            self.__touch(offset, length)
+            LocalState.f.seek(offset)
+            LocalState.f.write(b'\x00' * length)
+            if LocalState.cache:
+                LocalState.cache.invalidate(offset, length)
+
+    def __touch(self, offset, length):
+        first = offset // self.__extent_size
+        last = (offset + max(length, 1) - 1) // self.__extent_size
+        for extent in range(first, last + 1):
+            self.__generations[extent] = self.__generations.get(extent, 0) + 1
+        if LocalState.checksums:
+            LocalState.checksums.invalidate(offset, length)
+
+    def extent_span(self):
+        """
+        One past the last extent of the block file that's been written
+        """
+        with LocalState.lock:
+            return max(self.__generations, default=-1) + 1
+
+    def extent_digests(self, start, end, refresh=False):
+        """
+        (generation, crc) of every written extent in [start, end), taking
+        the lock per extent so as not to hold up writes for long -- refresh
+        re-reads the extents rather than trusting their cached checksums
+        """
+        with LocalState.lock:
+            extents = [e for e in self.__generations if start <= e < end]
+        digests = {}
+        for extent in extents:
+            with LocalState.lock:
+                digests[extent] = (self.__generations[extent],
+                                   LocalState.checksums.crc(extent,
+                                                            refresh=refresh))
+        return digests
+
+    def extent_data(self, extent, generation):
+        """
+        The extent's data if it's still at the given generation, else None
+        """
+        with LocalState.lock:
+            if self.__generations.get(extent) != generation:
+                return None
+            return LocalState.checksums.read(extent)
+
+    def repair_extent(self, extent, generation, data):
+        """
+        Overwrite the extent with a peer's copy unless a write has been
+        applied to it since the copy was compared
+        """
+        with LocalState.lock:
+            if self.__generations.get(extent) != generation:
+                return False
+            offset = extent * self.__extent_size
+            LocalState.f.seek(offset)
+            LocalState.f.write(data)
+            if LocalState.cache:
+                LocalState.cache.invalidate(offset, len(data))
+            LocalState.checksums.invalidate(offset, len(data))
+            return True
+
+    def read(self, offset, length, stream=None):
+        if LocalState.cache:
+            return LocalState.cache.read(offset, length, stream=stream)
+        with LocalState.lock:
+            LocalState.f.seek(offset)
+            return LocalState.f.read(length)
+
+    def lead_write(self, offset, data, volume=None, callback=None):
+        sync = False
+        with LocalState.lock:
+            LocalState.write_count += 1
+            if LocalState.write_count >= 20:
+                LocalState.write_count = 0
+                sync = True
+        write_uuid = uuid.uuid1().bytes
+        LocalState.write_sharer.cache.set(write_uuid, data)
+        result = AsyncResult()
+
+        def on_result(res, err):
+            result.onResult(res, err)
+            if callback:
+                callback(res, err)
+
+        self.write(LocalState.hostname,
+                   offset,
+                   write_uuid,
+                   volume=volume,
+                   length=len(data),
+                   callback=on_result)
+        if sync:
+            # periodically wait for our writes to catch up
+            result.event.wait(None)
+
+    def flush(self):
+        with LocalState.lock:
+            LocalState.f.flush()
+            os.fsync(LocalState.f.fileno())
+
+
+class VolumeCatalog(SyncObjConsumer):
+    """
+    Replicated catalog of volumes and the slots backing them in the block file
+
+    Every volume, snapshot and clone is a node with its own
+    DEFAULT_DEVICE_SIZE slot and an optional parent node. Each node's block
+    map records which extents have been written to its own slot and every
+    other extent resolves to the nearest ancestor that has written it, or to
+    zeros if none has. Snapshots and clones are therefore metadata-only and
+    data is copied locally on each replica, one extent at a time, the first
+    time a node writes to an extent it doesn't own yet.
+    """
+    def __init__(self, extent_size=DEFAULT_EXTENT_SIZE):
+        super(VolumeCatalog, self).__init__()
+        self.__extent_size = extent_size
+        self.__slots = {}  # volume name -> slot of its current node
+        self.__parents = {}  # slot -> parent slot or None
+        self.__extents = {}  # slot -> set of extents written to the slot
+        self.__snapshots = set()  # names of read-only volumes
+        self.__qos = {}  # volume name -> limits overriding the node defaults
+        # volume name -> how the balancers lay it out across shards
+        self.__layouts = {}
+
+    def __contains__(self, volume):
+        return volume in self.__slots
+
+    @replicated
+    def create(self, volume):
+        with LocalState.lock:
+            if volume not in self.__slots:
+                self.__slots[volume] = self.__new_node(None)
+
+    @replicated
+    def snapshot(self, volume, snapshot):
+        with LocalState.lock:
+            if volume not in self.__slots or snapshot in self.__slots:
+                logging.error("Can't snapshot {} as {}".format(
+                    volume, snapshot))
+                return
+            self.__slots[snapshot] = self.__freeze(volume)
+            self.__snapshots.add(snapshot)
+
+    @replicated
+    def clone(self, source, volume):
+        with LocalState.lock:
+            if source not in self.__slots or volume in self.__slots:
+                logging.error("Can't clone {} as {}".format(source, volume))
+                return
+            if source in self.__snapshots:
+                parent = self.__slots[source]
+            else:
+                parent = self.__freeze(source)
+            self.__slots[volume] = self.__new_node(parent)
+
+    @replicated
+    def set_qos(self, volume, limits):
+        with LocalState.lock:
+            if volume not in self.__slots:
+                logging.error("Can't set QoS of missing volume {}".format(
+                    volume))
+                return
+            self.__qos[volume] = {
+                key: value
+                for key, value in limits.items() if value is not None
+            }
+
+    @replicated
+    def claim_layout(self, volume, layout):
+        """
+        Record the volume's layout unless one already has been, returning
+        whichever layout the volume ends up with
+
+        Balancers racing to serve a new volume each propose their own
+        default and all get back the one the log applied first.
+        """
+        with LocalState.lock:
+            return self.__layouts.setdefault(volume, layout)
+
+    def is_read_only(self, volume):
+        return volume in self.__snapshots
+
+    def qos(self, volume):
+        return self.__qos.get(volume, {})
+
+    def resolve(self, volume, offset, length):
+        """
+        Map a range of a volume to (block file offset, length) segments where
+        a None offset means the segment has never been written and reads as
+        zeros
+        """
+        segments = []
+        with LocalState.lock:
+            slot = self.__slots[volume]
+            end = offset + length
+            while offset < end:
+                extent = offset // self.__extent_size
+                seg_end = min((extent + 1) * self.__extent_size, end)
+                owner = self.__owner(slot, extent)
+                start = None if owner is None else \
+                    owner * DEFAULT_DEVICE_SIZE + offset
+                prev = segments[-1] if segments else None
+                if prev and ((prev[0] is None and start is None) or
+                             (prev[0] is not None and start is not None
+                              and prev[0] + prev[1] == start)):
+                    segments[-1] = (prev[0], prev[1] + seg_end - offset)
+                else:
+                    segments.append((start, seg_end - offset))
+                offset = seg_end
+        return segments
+
+    def prepare_write(self, volume, offset, length):
+        """
+        Copy up any extents the volume's node doesn't own yet and return the
+        block file offset to write to -- called by replicas as they apply a
+        write while holding LocalState.lock
+        """
+        if volume not in self.__slots or volume in self.__snapshots:
+            logging.error(
+                "Discarding write to {} -- volume is missing or read-only".
+                format(volume))
+            return None
+        slot = self.__slots[volume]
+        base = slot * DEFAULT_DEVICE_SIZE
+        first = offset // self.__extent_size
+        last = (offset + max(length, 1) - 1) // self.__extent_size
+        for extent in range(first, last + 1):
+            if extent in self.__extents[slot]:
+                continue
+            owner = self.__owner(slot, extent)
+            data = b''
+            if owner is not None:
+                LocalState.f.seek(owner * DEFAULT_DEVICE_SIZE +
+                                  extent * self.__extent_size)
+                data = LocalState.f.read(self.__extent_size)
+            start = base + extent * self.__extent_size
+            LocalState.f.seek(start)
+            LocalState.f.write(data.ljust(self.__extent_size, b'\x00'))
+            if LocalState.cache:
+                LocalState.cache.invalidate(start, self.__extent_size)
+            self.__extents[slot].add(extent)
+        return base + offset
+
+    def __owner(self, slot, extent):
+        while slot is not None and extent not in self.__extents[slot]:
+            slot = self.__parents[slot]
+        return slot
+
+    def __new_node(self, parent):
+        slot = len(self.__parents)
+        self.__parents[slot] = parent
+        self.__extents[slot] = set()
+        return slot
+
+    def __freeze(self, volume):
+        """
+        Freeze the volume's current node and move the volume onto a fresh
+        child of it, returning the frozen slot
+        """
+        frozen = self.__slots[volume]
+        self.__slots[volume] = self.__new_node(frozen)
+        return frozen
@@ -0,0 +1,258 @@
+import errno
+import io
+import socket
+import threading
+import unittest
+import zlib
+from unittest import mock
+
+from nbd import repl, server
+from nbd.iptr import NBDInterpreter, MagicValues
+from nbd.qos import QoS
+from nbd.repl import ReplFile, VolumeCatalog
+from nbd.scrub import ExtentChecksums
+from nbd.state import LocalState
+
+EXTENT = 16
+SLOT = 8 * EXTENT  # so the block file stays small
+
+
+class FakeSharer(object):
+    """
+    Write sharer holding every write in memory
+    """
+    def __init__(self):
+        self.writes = {}
+
+    def get_write(self, write_uuid, check_first):
+        if write_uuid not in self.writes:
+            raise ValueError("Write not found", write_uuid)
+        return self.writes[write_uuid]
+
+
+class LocalStateTest(unittest.TestCase):
+    """
+    Applies replicated calls straight to an in-memory block file
+    """
+    def setUp(self):
+        self.f = io.BytesIO()
+        self.sharer = FakeSharer()
+        patches = [
+            mock.patch.object(LocalState, 'f', self.f),
+            mock.patch.object(LocalState, 'lock', threading.Lock()),
+            mock.patch.object(LocalState, 'cache', None),
+            mock.patch.object(LocalState, 'checksums',
+                              ExtentChecksums(self.f, EXTENT)),
+            mock.patch.object(LocalState, 'write_sharer', self.sharer),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.blocks = ReplFile(extent_size=EXTENT)
+
+    def write(self, offset, data, volume=None):
+        write_uuid = str(len(self.sharer.writes)).encode()
+        self.sharer.writes[write_uuid] = data
+        self.blocks.write('peer',
+                          offset,
+                          write_uuid,
+                          volume=volume,
+                          length=len(data),
+                          _doApply=True)
+
+
+class TestReplFile(LocalStateTest):
+    def test_extent_digests(self):
+        self.write(0, b'a' * EXTENT)
+        self.write(EXTENT - 1, b'bb')
+        self.write(3 * EXTENT, b'c')
+        self.assertEqual(4, self.blocks.extent_span())
+        first = b'a' * (EXTENT - 1) + b'b'
+        second = b'b' + b'\x00' * (EXTENT - 1)
+        self.assertEqual(
+            {
+                0: (2, zlib.crc32(first)),
+                1: (1, zlib.crc32(second)),
+            }, self.blocks.extent_digests(0, 3))
+
+    def test_digests_follow_writes(self):
+        self.write(0, b'a' * EXTENT)
+        self.blocks.extent_digests(0, 1)
+        self.write(0, b'b')
+        generation, crc = self.blocks.extent_digests(0, 1)[0]
+        self.assertEqual(2, generation)
+        self.assertEqual(zlib.crc32(b'b' + b'a' * (EXTENT - 1)), crc)
+
+    def test_missing_write_still_counts(self):
+        # the scrubber should see this replica as behind on the extent
+        with self.assertLogs(level='ERROR'):
+            self.blocks.write('peer',
+                              0,
+                              b'lost',
+                              length=EXTENT,
+                              _doApply=True)
+        self.assertEqual(1, self.blocks.extent_digests(0, 1)[0][0])
+
+    def test_repair_extent(self):
+        self.write(EXTENT, b'a' * EXTENT)
+        generation, _ = self.blocks.extent_digests(1, 2)[1]
+        self.assertTrue(
+            self.blocks.repair_extent(1, generation, b'r' * EXTENT))
+        self.assertEqual(b'r' * EXTENT, self.blocks.extent_data(1, generation))
+        self.assertEqual((generation, zlib.crc32(b'r' * EXTENT)),
+                         self.blocks.extent_digests(1, 2)[1])
+
+    def test_repair_skips_extent_written_since(self):
+        self.write(0, b'a' * EXTENT)
+        generation, _ = self.blocks.extent_digests(0, 1)[0]
+        self.write(0, b'n' * EXTENT)
+        self.assertFalse(
+            self.blocks.repair_extent(0, generation, b'r' * EXTENT))
+        self.assertIsNone(self.blocks.extent_data(0, generation))
+        self.assertEqual(b'n' * EXTENT, self.blocks.extent_data(0, 2))
+
+
+class TestVolumeCatalog(LocalStateTest):
+    def setUp(self):
+        super().setUp()
+        self.catalog = VolumeCatalog(extent_size=EXTENT)
+        patches = [
+            mock.patch.object(repl, 'DEFAULT_DEVICE_SIZE', SLOT),
+            mock.patch.object(LocalState, 'catalog', self.catalog),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.catalog.create(b'vol', _doApply=True)
+
+    def read(self, volume, offset, length):
+        return server.read_volume(self.blocks, self.catalog, volume, offset,
+                                  length)
+
+    def test_resolve(self):
+        self.assertEqual([(None, 3 * EXTENT)],
+                         self.catalog.resolve(b'vol', 0, 3 * EXTENT))
+        self.write(EXTENT + 4, b'abcd', volume=b'vol')
+        self.write(2 * EXTENT, b'efgh', volume=b'vol')
+        # adjoining extents of the same slot come back as one segment
+        self.assertEqual([(None, EXTENT), (EXTENT, 2 * EXTENT),
+                          (None, EXTENT)],
+                         self.catalog.resolve(b'vol', 0, 4 * EXTENT))
+        self.assertEqual([(EXTENT + 4, 4)],
+                         self.catalog.resolve(b'vol', EXTENT + 4, 4))
+
+    def test_volumes_get_their_own_slots(self):
+        self.catalog.create(b'other', _doApply=True)
+        self.catalog.create(b'vol', _doApply=True)
+        self.write(0, b'other', volume=b'other')
+        self.assertEqual([(SLOT, 5)], self.catalog.resolve(b'other', 0, 5))
+        self.assertEqual(b'\x00' * 5, self.read(b'vol', 0, 5))
+
+    def test_copy_up_on_first_write(self):
+        self.write(0, b'a' * 2 * EXTENT, volume=b'vol')
+        self.catalog.clone(b'vol', b'clone', _doApply=True)
+        self.write(4, b'bb', volume=b'clone')
+        # the clone now owns the whole extent, copied from its parent
+        [(start, length)] = self.catalog.resolve(b'clone', 0, EXTENT)
+        self.assertEqual(EXTENT, length)
+        self.assertNotEqual(0, start // SLOT)
+        self.assertEqual(b'aaaabb' + b'a' * (2 * EXTENT - 6),
+                         self.read(b'clone', 0, 2 * EXTENT))
+        # while the extent it didn't touch is still its parent's
+        self.assertEqual(self.catalog.resolve(b'vol', EXTENT, EXTENT),
+                         self.catalog.resolve(b'clone', EXTENT, EXTENT))
+
+    def test_copy_up_of_unwritten_extent_is_zeros(self):
+        self.catalog.clone(b'vol', b'clone', _doApply=True)
+        self.write(4, b'bb', volume=b'clone')
+        self.assertEqual(b'\x00' * 4 + b'bb' + b'\x00' * (EXTENT - 6),
+                         self.read(b'clone', 0, EXTENT))
+
+    def test_snapshot_and_clone_are_isolated(self):
+        self.write(0, b'old!', volume=b'vol')
+        self.catalog.snapshot(b'vol', b'snap', _doApply=True)
+        self.catalog.clone(b'vol', b'clone', _doApply=True)
+        self.write(0, b'new!', volume=b'vol')
+        self.assertEqual(b'new!', self.read(b'vol', 0, 4))
+        self.assertEqual(b'old!', self.read(b'snap', 0, 4))
+        self.assertEqual(b'old!', self.read(b'clone', 0, 4))
+        self.write(0, b'mine', volume=b'clone')
+        self.assertEqual(b'mine', self.read(b'clone', 0, 4))
+        self.assertEqual(b'new!', self.read(b'vol', 0, 4))
+        self.assertEqual(b'old!', self.read(b'snap', 0, 4))
+
+    def test_clone_of_snapshot(self):
+        self.write(0, b'old!', volume=b'vol')
+        self.catalog.snapshot(b'vol', b'snap', _doApply=True)
+        self.catalog.clone(b'snap', b'clone', _doApply=True)
+        self.write(0, b'mine', volume=b'clone')
+        self.assertEqual(b'old!', self.read(b'snap', 0, 4))
+        self.assertEqual(b'old!', self.read(b'vol', 0, 4))
+
+    def test_snapshot_is_read_only(self):
+        self.catalog.snapshot(b'vol', b'snap', _doApply=True)
+        self.assertTrue(self.catalog.is_read_only(b'snap'))
+        self.assertFalse(self.catalog.is_read_only(b'vol'))
+        # even a write that makes it into the log is discarded
+        with self.assertLogs(level='ERROR'):
+            self.write(0, b'nope', volume=b'snap')
+        self.assertEqual(b'\x00' * 4, self.read(b'snap', 0, 4))
+
+    def test_snapshot_write_gets_eperm(self):
+        self.write(0, b'old!', volume=b'vol')
+        self.catalog.snapshot(b'vol', b'snap', _doApply=True)
+        patches = [
+            mock.patch.object(LocalState, 'volume_states', {}),
+            mock.patch.object(LocalState, 'qos', QoS()),
+            mock.patch.object(LocalState, 'trace', None),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        client, cxn = socket.socketpair()
+        client.settimeout(5)
+        self.addCleanup(client.close)
+        threading.Thread(target=server.handle_cxn,
+                         args=(cxn, self.blocks, self.catalog, None),
+                         daemon=True).start()
+        iptr = NBDInterpreter(client, client=True)
+        iptr.start_session(b'snap')
+        iptr.get_export_response()
+        iptr.send_transmission_request(MagicValues.RequestKindWrite,
+                                       b'\x00' * 7 + b'\x01', 0, 4, b'nope')
+        resp = iptr.get_transmission_response(lambda handle: 0)
+        self.assertEqual(errno.EPERM, resp.error)
+        iptr.send_transmission_request(MagicValues.RequestKindRead,
+                                       b'\x00' * 7 + b'\x02', 0, 4)
+        resp = iptr.get_transmission_response(lambda handle: 4)
+        self.assertEqual(b'old!', resp.data)
+
+    def test_first_layout_claimed_sticks(self):
+        striped = {"stripe_size": 4 * EXTENT, "shards": 3}
+        self.assertIsNone(
+            self.catalog.claim_layout(b'new', None, _doApply=True))
+        self.assertIsNone(
+            self.catalog.claim_layout(b'new', striped, _doApply=True))
+        self.assertEqual(
+            striped, self.catalog.claim_layout(b'other', striped,
+                                               _doApply=True))
+
+    def test_set_qos(self):
+        self.assertEqual({}, self.catalog.qos(b'vol'))
+        limits = {"iops": 100, "bps": None, "weight": 2.}
+        self.catalog.set_qos(b'vol', limits, _doApply=True)
+        # unset limits fall back to the node defaults
+        self.assertEqual({"iops": 100, "weight": 2.}, self.catalog.qos(b'vol'))
+        qos = QoS(defaults={"bps": 2**20, "iops": 10}, catalog=self.catalog)
+        self.assertEqual({
+            "iops": 100,
+            "bps": 2**20,
+            "weight": 2.
+        }, qos.limits(b'vol'))
+        with self.assertLogs(level='ERROR'):
+            self.catalog.set_qos(b'missing', {"iops": 1}, _doApply=True)
+        self.assertEqual({}, self.catalog.qos(b'missing'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,216 @@
+import argparse
+import collections
+import contextlib
+import socket
+import statistics
+import threading
+import time
+
+from nbd.iptr import NBDInterpreter, MagicValues
+from nbd.trace import TraceSession, read_trace
+
+DEFAULT_MAX_IN_FLIGHT = 128  # requests per connection, like a device queue
+
+KIND_NAMES = {
+    MagicValues.RequestKindRead: "read",
+    MagicValues.RequestKindWrite: "write",
+    MagicValues.RequestKindFlush: "flush",
+}
+
+
+class ReplaySession(object):
+    """
+    Re-drives one traced connection's requests against a server
+
+    Requests are sent at their traced times, divided by speed, without
+    waiting for earlier ones to be answered so that the server sees the
+    same concurrency it did when the trace was taken -- up to
+    max_in_flight, past which sending waits on replies.
+    """
+    def __init__(self, address, volume, requests, speed, max_in_flight):
+        self.requests = requests
+        self.speed = speed
+        self.sock = socket.create_connection(address)
+        self.iptr = NBDInterpreter(self.sock, client=True)
+        self.iptr.start_session(volume)
+        self.iptr.get_export_response()
+        self._in_flight = threading.Semaphore(max_in_flight)
+        self._lock = threading.Lock()
+        self._pending = {}  # handle -> (traced request, sent at)
+        # (traced request, replayed latency, replayed error) per reply
+        self.results = []
+        # whatever stopped the reader before every reply was in
+        self._error = None
+
+    def run(self, started_at):
+        reader = threading.Thread(target=self._read_replies)
+        reader.start()
+        for i, req in enumerate(self.requests):
+            if self.speed:
+                delay = started_at + req.start / self.speed - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            self._in_flight.acquire()
+            if self._error is not None:
+                break
+            handle = i.to_bytes(byteorder="big", length=8)
+            data = None
+            if req.kind == MagicValues.RequestKindWrite:
+                # without a recorded payload any bytes of the right length
+                # make the same demands of the server
+                data = req.data or b'\x00' * req.length
+            with self._lock:
+                self._pending[handle] = (req, time.monotonic())
+            try:
+                self.iptr.send_transmission_request(req.kind, handle,
+                                                    req.offset, req.length,
+                                                    data)
+            except OSError as e:
+                self._error = self._error or e
+                # stop the reader waiting on replies that won't come
+                with contextlib.suppress(OSError):
+                    self.sock.shutdown(socket.SHUT_RDWR)
+                break
+        reader.join()
+        if self._error is not None:
+            self.sock.close()
+            raise self._error
+        self.iptr.send_transmission_request(MagicValues.RequestKindClose,
+                                            b'\x00' * 8, 0, 0)
+        self.sock.close()
+
+    def _read_length(self, handle):
+        with self._lock:
+            if handle not in self._pending:
+                raise ValueError("Reply for unknown handle {}".format(
+                    handle.hex()))
+            req, _ = self._pending[handle]
+        return req.length if req.kind == MagicValues.RequestKindRead else 0
+
+    def _read_replies(self):
+        try:
+            for _ in range(len(self.requests)):
+                resp = self.iptr.get_transmission_response(self._read_length)
+                if resp is None:
+                    raise ConnectionError("Server closed the connection")
+                with self._lock:
+                    entry = self._pending.pop(resp.handle, None)
+                if entry is None:
+                    raise ValueError("Reply for unknown handle {}".format(
+                        resp.handle.hex()))
+                req, sent_at = entry
+                self.results.append(
+                    (req, time.monotonic() - sent_at, resp.error))
+                self._in_flight.release()
+        except Exception as e:
+            self._error = self._error or e
+            # the sender may be waiting on a reply that's never coming
+            self._in_flight.release()
+
+
+def load_sessions(path):
+    """
+    The traced connections as {session: (volume, [TraceRequest, ...])}
+    """
+    sessions = {}
+    for record in read_trace(path):
+        if isinstance(record, TraceSession):
+            sessions[record.session] = (record.volume, [])
+        elif record.kind in KIND_NAMES:
+            sessions[record.session][1].append(record)
+    # requests are recorded as they finish so put them back in send order
+    for _, requests in sessions.values():
+        requests.sort(key=lambda req: req.start)
+    return sessions
+
+
+def replay(path,
+           address,
+           speed=1.,
+           volume_prefix=b'',
+           max_in_flight=DEFAULT_MAX_IN_FLIGHT):
+    replays = [
+        ReplaySession(address, volume_prefix + volume, requests, speed,
+                      max_in_flight)
+        for volume, requests in load_sessions(path).values() if requests
+    ]
+    started_at = time.monotonic()
+    errors = []
+
+    def run(session):
+        try:
+            session.run(started_at)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [
+        threading.Thread(target=run, args=(session, )) for session in replays
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return [result for session in replays for result in session.results
+            ], time.monotonic() - started_at
+
+
+def _percentiles(values):
+    values = sorted(values)
+    return (statistics.median(values),
+            values[min(int(len(values) * .99), len(values) - 1)])
+
+
+def report(results, total_s):
+    by_kind = collections.defaultdict(list)
+    for req, latency, error in results:
+        by_kind[KIND_NAMES[req.kind]].append((req, latency, error))
+    print("replayed {} requests in {:.2f}s".format(len(results), total_s))
+    # traced latencies are the server's, from reading a request to
+    # answering it, while replayed ones are seen from the client so also
+    # take in the network
+    print("| kind | count | errors | traced server p50 ms "
+          "| traced server p99 ms | replayed client p50 ms "
+          "| replayed client p99 ms |")
+    print("|---|---|---|---|---|---|---|")
+    for kind in sorted(by_kind):
+        rows = by_kind[kind]
+        traced = _percentiles([req.latency for req, _, _ in rows])
+        replayed = _percentiles([latency for _, latency, _ in rows])
+        errors = sum(1 for _, _, error in rows if error)
+        print("| {} | {} | {} | {:.2f} | {:.2f} | {:.2f} | {:.2f} |".format(
+            kind, len(rows), errors, traced[0] * 1e3, traced[1] * 1e3,
+            replayed[0] * 1e3, replayed[1] * 1e3))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Replay a trace recorded with NBDD_TRACE_PATH")
+    parser.add_argument("trace")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=2000)
+    parser.add_argument(
+        "--speed",
+        type=float,
+        default=1.,
+        help="multiple of the traced request rate, or 0 for as fast as "
+        "the server answers")
+    parser.add_argument(
+        "--volume-prefix",
+        default="replay-",
+        help="prepended to the traced export names so a replay doesn't "
+        "write over the originals")
+    parser.add_argument("--max-in-flight",
+                        type=int,
+                        default=DEFAULT_MAX_IN_FLIGHT)
+    args = parser.parse_args()
+    results, total_s = replay(args.trace, (args.host, args.port),
+                              speed=args.speed,
+                              volume_prefix=args.volume_prefix.encode("utf-8"),
+                              max_in_flight=args.max_in_flight)
+    report(results, total_s)
+
+
+if __name__ == "__main__":
+    main()
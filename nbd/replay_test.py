@@ -0,0 +1,125 @@
+import contextlib
+import socket
+import threading
+import unittest
+from unittest import mock
+
+from nbd import replay
+from nbd.iptr import NBDInterpreter, MagicValues
+from nbd.replay import ReplaySession
+from nbd.trace import TraceRequest
+
+
+def write_request(start, offset=0, length=16):
+    return TraceRequest(0, start, 0., MagicValues.RequestKindWrite, offset,
+                        length, 0, None)
+
+
+def read_request(start, offset=0, length=16):
+    return TraceRequest(0, start, 0., MagicValues.RequestKindRead, offset,
+                        length, 0, None)
+
+
+class FakeServer(object):
+    """
+    NBD server that answers the first `answer` requests, or every one if
+    None, and then hangs up -- reply_handle overrides the handle replied to
+    """
+    def __init__(self, answer=None, reply_handle=None):
+        self.answer = answer
+        self.reply_handle = reply_handle
+        self.requests = []
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.listen(1)
+        self.address = self.sock.getsockname()
+        threading.Thread(target=self._serve, daemon=True).start()
+
+    def _serve(self):
+        cxn, _ = self.sock.accept()
+        iptr = NBDInterpreter(cxn)
+        for _ in iptr.get_client_options():
+            pass
+        iptr.send_export_response(2**20)
+        # the client hangs up on replies it doesn't like
+        with contextlib.suppress(OSError):
+            for req in iptr.get_transmission_requests():
+                if req.kind == MagicValues.RequestKindClose:
+                    break
+                if self.answer is not None and \
+                        len(self.requests) >= self.answer:
+                    break
+                self.requests.append(req)
+                data = None
+                if req.kind == MagicValues.RequestKindRead:
+                    data = b'\x00' * req.length
+                iptr.send_transmission_response(
+                    self.reply_handle or req.handle, data)
+        cxn.close()
+        self.sock.close()
+
+
+class TestReplaySession(unittest.TestCase):
+    def run_session(self, server, requests, max_in_flight=4):
+        session = ReplaySession(server.address, b'vol', requests, 0.,
+                                max_in_flight)
+        session.sock.settimeout(5)
+        errors = []
+
+        def run():
+            try:
+                session.run(0.)
+            except Exception as e:
+                errors.append(e)
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        thread.join(5)
+        self.assertFalse(thread.is_alive(), "replay never finished")
+        return session, errors
+
+    def test_replays_every_request(self):
+        server = FakeServer()
+        requests = [write_request(0.), read_request(0.), write_request(0.)]
+        session, errors = self.run_session(server, requests)
+        self.assertEqual([], errors)
+        self.assertEqual(requests, [req for req, _, _ in session.results])
+        self.assertEqual(3, len(server.requests))
+
+    def test_server_closes_early(self):
+        server = FakeServer(answer=2)
+        requests = [write_request(0.) for _ in range(10)]
+        session, errors = self.run_session(server, requests)
+        self.assertEqual(1, len(errors))
+        # the sender can see the server go first, and a reset connection
+        # may drop replies still in flight
+        self.assertIsInstance(errors[0], OSError)
+        self.assertLessEqual(len(session.results), 2)
+
+    def test_server_closes_while_sender_waits(self):
+        # with one request in flight the sender is stuck waiting on the
+        # reply to the one the server dropped
+        server = FakeServer(answer=1)
+        requests = [write_request(0.) for _ in range(5)]
+        session, errors = self.run_session(server, requests, max_in_flight=1)
+        self.assertEqual(1, len(errors))
+        self.assertIsInstance(errors[0], ConnectionError)
+        self.assertEqual(1, len(session.results))
+
+    def test_reply_for_unknown_handle(self):
+        server = FakeServer(reply_handle=b'\xff' * 8)
+        session, errors = self.run_session(server, [read_request(0.)])
+        self.assertEqual(1, len(errors))
+        self.assertIsInstance(errors[0], ValueError)
+
+    def test_replay_raises_session_errors(self):
+        server = FakeServer(answer=0)
+        with mock.patch.object(
+                replay, 'load_sessions',
+                return_value={0: (b'vol', [write_request(0.)])}):
+            with self.assertRaises(ConnectionError):
+                replay.replay("unused", server.address, speed=0.)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,251 @@
+import hashlib
+import json
+import logging
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import zlib
+
+from nbd.qos import TokenBucket
+
+DEFAULT_SCRUB_INTERVAL = 3600.  # seconds between passes
+DEFAULT_SCRUB_BYTES_PER_S = 16 * 2**20  # 16MiB/s of extents hashed
+SCRUB_FANOUT = 16  # child ranges compared per round trip
+SCRUB_LEAF_EXTENTS = 64  # ranges this small compare extent by extent
+SCRUB_PORT = 8080
+SCRUB_TIMEOUT = 10.  # seconds
+
+
+class ExtentChecksums(object):
+    """
+    CRC32 of each extent of the block file, computed the first time it's
+    asked for and dropped whenever a write lands on the extent
+
+    Every method expects the caller to already hold the backing file lock.
+    """
+    def __init__(self, f, extent_size):
+        self._f = f
+        self.extent_size = extent_size
+        self._crcs = {}
+        # bytes read to compute checksums so the scrubber can pace itself
+        self.bytes_hashed = 0
+
+    def invalidate(self, offset, length):
+        first = offset // self.extent_size
+        last = (offset + max(length, 1) - 1) // self.extent_size
+        for extent in range(first, last + 1):
+            self._crcs.pop(extent, None)
+
+    def crc(self, extent, refresh=False):
+        crc = None if refresh else self._crcs.get(extent)
+        if crc is None:
+            crc = self._crcs[extent] = zlib.crc32(self.read(extent))
+            self.bytes_hashed += self.extent_size
+        return crc
+
+    def read(self, extent):
+        # the file only extends as far as the furthest write
+        self._f.seek(extent * self.extent_size)
+        return self._f.read(self.extent_size).ljust(self.extent_size, b'\x00')
+
+
+def range_hashes(digests, start, end, parts):
+    """
+    Split [start, end) into `parts` ranges and hash the (generation, crc)
+    digests of the extents in each
+    """
+    bounds = [start + (end - start) * i // parts for i in range(parts + 1)]
+    hashes = [hashlib.sha1() for _ in range(parts)]
+    part = 0
+    for extent in sorted(digests):
+        while extent >= bounds[part + 1]:
+            part += 1
+        generation, crc = digests[extent]
+        hashes[part].update("{}:{}:{};".format(extent, generation,
+                                               crc).encode("utf-8"))
+    return bounds, [h.hexdigest() for h in hashes]
+
+
+class Scrubber(object):
+    """
+    Periodically compares this replica's extents with its peers' and pulls
+    over any that have diverged
+
+    Extents are compared by (generation, crc) where the generation counts
+    the writes the Raft log has applied to the extent, so two replicas only
+    disagree about an extent if they've applied the same writes and still
+    ended up with different data. Ranges are compared by hash, splitting
+    the ones that differ until they're small enough to compare extent by
+    extent, so a pass over replicas that agree is a handful of requests.
+    Each replica only ever repairs itself, and only towards the data a
+    majority of the replicas hold.
+    """
+    def __init__(self,
+                 blocks,
+                 checksums,
+                 peers,
+                 interval=DEFAULT_SCRUB_INTERVAL,
+                 bytes_per_s=DEFAULT_SCRUB_BYTES_PER_S,
+                 port=SCRUB_PORT):
+        self.blocks = blocks
+        self.checksums = checksums
+        self.peers = peers
+        self.interval = interval
+        self.port = port
+        self._bucket = TokenBucket(bytes_per_s)
+        self._lock = threading.Lock()
+        self.passes = 0
+        self.repaired = 0
+        self.unresolved = 0
+        self.last_pass_at = None
+
+    def start(self):
+        threading.Thread(target=self._scrub_loop, daemon=True).start()
+
+    def status(self):
+        with self._lock:
+            return {
+                "passes": self.passes,
+                "repaired": self.repaired,
+                "unresolved": self.unresolved,
+                "last_pass_at": self.last_pass_at,
+            }
+
+    def hashes(self, start, end, parts):
+        """
+        Hashes of our digests over `parts` slices of [start, end) for a
+        peer to compare its own against
+        """
+        _, hashes = range_hashes(self.blocks.extent_digests(start, end),
+                                 start, end, parts)
+        return hashes
+
+    def _scrub_loop(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.scrub()
+            except Exception:
+                logging.exception("Scrub pass failed")
+
+    def scrub(self):
+        span = self.blocks.extent_span()
+        # re-read everything at our own pace, which catches the disk changing
+        # under us and means comparing ranges only has to hash what's been
+        # written since
+        for start in range(0, span, SCRUB_LEAF_EXTENTS):
+            self._digests(start,
+                          min(start + SCRUB_LEAF_EXTENTS, span),
+                          refresh=True)
+        for peer in self.peers:
+            try:
+                self._compare(peer, 0, span)
+            except OSError as e:
+                logging.warning("Couldn't scrub against {}: {}".format(
+                    peer, e))
+        with self._lock:
+            self.passes += 1
+            self.last_pass_at = time.time()
+
+    def _compare(self, peer, start, end):
+        if end - start <= SCRUB_LEAF_EXTENTS:
+            self._compare_extents(peer, start, end)
+            return
+        parts = min(SCRUB_FANOUT, end - start)
+        bounds, local = range_hashes(self._digests(start, end), start, end,
+                                     parts)
+        remote = self._fetch(peer, "hashes", start=start, end=end,
+                             parts=parts)["hashes"]
+        for i in range(parts):
+            if local[i] != remote[i]:
+                self._compare(peer, bounds[i], bounds[i + 1])
+
+    def _compare_extents(self, peer, start, end):
+        local = self._digests(start, end)
+        remote = self._remote_digests(peer, start, end)
+        for extent, (generation, crc) in sorted(local.items()):
+            digest = remote.get(extent)
+            # a different generation means one of us is still applying
+            # writes to the extent so leave it for the next pass
+            if digest is None or digest[0] != generation or digest[1] == crc:
+                continue
+            self._repair(extent, generation, crc)
+
+    def _repair(self, extent, generation, crc):
+        # poll every replica so we only move towards what most of them hold
+        holders = {crc: [None]}
+        for peer in self.peers:
+            try:
+                digest = self._remote_digests(peer, extent,
+                                              extent + 1).get(extent)
+            except OSError:
+                continue
+            if digest is not None and digest[0] == generation:
+                holders.setdefault(digest[1], []).append(peer)
+        most = max(len(nodes) for nodes in holders.values())
+        leaders = [c for c, nodes in holders.items() if len(nodes) == most]
+        if len(leaders) > 1:
+            logging.error(
+                "Extent {} at generation {} has diverged with no majority".
+                format(extent, generation))
+            with self._lock:
+                self.unresolved += 1
+            return
+        majority = leaders[0]
+        if majority == crc:
+            # we're in the majority so it's up to the others to repair
+            return
+        for peer in holders[majority]:
+            try:
+                data = self._fetch_extent(peer, extent, generation)
+            except OSError:
+                continue
+            if data is None or zlib.crc32(data) != majority:
+                continue
+            self._throttle(len(data))
+            if self.blocks.repair_extent(extent, generation, data):
+                logging.warning(
+                    "Repaired extent {} at generation {} from {}".format(
+                        extent, generation, peer))
+                with self._lock:
+                    self.repaired += 1
+            return
+
+    def _digests(self, start, end, refresh=False):
+        hashed = self.checksums.bytes_hashed
+        digests = self.blocks.extent_digests(start, end, refresh=refresh)
+        self._throttle(self.checksums.bytes_hashed - hashed)
+        return digests
+
+    def _throttle(self, n):
+        delay = self._bucket.take(n)
+        if delay:
+            time.sleep(delay)
+
+    def _remote_digests(self, peer, start, end):
+        digests = self._fetch(peer, "digests", start=start, end=end)
+        return {int(k): tuple(v) for k, v in digests.items()}
+
+    def _fetch(self, peer, path, **params):
+        url = "http://{}:{}/scrub/{}?{}".format(peer, self.port, path,
+                                                urllib.parse.urlencode(params))
+        with urllib.request.urlopen(url, timeout=SCRUB_TIMEOUT) as resp:
+            return json.loads(resp.read())
+
+    def _fetch_extent(self, peer, extent, generation):
+        url = "http://{}:{}/scrub/extent?{}".format(
+            peer, self.port,
+            urllib.parse.urlencode({
+                "extent": extent,
+                "generation": generation
+            }))
+        try:
+            with urllib.request.urlopen(url, timeout=SCRUB_TIMEOUT) as resp:
+                return resp.read()
+        except urllib.error.HTTPError as e:
+            if e.code == 409:
+                # the peer has moved on from that generation
+                return None
+            raise
@@ -0,0 +1,228 @@
+import io
+import json
+import unittest
+import zlib
+from unittest import mock
+
+from nbd import scrub
+from nbd.repl_test import EXTENT, LocalStateTest
+from nbd.scrub import ExtentChecksums, Scrubber, range_hashes
+from nbd.state import LocalState
+
+
+class FakePeer(object):
+    """
+    Another replica's extents as extent -> (generation, data)
+    """
+    def __init__(self, extents):
+        self.extents = dict(extents)
+        self.digest_requests = []
+        self.on_extent_data = None
+
+    def extent_digests(self, start, end, refresh=False):
+        self.digest_requests.append((start, end))
+        return {
+            extent: (generation, zlib.crc32(data))
+            for extent, (generation, data) in self.extents.items()
+            if start <= extent < end
+        }
+
+    def extent_data(self, extent, generation):
+        if self.on_extent_data:
+            self.on_extent_data()
+        if self.extents.get(extent, (None, ))[0] != generation:
+            return None
+        return self.extents[extent][1]
+
+
+class LocalScrubber(Scrubber):
+    """
+    Scrubber that asks FakePeers what the HTTP endpoints would
+    """
+    def _fetch(self, peer, path, **params):
+        peer = self.peers[peer]
+        if path == "hashes":
+            _, hashes = range_hashes(
+                peer.extent_digests(params["start"], params["end"]),
+                params["start"], params["end"], params["parts"])
+            return {"hashes": hashes}
+        # keys come back as strings like they do over JSON
+        return json.loads(
+            json.dumps(peer.extent_digests(params["start"], params["end"])))
+
+    def _fetch_extent(self, peer, extent, generation):
+        return self.peers[peer].extent_data(extent, generation)
+
+
+class TestExtentChecksums(unittest.TestCase):
+    def setUp(self):
+        self.f = io.BytesIO(b'a' * EXTENT + b'b' * 4)
+        self.checksums = ExtentChecksums(self.f, EXTENT)
+
+    def test_crc_is_cached_until_invalidated(self):
+        self.assertEqual(zlib.crc32(b'a' * EXTENT), self.checksums.crc(0))
+        self.f.seek(0)
+        self.f.write(b'c')
+        self.assertEqual(zlib.crc32(b'a' * EXTENT), self.checksums.crc(0))
+        self.assertEqual(EXTENT, self.checksums.bytes_hashed)
+        self.checksums.invalidate(0, 1)
+        self.assertEqual(zlib.crc32(b'c' + b'a' * (EXTENT - 1)),
+                         self.checksums.crc(0))
+        self.assertEqual(2 * EXTENT, self.checksums.bytes_hashed)
+
+    def test_refresh_rereads(self):
+        self.checksums.crc(0)
+        self.f.seek(0)
+        self.f.write(b'c')
+        self.assertEqual(zlib.crc32(b'c' + b'a' * (EXTENT - 1)),
+                         self.checksums.crc(0, refresh=True))
+
+    def test_invalidate_covers_every_extent_touched(self):
+        for extent in range(3):
+            self.checksums.crc(extent)
+        self.checksums.invalidate(EXTENT - 1, 2)
+        self.assertEqual([2], list(self.checksums._crcs))
+
+    def test_short_extents_read_as_zero_padded(self):
+        self.assertEqual(b'b' * 4 + b'\x00' * (EXTENT - 4),
+                         self.checksums.read(1))
+        self.assertEqual(b'\x00' * EXTENT, self.checksums.read(5))
+
+
+class TestRangeHashes(unittest.TestCase):
+    def digests(self, extents):
+        return {extent: (1, extent * 7) for extent in extents}
+
+    def test_bounds(self):
+        bounds, hashes = range_hashes({}, 10, 20, 4)
+        self.assertEqual([10, 12, 15, 17, 20], bounds)
+        self.assertEqual(1, len(set(hashes)))
+
+    def test_only_the_differing_part_changes(self):
+        ours = self.digests(range(0, 64, 3))
+        theirs = dict(ours)
+        theirs[33] = (1, 0)
+        bounds, local = range_hashes(ours, 0, 64, 8)
+        _, remote = range_hashes(theirs, 0, 64, 8)
+        differing = [i for i in range(8) if local[i] != remote[i]]
+        self.assertEqual([4], differing)
+        self.assertEqual((32, 40), (bounds[4], bounds[5]))
+
+    def test_generation_counts(self):
+        ours = self.digests([5])
+        _, local = range_hashes(ours, 0, 8, 1)
+        _, remote = range_hashes({5: (2, ours[5][1])}, 0, 8, 1)
+        self.assertNotEqual(local, remote)
+
+
+class TestScrubber(LocalStateTest):
+    def write_extent(self, extent, data):
+        self.write(extent * EXTENT, data)
+
+    def corrupt(self, extent, data):
+        # behind the log's back, as a bad disk would
+        self.f.seek(extent * EXTENT)
+        self.f.write(data)
+
+    def local(self, extent):
+        return LocalState.checksums.read(extent)
+
+    def scrubber(self, peers):
+        return LocalScrubber(self.blocks,
+                             LocalState.checksums,
+                             peers,
+                             bytes_per_s=2**30)
+
+    def test_repairs_from_majority(self):
+        good = b'g' * EXTENT
+        self.write_extent(0, good)
+        self.write_extent(1, good)
+        self.corrupt(1, b'b' * EXTENT)
+        scrubber = self.scrubber({
+            'p1': FakePeer({0: (1, good), 1: (1, good)}),
+            'p2': FakePeer({0: (1, good), 1: (1, good)}),
+        })
+        scrubber.scrub()
+        self.assertEqual(good, self.local(1))
+        self.assertEqual(1, scrubber.repaired)
+        self.assertEqual(0, scrubber.unresolved)
+
+    def test_leaves_majority_copy_alone(self):
+        good = b'g' * EXTENT
+        self.write_extent(0, good)
+        scrubber = self.scrubber({
+            'p1': FakePeer({0: (1, b'b' * EXTENT)}),
+            'p2': FakePeer({0: (1, good)}),
+        })
+        scrubber.scrub()
+        self.assertEqual(good, self.local(0))
+        self.assertEqual(0, scrubber.repaired)
+
+    def test_skips_extents_at_other_generations(self):
+        self.write_extent(0, b'a' * EXTENT)
+        scrubber = self.scrubber({
+            'p1': FakePeer({0: (2, b'b' * EXTENT)}),
+            'p2': FakePeer({0: (2, b'b' * EXTENT)}),
+        })
+        scrubber.scrub()
+        self.assertEqual(b'a' * EXTENT, self.local(0))
+        self.assertEqual(0, scrubber.repaired)
+        self.assertEqual(0, scrubber.unresolved)
+
+    def test_tie_is_left_alone(self):
+        self.write_extent(0, b'a' * EXTENT)
+        scrubber = self.scrubber({'p1': FakePeer({0: (1, b'b' * EXTENT)})})
+        with self.assertLogs(level='ERROR'):
+            scrubber.scrub()
+        self.assertEqual(b'a' * EXTENT, self.local(0))
+        self.assertEqual(0, scrubber.repaired)
+        self.assertEqual(1, scrubber.unresolved)
+
+    def test_no_majority_is_left_alone(self):
+        self.write_extent(0, b'a' * EXTENT)
+        scrubber = self.scrubber({
+            'p1': FakePeer({0: (1, b'b' * EXTENT)}),
+            'p2': FakePeer({0: (1, b'c' * EXTENT)}),
+        })
+        with self.assertLogs(level='ERROR'):
+            scrubber.scrub()
+        self.assertEqual(b'a' * EXTENT, self.local(0))
+        self.assertEqual(0, scrubber.repaired)
+        # once when compared against each peer
+        self.assertEqual(2, scrubber.unresolved)
+
+    def test_write_during_repair_is_not_overwritten(self):
+        good = b'g' * EXTENT
+        self.write_extent(0, good)
+        self.corrupt(0, b'b' * EXTENT)
+        p1 = FakePeer({0: (1, good)})
+        p2 = FakePeer({0: (1, good)})
+        # the log applies a write between the compare and the repair
+        p1.on_extent_data = lambda: self.write_extent(0, b'n' * EXTENT)
+        scrubber = self.scrubber({'p1': p1, 'p2': p2})
+        scrubber.scrub()
+        self.assertEqual(b'n' * EXTENT, self.local(0))
+        self.assertEqual(0, scrubber.repaired)
+
+    def test_narrows_to_differing_extent(self):
+        good = b'g' * EXTENT
+        extents = {extent: (1, good) for extent in range(64)}
+        for extent in extents:
+            self.write_extent(extent, good)
+        self.corrupt(37, b'b' * EXTENT)
+        p1 = FakePeer(extents)
+        p2 = FakePeer(extents)
+        scrubber = self.scrubber({'p1': p1, 'p2': p2})
+        with mock.patch.object(scrub, 'SCRUB_LEAF_EXTENTS', 4), \
+                mock.patch.object(scrub, 'SCRUB_FANOUT', 4):
+            scrubber.scrub()
+        self.assertEqual(good, self.local(37))
+        self.assertEqual(1, scrubber.repaired)
+        # hashed down 64 -> 16 -> 4 and only then compared extent by extent
+        leaves = [(start, end) for start, end in p1.digest_requests
+                  if end - start <= 4]
+        self.assertEqual([(36, 40), (37, 38)], leaves)
+
+
+if __name__ == '__main__':
+    unittest.main()
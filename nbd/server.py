@@ -1,5 +1,9 @@
 #! /usr/local/bin/python3
 
+import contextlib
+import errno
+import functools
+import json
 import logging
 import os
 import random
@@ -7,21 +11,26 @@ import socket
 import _thread
 import threading
 import time
-import uuid
+import urllib.parse
 
-import jaeger_client
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
-from http.server import BaseHTTPRequestHandler, HTTPServer
+from nbd.iptr import NBDInterpreter, MagicValues
+from nbd.qos import QoS, DEFAULT_STORE_CONCURRENCY, \
+    DEFAULT_REPLICATION_CONCURRENCY
+from nbd.state import LocalState, DEFAULT_DEVICE_SIZE, DEFAULT_EXTENT_SIZE
+from nbd.trace import TraceRecorder
 
-from nbd.iptr import NBDInterpreter, MagicValues, next_n_bytes
-from pysyncobj import SyncObj, SyncObjConsumer
-from pysyncobj.batteries import ReplCounter, ReplList
-from pysyncobj.config import SyncObjConf
-from pysyncobj.syncobj import AsyncResult, replicated
+# NOTE pysyncobj, jaeger_client and the scrubber are only imported once we
+# know they're needed so that a restarting node is listening again quickly
 
-DEFAULT_BLOCK_SIZE = 512  # bytes
-DEFAULT_BLOCK_COUNT = (2**20)  # 512MiB
-DEFAULT_DEVICE_SIZE = DEFAULT_BLOCK_SIZE * DEFAULT_BLOCK_COUNT
+LISTEN_BACKLOG = 128  # connections held by the kernel while we start up
+RAFT_STATUS_INTERVAL = 1.  # seconds between cached Raft status refreshes
+DEFAULT_MAX_COMMIT_LAG = 1000  # log entries behind the leader's commit index
+DEFAULT_MAX_APPLY_LAG = 1000  # committed log entries not yet applied
+DEFAULT_DEEP_CHECK_INTERVAL = 10.  # seconds
+DEEP_CHECK_TIMEOUT = 5.  # seconds
+FLUSH_TIMEOUT = 30.  # seconds to wait for a volume's writes to be applied
 
 
 def handle_cxn(cxn, blocks, volumes, tracer):
@@ -37,40 +46,79 @@ def handle_cxn(cxn, blocks, volumes, tracer):
 
     if volume not in volumes:
         # NOTE some short-cuts here for simple implementation
-        # * race condition if creating the same volume twice
-        # * volumes may sync faster than blocks causing index error
         # * volume lookup is O(n) but could be O(log(n))
         if isinstance(volumes, list):
             volumes.append(volume)
             blocks.extend([b'\x00'] * DEFAULT_DEVICE_SIZE)
         else:
-            volumes.append(volume, sync=True)
-            volix = volumes.index(volume)
-            blocks.write_zeros(volix * DEFAULT_DEVICE_SIZE,
-                               DEFAULT_DEVICE_SIZE)
-            # blocks.extend_zeros(DEFAULT_DEVICE_SIZE, sync=True)
-
-    voloffset = DEFAULT_DEVICE_SIZE * volumes.index(volume)
-    iptr.send_export_response(DEFAULT_DEVICE_SIZE)
+            # creation is idempotent in the catalog so racing creators are
+            # harmless and unwritten extents read as zeros without having
+            # to write them out first
+            volumes.create(volume, sync=True)
+
+    read_only = volumes.is_read_only(volume)
+    state = get_volume_state(volume)
+    qos = LocalState.qos
+    if LocalState.trace:
+        iptr.trace = LocalState.trace.session(volume)
+    iptr.send_export_response(DEFAULT_DEVICE_SIZE,
+                              read_only=read_only,
+                              multi_conn=True)
     logging.info("Entering transmission phase")
     for req in iptr.get_transmission_requests():
         if req.kind == MagicValues.RequestKindRead:
             logging.info("Reading bytes {} - {} of {}".format(
                 req.offset, req.offset + req.length, volume.decode("utf-8")))
-            start = voloffset + req.offset
-            data = blocks.read(req.offset, req.length)
-            # data = b"".join(blocks[start:start + req.length])
+            qos.throttle(volume, req.length)
+            # writes are acked before they're applied so make sure any
+            # acked on this or another connection show up
+            if not state.wait_for_range(
+                    req.offset, req.length, timeout=FLUSH_TIMEOUT):
+                iptr.send_transmission_response(req.handle, error=errno.EIO)
+                continue
+            with qos.store.slot(volume, req.length, qos.weight(volume)):
+                data = read_volume(blocks, volumes, volume, req.offset,
+                                   req.length)
             iptr.send_transmission_response(req.handle, data)
         elif req.kind == MagicValues.RequestKindWrite:
             logging.info("Writing bytes {} - {} of {}".format(
                 req.offset, req.offset + req.length, volume.decode("utf-8")))
-            start = voloffset + req.offset
-            with tracer.start_span('write-all-replicas'):
-                blocks.lead_write(start, req.data)
-            # blocks[start:start + req.length] = [
-            #     b.to_bytes(byteorder="big", length=1) for b in req.data
-            # ]
+            if read_only:
+                iptr.send_transmission_response(req.handle,
+                                                error=errno.EPERM)
+                continue
+            qos.throttle(volume, req.length)
+            # the replication slot is held until the write is applied so a
+            # busy volume can't fill the log ahead of everyone else's writes
+            qos.replication.acquire(volume, req.length, qos.weight(volume))
+            on_applied = release_after(qos.replication.release,
+                                       state.start_write(req.offset,
+                                                         req.length))
+            try:
+                with tracer.start_span('write-all-replicas'):
+                    blocks.lead_write(req.offset,
+                                      req.data,
+                                      volume=volume,
+                                      callback=on_applied)
+            except Exception as e:
+                logging.exception("Failed to write bytes {} - {} of {}".format(
+                    req.offset, req.offset + req.length,
+                    volume.decode("utf-8")))
+                # the callback will never run so release the slot and clear
+                # the write ourselves or the volume, and everyone queued
+                # behind it for replication, would wait on them forever
+                on_applied(None, e)
+                iptr.send_transmission_response(req.handle, error=errno.EIO)
+                continue
             iptr.send_transmission_response(req.handle)
+        elif req.kind == MagicValues.RequestKindFlush:
+            logging.info("Flushing {}".format(volume.decode("utf-8")))
+            error = 0
+            if not state.flush(timeout=FLUSH_TIMEOUT):
+                error = errno.EIO
+            elif not isinstance(blocks, list):
+                blocks.flush()
+            iptr.send_transmission_response(req.handle, error=error)
         elif req.kind == MagicValues.RequestKindClose:
             cxn.shutdown(socket.SHUT_RDWR)
             cxn.close
@@ -79,53 +127,253 @@ def handle_cxn(cxn, blocks, volumes, tracer):
             raise ValueError("Unknown request type: {}".format(req.kind))
 
 
-class ReplBlocks(ReplList):
-    @replicated
-    def setslicesubset(self, i, j, sequence):
-        self.rawData()[i:j] = sequence
-
-    @replicated
-    def extend_zeros(self, count):
-        self.rawData().extend([b'\x00'] * count)
-
-    # Break up the write, otherwise it may pickle beyond the size of one packet
-    # and PySyncObj isn't set up for that
-    def setslice(self, i, j, sequence):
-        size = 2**12
-        asyncs = []
-        offset = i
-        while offset < j:
-            end = min(offset + size, j)
-            asc = AsyncResult()
-            self.setslicesubset(offset,
-                                end,
-                                sequence[offset - i:end - i],
-                                callback=asc.onResult)
-            asyncs.append(asc)
-            offset += size
-
-        for asc in asyncs:
-            asc.event.wait(None)
-
-    def __setitem__(self, k, v):
-        if isinstance(k, slice):
-            self.setslice(k.start, k.stop, v)
+def release_after(release, callback):
+    def on_result(res, err):
+        release()
+        callback(res, err)
+
+    return on_result
+
+
+def read_volume(blocks, volumes, volume, offset, length):
+    parts = []
+    for start, seglen in volumes.resolve(volume, offset, length):
+        if start is None:
+            parts.append(b'\x00' * seglen)
         else:
-            super()[k] = v
+            # slots that have never been written past may lie beyond the
+            # end of the block file
+            parts.append(
+                blocks.read(start, seglen, stream=volume).ljust(
+                    seglen, b'\x00'))
+    return b''.join(parts)
+
+
+class RaftStatusCache(object):
+    """
+    Snapshot of SyncObj.getStatus() refreshed in the background so that
+    readiness probes never touch Raft themselves
+    """
+    def __init__(self, sync_obj, interval=RAFT_STATUS_INTERVAL):
+        self._sync_obj = sync_obj
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._status = None
+        self._updated_at = None
+
+    def start(self):
+        _thread.start_new_thread(self._refresh_loop, ())
+
+    def get(self):
+        """
+        The latest status and how many seconds old it is
+        """
+        with self._lock:
+            if self._status is None:
+                return None, None
+            return self._status, time.monotonic() - self._updated_at
+
+    def _refresh_loop(self):
+        while True:
+            self.refresh()
+            time.sleep(self.interval)
+
+    def refresh(self):
+        try:
+            status = self._sync_obj.getStatus()
+        except Exception:
+            # the status is read racily from outside the Raft thread so just
+            # try again next time
+            logging.exception("Failed to read Raft status")
+        else:
+            with self._lock:
+                self._status = status
+                self._updated_at = time.monotonic()
+
+    def readiness_problems(self, max_commit_lag, max_apply_lag):
+        status, age_s = self.get()
+        if status is None:
+            return ["no Raft status yet"]
+        problems = []
+        if age_s > 3 * self.interval:
+            problems.append("Raft status is {:.1f}s old".format(age_s))
+        if status['leader'] is None:
+            problems.append("no known leader")
+        if not status['has_quorum']:
+            problems.append("no quorum")
+        leader_commit = status['leader_commit_idx']
+        if leader_commit is not None and \
+                leader_commit - status['commit_idx'] > max_commit_lag:
+            problems.append("commit index {} behind leader's {}".format(
+                status['commit_idx'], leader_commit))
+        if status['commit_idx'] - status['last_applied'] > max_apply_lag:
+            problems.append("applied {} of {} committed entries".format(
+                status['last_applied'], status['commit_idx']))
+        return problems
+
+
+class DeepCheck(object):
+    """
+    Round trip a write through the Raft log at most once per interval,
+    handing the last result to any probes in between
+    """
+    def __init__(self,
+                 counter,
+                 interval=DEFAULT_DEEP_CHECK_INTERVAL,
+                 timeout=DEEP_CHECK_TIMEOUT):
+        self._counter = counter
+        self._interval = interval
+        self._timeout = timeout
+        self._lock = threading.Lock()
+        self._checked_at = None
+        self._error = None
+
+    def check(self):
+        """
+        None if the last write went through, otherwise what went wrong
+        """
+        # concurrent probes wait on the one in progress and share its result
+        with self._lock:
+            now = time.monotonic()
+            if self._checked_at is None or \
+                    now - self._checked_at >= self._interval:
+                try:
+                    self._counter.add(random.choice([1, -1]),
+                                      sync=True,
+                                      timeout=self._timeout)
+                    self._error = None
+                except Exception as e:
+                    self._error = "Error writing to distributed log: {}".format(
+                        repr(e))
+                self._checked_at = time.monotonic()
+            return self._error
 
 
 class HealthHandler(BaseHTTPRequestHandler):
-    counter = None
+    catalog = None
+    # set in clustered mode -- without them the node is trivially ready
+    raft_status = None
+    deep_check = None
+    scrubber = None
+    # cleared once the node has finished starting up and serves NBD
+    starting = True
+    max_commit_lag = DEFAULT_MAX_COMMIT_LAG
+    max_apply_lag = DEFAULT_MAX_APPLY_LAG
 
     def do_GET(s):
-        if not HealthHandler.counter:
-            s.send_response(200)
+        # GET / or /health/live: the process is up and serving HTTP
+        # GET /health/ready: the node has started up, has a leader and is
+        #   keeping up with the log, going by cached Raft status
+        # GET /health/deep: a write makes it through the log, rate limited
+        # GET /scrub/...: extent digests compared by peers' scrubbers
+        path = s.path.split("?")[0].rstrip("/")
+        if path.startswith("/scrub/") and HealthHandler.scrubber:
+            s._scrub(path[len("/scrub/"):])
+        elif path in ("", "/health/live"):
+            s._respond(200, "OK")
+        elif path == "/health/ready":
+            problems = []
+            if HealthHandler.starting:
+                problems = ["starting up"]
+            elif HealthHandler.raft_status:
+                problems = HealthHandler.raft_status.readiness_problems(
+                    HealthHandler.max_commit_lag, HealthHandler.max_apply_lag)
+            if problems:
+                s._respond(503, "; ".join(problems))
+            else:
+                s._respond(200, "OK")
+        elif path == "/health/deep":
+            error = None
+            if HealthHandler.deep_check:
+                error = HealthHandler.deep_check.check()
+            if error:
+                s._respond(500, error)
+            else:
+                s._respond(200, "OK")
+        else:
+            s._respond(404, "Not found")
+
+    def _scrub(s, path):
+        # GET /scrub/status
+        # GET /scrub/hashes?start=&end=&parts=: digest hashes of sub-ranges
+        # GET /scrub/digests?start=&end=: (generation, crc) of each extent
+        # GET /scrub/extent?extent=&generation=: an extent's data, or 409
+        #   if it's been written since
+        scrubber = HealthHandler.scrubber
+        query = urllib.parse.parse_qs(urllib.parse.urlparse(s.path).query)
+        try:
+            params = {key: int(values[0]) for key, values in query.items()}
+        except ValueError:
+            s._respond(400, "Expected integer parameters")
+            return
+        if path in ("hashes", "digests") and \
+                not {"start", "end"} <= params.keys():
+            s._respond(400, "Expected start and end")
+        elif path == "status":
+            s._respond(200, json.dumps(scrubber.status()))
+        elif path == "hashes":
+            start, end = params["start"], params["end"]
+            hashes = scrubber.hashes(start, end, params.get("parts", 1))
+            s._respond(200, json.dumps({"hashes": hashes}))
+        elif path == "digests":
+            digests = scrubber.blocks.extent_digests(params["start"],
+                                                     params["end"])
+            s._respond(200, json.dumps(digests))
+        elif path == "extent":
+            data = None
+            if {"extent", "generation"} <= params.keys():
+                data = scrubber.blocks.extent_data(params["extent"],
+                                                   params["generation"])
+            if data is None:
+                s._respond(409, "Extent has been written since")
+            else:
+                s._respond(200, data)
+        else:
+            s._respond(404, "Not found")
+
+    def _respond(s, code, body):
+        s.send_response(code)
+        s.end_headers()
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        s.wfile.write(body)
+
+    def log_message(s, format, *args):
+        # probes arrive every few seconds from every checker
+        logging.debug("Health: " + format, *args)
+
+    def do_POST(s):
+        # POST /volumes/<volume>/snapshots/<name> or
+        # POST /volumes/<volume>/clones/<name> or
+        # POST /volumes/<volume>/qos with a JSON body of limits
+        # POST /volumes/<volume>/layout with a JSON body of the layout a
+        #   balancer would give the volume, answered with the one it has
+        parts = s.path.strip("/").split("/")
+        if (HealthHandler.catalog and len(parts) == 3
+                and parts[0] == "volumes" and parts[2] == "qos"):
+            s._set_qos(parts[1].encode("utf-8"))
+            return
+        if (HealthHandler.catalog and len(parts) == 3
+                and parts[0] == "volumes" and parts[2] == "layout"):
+            # balancers quote names as they may be any bytes at all
+            s._claim_layout(urllib.parse.unquote_to_bytes(parts[1]))
+            return
+        if (not HealthHandler.catalog or len(parts) != 4
+                or parts[0] != "volumes"
+                or parts[2] not in ("snapshots", "clones")):
+            s.send_response(404)
+            s.end_headers()
+            return
+        volume, name = parts[1].encode("utf-8"), parts[3].encode("utf-8")
+        if volume not in HealthHandler.catalog or name in HealthHandler.catalog:
+            s.send_response(409)
             s.end_headers()
-            s.wfile.write(b"OK")
             return
-        inc_value = random.choice([1, -1])
         try:
-            HealthHandler.counter.add(inc_value)
+            if parts[2] == "snapshots":
+                HealthHandler.catalog.snapshot(volume, name, sync=True)
+            else:
+                HealthHandler.catalog.clone(volume, name, sync=True)
             s.send_response(200)
             s.end_headers()
             s.wfile.write(b"OK")
@@ -134,122 +382,223 @@ class HealthHandler(BaseHTTPRequestHandler):
             s.end_headers()
             s.wfile.write(b"Error writing to distributed log")
 
+    def _set_qos(s, volume):
+        # e.g. {"iops": 500, "bps": 10485760, "weight": 2} -- a null or
+        # missing limit falls back to the node's default
+        if volume not in HealthHandler.catalog:
+            s._respond(404, "Not found")
+            return
+        try:
+            length = int(s.headers.get("Content-Length", 0))
+            limits = json.loads(s.rfile.read(length) or b"{}")
+            limits = {
+                key: None if limits.get(key) is None else float(limits[key])
+                for key in ("iops", "bps", "weight")
+            }
+        except (TypeError, ValueError):
+            s._respond(400, "Expected a JSON object of iops, bps and weight")
+            return
+        if any(value is not None and value <= 0 for value in limits.values()):
+            s._respond(400, "Limits must be positive")
+            return
+        try:
+            HealthHandler.catalog.set_qos(volume, limits, sync=True)
+        except:
+            s._respond(500, "Error writing to distributed log")
+            return
+        s._respond(200, "OK")
 
-class LoglessCache(object):
-    def __init__(self, capacity=100):
-        self._roundrobin = [b''] * capacity
-        self._uuid2write = {}
-        self._lock = threading.Lock()
-        self._ix = 0
-
-    def set(self, newuuid, val):
-        with self._lock:
-            curuuid = self._roundrobin[self._ix]
-            if curuuid in self._uuid2write:
-                del self._uuid2write[curuuid]
-            self._roundrobin[self._ix] = newuuid
-            self._uuid2write[newuuid] = val
-            self._ix = (self._ix + 1) % len(self._roundrobin)
-
-    def get(self, write_uuid):
-        with self._lock:
-            return self._uuid2write.get(write_uuid, b'')
-
-
-class WriteSharer(object):
-    def __init__(self, peers, cache):
-        self.peers = peers
-        self.locks = {peer: threading.Lock() for peer in self.peers}
-        self.cache = cache
-        self.clients = {}
-
-    def listen_for_asks(self):
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.bind(("0.0.0.0", 2002))
-        sock.setblocking(True)
-        sock.listen(1)
-        while True:
-            cxn, _client = sock.accept()
-            _thread.start_new_thread(self._handle_asks, (cxn, ))
 
-    def _handle_asks(self, cxn):
-        while True:
-            write_uuid_len = int.from_bytes(next_n_bytes(cxn, 4),
-                                            byteorder="big")
-            write_uuid = next_n_bytes(cxn, write_uuid_len)
-            write = self.cache.get(write_uuid)
-            cxn.sendall(len(write).to_bytes(byteorder="big", length=4))
-            cxn.sendall(write)
-
-    def get_write(self, write_uuid, check_first):
-        peers = list(self.peers)
-        if check_first in peers:
-            peers.remove(check_first)
-            peers.insert(0, check_first)
-        write = self.cache.get(write_uuid)
-        if write != b'':
-            return write
-        for peer in peers:
-            with self.locks[peer]:
-                client = self.clients.get(peer)
-                if client is None:
-                    client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                    client.connect((peer, 2002))
-                    self.clients[peer] = client
-                client.sendall(
-                    len(write_uuid).to_bytes(byteorder="big", length=4))
-                client.sendall(write_uuid)
-                write_len = int.from_bytes(next_n_bytes(client, 4),
-                                           byteorder="big")
-                if write_len != 0:
-                    return next_n_bytes(client, write_len)
-        raise ValueError("Write not found", write_uuid)
-
-
-class LocalState(object):
-    f = None
-    write_sharer = None
-    lock = None
-    hostname = None
-    write_count = None
-
-
-class ReplFile(SyncObjConsumer):
-    @replicated
-    def write(self, originator, offset, write_uuid):
+    def _claim_layout(s, volume):
+        # null for a volume living wholly on one shard or e.g.
+        # {"stripe_size": 65536, "shards": 3} -- the volume needn't have been
+        # created yet as balancers settle its layout before connecting
         try:
-            write = LocalState.write_sharer.get_write(write_uuid, originator)
-            with LocalState.lock:
-                logging.info("Writing {} to offset {}".format(
-                    write_uuid, offset))
-                LocalState.f.seek(offset)
-                LocalState.f.write(write)
-        except ValueError:
-            logging.error(
-                "Failed to write {} to offset {} -- block not found among peers"
-                .format(write_uuid, offset))
-
-    @replicated
-    def write_zeros(self, offset, length):
-        with LocalState.lock:
-            LocalState.f.seek(offset)
-            LocalState.f.write(b'\x00' * length)
-
-    def read(self, offset, length):
-        with LocalState.lock:
-            LocalState.f.seek(offset)
-            return LocalState.f.read(length)
-
-    def lead_write(self, offset, data):
-        sync = False
-        with LocalState.lock:
-            LocalState.write_count += 1
-            if LocalState.write_count >= 20:
-                LocalState.write_count = 0
-                sync = True
-        write_uuid = uuid.uuid1().bytes
-        LocalState.write_sharer.cache.set(write_uuid, data)
-        self.write(LocalState.hostname, offset, write_uuid, sync=sync)
+            length = int(s.headers.get("Content-Length", 0))
+            layout = json.loads(s.rfile.read(length) or b"null")
+        except (TypeError, ValueError):
+            s._respond(400, "Expected a JSON layout")
+            return
+        if layout is not None and not (isinstance(layout, dict) and {
+                "stripe_size", "shards"
+        } == layout.keys()):
+            s._respond(400, "Expected null or stripe_size and shards")
+            return
+        try:
+            layout = HealthHandler.catalog.claim_layout(volume,
+                                                        layout,
+                                                        sync=True)
+        except:
+            s._respond(500, "Error writing to distributed log")
+            return
+        s._respond(200, json.dumps(layout))
+
+
+class VolumeState(object):
+    """
+    Writes to a volume that have been acked but not yet applied locally,
+    shared by every connection to the volume so that reads and flushes on
+    one connection account for writes acked on another
+    """
+    def __init__(self):
+        self._cv = threading.Condition()
+        self._pending = {}  # write id -> (offset, length)
+        self._next_id = 0
+        self._failed = False
+
+    def start_write(self, offset, length):
+        """
+        Register a write and return the callback to run once it's applied
+        """
+        with self._cv:
+            write_id = self._next_id
+            self._next_id += 1
+            self._pending[write_id] = (offset, length)
+        return functools.partial(self._finish_write, write_id)
+
+    def _finish_write(self, write_id, result, error):
+        with self._cv:
+            del self._pending[write_id]
+            if error:
+                self._failed = True
+            self._cv.notify_all()
+
+    def wait_for_range(self, offset, length, timeout=None):
+        """
+        Wait for acked writes overlapping the range to be applied, returning
+        False if that takes longer than timeout
+        """
+        with self._cv:
+            return self._cv.wait_for(
+                lambda: not self._overlaps_pending(offset, length), timeout)
+
+    def _overlaps_pending(self, offset, length):
+        for start, pending_length in self._pending.values():
+            if start < offset + length and offset < start + pending_length:
+                return True
+        return False
+
+    def flush(self, timeout=None):
+        """
+        Wait for every acked write to be applied, returning False if that
+        takes longer than timeout or any of them failed since the last flush
+        """
+        with self._cv:
+            if not self._cv.wait_for(lambda: not self._pending, timeout):
+                return False
+            failed, self._failed = self._failed, False
+        return not failed
+
+
+def get_volume_state(volume):
+    with LocalState.volume_states_lock:
+        state = LocalState.volume_states.get(volume)
+        if state is None:
+            state = LocalState.volume_states[volume] = VolumeState()
+        return state
+
+
+class DeferredTracer(object):
+    """
+    Jaeger tracer that's set up in the background rather than on the way to
+    serving -- spans are no-ops until it's ready, or for good if tracing
+    isn't configured
+    """
+    def __init__(self):
+        self._tracer = None
+
+    def start(self):
+        _thread.start_new_thread(self._initialize, ())
+
+    def _initialize(self):
+        try:
+            import jaeger_client
+            self._tracer = jaeger_client.Config(
+                config={
+                    'sampler': {
+                        'type': 'const',
+                        'param': 1,
+                    },
+                    'logging': True,
+                },
+                service_name='nbd',
+            ).initialize_tracer()
+        except Exception:
+            logging.exception("Failed to set up tracing -- carrying on without")
+
+    def start_span(self, operation_name):
+        tracer = self._tracer
+        if tracer is None:
+            return contextlib.nullcontext()
+        return tracer.start_span(operation_name)
+
+
+def start_cluster(peers, hostname):
+    """
+    Set up this node's replicas of the block file and volume catalog and
+    return them
+    """
+    from nbd.cache import PageCache, DEFAULT_CACHE_BYTES, \
+        DEFAULT_READAHEAD_BYTES
+    from nbd.repl import LoglessCache, ReplFile, VolumeCatalog, WriteSharer
+    from nbd.scrub import ExtentChecksums, Scrubber, \
+        DEFAULT_SCRUB_INTERVAL, DEFAULT_SCRUB_BYTES_PER_S
+    from pysyncobj import SyncObj
+    from pysyncobj.batteries import ReplCounter
+
+    LocalState.f = open('/tmp/blocks', 'r+b')
+    write_cache = LoglessCache()
+    LocalState.write_sharer = WriteSharer(peers, write_cache)
+    _thread.start_new_thread(LocalState.write_sharer.listen_for_asks, ())
+    LocalState.lock = threading.Lock()
+    LocalState.hostname = hostname
+    LocalState.write_count = 0
+    cache_bytes = int(os.environ.get("NBDD_CACHE_BYTES", DEFAULT_CACHE_BYTES))
+    if cache_bytes > 0:
+        LocalState.cache = PageCache(
+            LocalState.f,
+            LocalState.lock,
+            budget=cache_bytes,
+            readahead=int(
+                os.environ.get("NBDD_READAHEAD_BYTES",
+                               DEFAULT_READAHEAD_BYTES)),
+        )
+    LocalState.checksums = ExtentChecksums(LocalState.f, DEFAULT_EXTENT_SIZE)
+    blocks = ReplFile()
+    volumes = VolumeCatalog()
+    LocalState.catalog = volumes
+    LocalState.qos.catalog = volumes
+    HealthHandler.catalog = volumes
+    health_counter = ReplCounter()
+    HealthHandler.deep_check = DeepCheck(
+        health_counter,
+        interval=float(
+            os.environ.get("NBDD_DEEP_CHECK_INTERVAL",
+                           DEFAULT_DEEP_CHECK_INTERVAL)))
+    HealthHandler.max_commit_lag = int(
+        os.environ.get("NBDD_READY_MAX_COMMIT_LAG", DEFAULT_MAX_COMMIT_LAG))
+    HealthHandler.max_apply_lag = int(
+        os.environ.get("NBDD_READY_MAX_APPLY_LAG", DEFAULT_MAX_APPLY_LAG))
+    self_address = "{}:2001".format(hostname)
+    peer_addresses = ["{}:2001".format(peer) for peer in peers]
+    syncObj = SyncObj(self_address,
+                      peer_addresses,
+                      consumers=[blocks, volumes, health_counter])
+    HealthHandler.raft_status = RaftStatusCache(syncObj)
+    HealthHandler.raft_status.start()
+    HealthHandler.scrubber = Scrubber(
+        blocks,
+        LocalState.checksums,
+        peers,
+        interval=float(
+            os.environ.get("NBDD_SCRUB_INTERVAL", DEFAULT_SCRUB_INTERVAL)),
+        bytes_per_s=float(
+            os.environ.get("NBDD_SCRUB_BYTES_PER_S",
+                           DEFAULT_SCRUB_BYTES_PER_S)))
+    # peers still serve digests when our own passes are turned off
+    if HealthHandler.scrubber.interval > 0:
+        HealthHandler.scrubber.start()
+    return blocks, volumes
 
 
 def main():
@@ -258,6 +607,18 @@ def main():
                         filename='/proc/self/fd/2',
                         filemode='w')
 
+    # listen before doing anything else so a restart doesn't leave the port
+    # dark -- clients that connect while we start up wait in the backlog
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(('0.0.0.0', 2000))
+    sock.setblocking(True)
+    sock.listen(LISTEN_BACKLOG)
+
+    # threaded so a slow deep check can't hold up other probes
+    httpd = ThreadingHTTPServer(('0.0.0.0', 8080), HealthHandler)
+    _thread.start_new_thread(httpd.serve_forever, ())
+
     peers = None if "NBDD_PEERS" not in os.environ else os.environ[
         "NBDD_PEERS"].split(",")
     hostname = os.environ.get("NBDD_HOSTNAME")
@@ -267,42 +628,39 @@ def main():
     # (all devices are fixed size)
     volumes = []
 
-    tracer = jaeger_client.Config(
-        config={
-            'sampler': {
-                'type': 'const',
-                'param': 1,
-            },
-            'logging': True,
-        },
-        service_name='nbd',
-    ).initialize_tracer()
+    tracer = DeferredTracer()
+    # compose points every node at its Jaeger agent
+    if os.environ.get("JAEGER_AGENT_HOST") or \
+            os.environ.get("NBDD_TRACING", "") not in ("", "0"):
+        tracer.start()
+
+    qos_defaults = {}
+    for key in ("iops", "bps", "weight"):
+        value = os.environ.get("NBDD_QOS_" + key.upper())
+        if value:
+            qos_defaults[key] = float(value)
+    LocalState.qos = QoS(
+        qos_defaults,
+        store_concurrency=int(
+            os.environ.get("NBDD_QOS_STORE_CONCURRENCY",
+                           DEFAULT_STORE_CONCURRENCY)),
+        replication_concurrency=int(
+            os.environ.get("NBDD_QOS_REPLICATION_CONCURRENCY",
+                           DEFAULT_REPLICATION_CONCURRENCY)),
+    )
+
+    trace_path = os.environ.get("NBDD_TRACE_PATH")
+    if trace_path:
+        max_bytes = os.environ.get("NBDD_TRACE_MAX_BYTES")
+        LocalState.trace = TraceRecorder(
+            trace_path,
+            payloads=os.environ.get("NBDD_TRACE_PAYLOADS", "") not in ("",
+                                                                       "0"),
+            max_bytes=int(max_bytes) if max_bytes else None)
 
     if peers:
-        LocalState.f = open('/tmp/blocks', 'r+b')
-        write_cache = LoglessCache()
-        LocalState.write_sharer = WriteSharer(peers, write_cache)
-        _thread.start_new_thread(LocalState.write_sharer.listen_for_asks, ())
-        LocalState.lock = threading.Lock()
-        LocalState.hostname = hostname
-        LocalState.write_count = 0
-        blocks = ReplFile()
-        volumes = ReplList()
-        health_counter = ReplCounter()
-        HealthHandler.counter = health_counter
-        self_address = "{}:2001".format(hostname)
-        peer_addresses = ["{}:2001".format(peer) for peer in peers]
-        syncObj = SyncObj(self_address,
-                          peer_addresses,
-                          consumers=[blocks, volumes, health_counter])
-
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    sock.bind(('0.0.0.0', 2000))
-    sock.setblocking(True)
-    sock.listen(1)
-
-    httpd = HTTPServer(('0.0.0.0', 8080), HealthHandler)
-    _thread.start_new_thread(httpd.serve_forever, ())
+        blocks, volumes = start_cluster(peers, hostname)
+    HealthHandler.starting = False
 
     # Prototype will listen to one client at a time
     # -- can be made concurrent without much extra work
@@ -0,0 +1,283 @@
+import contextlib
+import errno
+import socket
+import threading
+import types
+import unittest
+from unittest import mock
+
+from nbd import server
+from nbd.iptr import NBDInterpreter, MagicValues
+from nbd.qos import QoS
+from nbd.state import LocalState
+
+VOLUME = b'vol'
+
+
+class FakeCatalog(object):
+    """
+    Every volume maps straight onto the block file
+    """
+    def __init__(self):
+        self.volumes = set()
+
+    def __contains__(self, volume):
+        return volume in self.volumes
+
+    def create(self, volume, sync=False):
+        self.volumes.add(volume)
+
+    def is_read_only(self, volume):
+        return False
+
+    def resolve(self, volume, offset, length):
+        return [(offset, length)]
+
+
+class FakeBlocks(object):
+    """
+    Block file whose writes are applied when the test says so, or that
+    fails them outright with `error`
+    """
+    def __init__(self, size=2**16):
+        self.data = bytearray(size)
+        self.error = None
+        self.unapplied = []
+
+    def lead_write(self, offset, data, volume=None, callback=None):
+        if self.error is not None:
+            raise self.error
+        self.unapplied.append((offset, data, callback))
+
+    def apply(self):
+        for offset, data, callback in self.unapplied:
+            self.data[offset:offset + len(data)] = data
+            callback(None, None)
+        self.unapplied = []
+
+    def read(self, offset, length, stream=None):
+        return bytes(self.data[offset:offset + length])
+
+    def flush(self):
+        pass
+
+
+class FakeTracer(object):
+    def start_span(self, name):
+        return contextlib.nullcontext()
+
+
+class TestHandleCxn(unittest.TestCase):
+    def setUp(self):
+        patches = [
+            mock.patch.object(LocalState, 'volume_states', {}),
+            # a single replication slot so one that leaks stalls every write
+            mock.patch.object(LocalState, 'qos',
+                              QoS(replication_concurrency=1)),
+            mock.patch.object(LocalState, 'trace', None),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.blocks = FakeBlocks()
+        client, cxn = socket.socketpair()
+        client.settimeout(5)
+        self.addCleanup(client.close)
+        threading.Thread(target=server.handle_cxn,
+                         args=(cxn, self.blocks, FakeCatalog(), FakeTracer()),
+                         daemon=True).start()
+        self.iptr = NBDInterpreter(client, client=True)
+        self.iptr.start_session(VOLUME)
+        self.iptr.get_export_response()
+        self.handles = 0
+
+    def request(self, kind, offset=0, length=0, data=None):
+        self.handles += 1
+        handle = self.handles.to_bytes(byteorder="big", length=8)
+        self.iptr.send_transmission_request(kind, handle, offset, length,
+                                            data)
+        return handle
+
+    def response(self, length=0):
+        return self.iptr.get_transmission_response(lambda handle: length)
+
+    def write(self, offset, data):
+        self.request(MagicValues.RequestKindWrite, offset, len(data), data)
+        return self.response()
+
+    def read(self, offset, length):
+        self.request(MagicValues.RequestKindRead, offset, length)
+        return self.response(length)
+
+    def flush(self):
+        self.request(MagicValues.RequestKindFlush)
+        return self.response()
+
+    def test_read_waits_for_acked_write(self):
+        self.assertEqual(0, self.write(0, b'hello').error)
+        self.request(MagicValues.RequestKindRead, 0, 5)
+        threading.Timer(.05, self.blocks.apply).start()
+        resp = self.response(5)
+        self.assertEqual(0, resp.error)
+        self.assertEqual(b'hello', resp.data)
+
+    def test_read_of_other_range_does_not_wait(self):
+        self.write(0, b'hello')
+        resp = self.read(100, 5)
+        self.assertEqual(0, resp.error)
+        self.assertEqual(b'\x00' * 5, resp.data)
+
+    def test_read_times_out_with_eio(self):
+        with mock.patch.object(server, 'FLUSH_TIMEOUT', .05):
+            self.write(0, b'hello')
+            self.assertEqual(errno.EIO, self.read(0, 5).error)
+            self.assertEqual(errno.EIO, self.flush().error)
+
+    def test_failed_write_is_not_left_pending(self):
+        self.blocks.error = RuntimeError("lost leadership")
+        self.assertEqual(errno.EIO, self.write(0, b'hello').error)
+        self.assertEqual(b'\x00' * 5, self.read(0, 5).data)
+        self.assertEqual({}, LocalState.volume_states[VOLUME]._pending)
+        self.blocks.error = None
+        self.write(0, b'again')
+        self.blocks.apply()
+        self.assertEqual(b'again', self.read(0, 5).data)
+
+    def test_failed_write_releases_replication_slot(self):
+        self.blocks.error = RuntimeError("lost leadership")
+        for _ in range(3):
+            self.assertEqual(errno.EIO, self.write(0, b'hello').error)
+        self.blocks.error = None
+        self.assertEqual(0, self.write(0, b'hello').error)
+        replication = LocalState.qos.replication
+        self.assertEqual(0, replication._free)
+        self.blocks.apply()
+        self.assertEqual(1, replication._free)
+
+
+class FakeSyncObj(object):
+    def __init__(self):
+        self.status = {
+            'leader': 'node-0',
+            'has_quorum': True,
+            'leader_commit_idx': 100,
+            'commit_idx': 100,
+            'last_applied': 100,
+        }
+        self.error = None
+
+    def getStatus(self):
+        if self.error is not None:
+            raise self.error
+        return dict(self.status)
+
+
+class FakeCounter(object):
+    def __init__(self):
+        self.adds = 0
+        self.error = None
+
+    def add(self, value, sync=False, timeout=None):
+        self.adds += 1
+        if self.error is not None:
+            raise self.error
+
+
+class FakeClockTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 0.
+        patch = mock.patch.object(
+            server, 'time',
+            types.SimpleNamespace(monotonic=lambda: self.now))
+        patch.start()
+        self.addCleanup(patch.stop)
+
+
+class TestRaftStatusCache(FakeClockTest):
+    def setUp(self):
+        super().setUp()
+        self.sync_obj = FakeSyncObj()
+        self.cache = server.RaftStatusCache(self.sync_obj, interval=1.)
+
+    def problems(self):
+        return self.cache.readiness_problems(max_commit_lag=10,
+                                             max_apply_lag=10)
+
+    def test_no_status_yet(self):
+        self.assertEqual((None, None), self.cache.get())
+        self.assertEqual(["no Raft status yet"], self.problems())
+
+    def test_healthy(self):
+        self.cache.refresh()
+        self.now = 1.5
+        self.assertEqual(1.5, self.cache.get()[1])
+        self.assertEqual([], self.problems())
+
+    def test_stale_status(self):
+        self.cache.refresh()
+        self.now = 3.5
+        self.assertEqual(["Raft status is 3.5s old"], self.problems())
+        # a failed refresh keeps the old snapshot
+        self.sync_obj.error = RuntimeError("racy read")
+        with self.assertLogs(level='ERROR'):
+            self.cache.refresh()
+        self.assertEqual(3.5, self.cache.get()[1])
+        self.sync_obj.error = None
+        self.cache.refresh()
+        self.assertEqual([], self.problems())
+
+    def test_no_leader(self):
+        self.sync_obj.status.update(leader=None, leader_commit_idx=None)
+        self.cache.refresh()
+        self.assertEqual(["no known leader"], self.problems())
+
+    def test_no_quorum(self):
+        self.sync_obj.status['has_quorum'] = False
+        self.cache.refresh()
+        self.assertEqual(["no quorum"], self.problems())
+
+    def test_commit_lag(self):
+        self.sync_obj.status.update(commit_idx=89, last_applied=89)
+        self.cache.refresh()
+        self.assertEqual(["commit index 89 behind leader's 100"],
+                         self.problems())
+        self.sync_obj.status.update(commit_idx=90, last_applied=90)
+        self.cache.refresh()
+        self.assertEqual([], self.problems())
+
+    def test_apply_lag(self):
+        self.sync_obj.status['last_applied'] = 89
+        self.cache.refresh()
+        self.assertEqual(["applied 89 of 100 committed entries"],
+                         self.problems())
+
+
+class TestDeepCheck(FakeClockTest):
+    def setUp(self):
+        super().setUp()
+        self.counter = FakeCounter()
+        self.check = server.DeepCheck(self.counter, interval=10.)
+
+    def test_checks_at_most_once_per_interval(self):
+        self.assertIsNone(self.check.check())
+        self.now = 9.9
+        self.assertIsNone(self.check.check())
+        self.assertEqual(1, self.counter.adds)
+        self.now = 10.
+        self.check.check()
+        self.assertEqual(2, self.counter.adds)
+
+    def test_failure_is_shared_until_next_check(self):
+        self.counter.error = RuntimeError("no quorum")
+        error = self.check.check()
+        self.assertIn("no quorum", error)
+        self.counter.error = None
+        self.now = 5.
+        self.assertEqual(error, self.check.check())
+        self.now = 10.
+        self.assertIsNone(self.check.check())
+        self.assertEqual(2, self.counter.adds)
+
+
+if __name__ == '__main__':
+    unittest.main()
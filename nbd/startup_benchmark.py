@@ -0,0 +1,147 @@
+import argparse
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+from nbd.iptr import MagicValues, next_n_bytes
+
+POLL_INTERVAL = .002  # seconds
+DEFAULT_TIMEOUT = 30.  # seconds
+
+
+def _wait_for(check, deadline):
+    while time.monotonic() < deadline:
+        if check():
+            return time.monotonic()
+        time.sleep(POLL_INTERVAL)
+    return None
+
+
+def _connect(address):
+    try:
+        return socket.create_connection(address, timeout=POLL_INTERVAL * 10)
+    except OSError:
+        return None
+
+
+def _ready(url):
+    try:
+        with urllib.request.urlopen(url, timeout=1) as resp:
+            return resp.status == 200
+    except (urllib.error.URLError, OSError):
+        return False
+
+
+def time_import(module, env):
+    """
+    Seconds to import the module in a fresh interpreter
+    """
+    out = subprocess.check_output([
+        sys.executable, "-c",
+        "import time; t = time.perf_counter(); import {}; "
+        "print(time.perf_counter() - t)".format(module)
+    ],
+                                  env=env)
+    return float(out)
+
+
+def time_startup(command, env, host, port, health_port, timeout):
+    """
+    Seconds from spawning the server until it accepts connections, sends
+    the NBD handshake and reports ready -- None for any it didn't reach
+    """
+    started_at = time.monotonic()
+    deadline = started_at + timeout
+    proc = subprocess.Popen(command,
+                            env=env,
+                            stdout=subprocess.DEVNULL,
+                            stderr=subprocess.DEVNULL)
+    try:
+        sock = None
+
+        def connected():
+            nonlocal sock
+            sock = _connect((host, port))
+            return sock is not None
+
+        listening_at = _wait_for(connected, deadline)
+        serving_at = None
+        if sock is not None:
+            with sock:
+                sock.settimeout(max(deadline - time.monotonic(), 0))
+                try:
+                    magic = next_n_bytes(sock,
+                                         len(MagicValues.HandshakeMagic))
+                except socket.timeout:
+                    magic = None
+                if magic == MagicValues.HandshakeMagic:
+                    serving_at = time.monotonic()
+        url = "http://{}:{}/health/ready".format(host, health_port)
+        ready_at = _wait_for(lambda: _ready(url), deadline)
+    finally:
+        proc.kill()
+        proc.wait()
+    return [
+        None if at is None else at - started_at
+        for at in (listening_at, serving_at, ready_at)
+    ]
+
+
+def _summary(values):
+    reached = [value for value in values if value is not None]
+    if not reached:
+        return "never"
+    return "{:.0f} ms [{:.0f}, {:.0f}] ({}/{})".format(
+        statistics.median(reached) * 1e3,
+        min(reached) * 1e3,
+        max(reached) * 1e3, len(reached), len(values))
+
+
+def _parse_env(s):
+    name, _, value = s.partition("=")
+    return name, value
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Time how long the NBD server takes to come back up")
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=2000)
+    parser.add_argument("--health-port", type=int, default=8080)
+    parser.add_argument("--timeout", type=float, default=DEFAULT_TIMEOUT)
+    parser.add_argument("--env",
+                        type=_parse_env,
+                        action="append",
+                        default=[],
+                        help="NAME=VALUE to set for the server")
+    parser.add_argument("command",
+                        nargs="*",
+                        default=[sys.executable, "-m", "nbd.server"],
+                        help="server command (default: this python -m "
+                        "nbd.server)")
+    args = parser.parse_args()
+    env = dict(os.environ)
+    env.update(args.env)
+
+    imports = [time_import("nbd.server", env) for _ in range(args.runs)]
+    results = [
+        time_startup(args.command, env, args.host, args.port,
+                     args.health_port, args.timeout) for _ in range(args.runs)
+    ]
+    print("| stage | median [min, max] |")
+    print("|---|---|")
+    print("| import nbd.server | {} |".format(_summary(imports)))
+    for i, stage in enumerate(("listening", "serving NBD", "ready")):
+        print("| {} | {} |".format(stage,
+                                   _summary([result[i]
+                                             for result in results])))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,22 @@
+import threading
+
+DEFAULT_BLOCK_SIZE = 512  # bytes
+DEFAULT_BLOCK_COUNT = (2**20)  # 512MiB
+DEFAULT_DEVICE_SIZE = DEFAULT_BLOCK_SIZE * DEFAULT_BLOCK_COUNT
+DEFAULT_EXTENT_SIZE = 2**16  # 64KiB unit of copy-on-write
+
+
+class LocalState(object):
+    f = None
+    write_sharer = None
+    lock = None
+    hostname = None
+    write_count = None
+    cache = None
+    checksums = None
+    catalog = None
+    qos = None
+    trace = None
+    # volume name -> VolumeState for every volume connected to on this node
+    volume_states = {}
+    volume_states_lock = threading.Lock()
@@ -0,0 +1,152 @@
+import collections
+import logging
+import struct
+import threading
+import time
+
+TRACE_MAGIC = b"NBDTRACE"
+TRACE_VERSION = 1
+FLUSH_INTERVAL = 1.  # seconds between flushes of buffered records
+TRACE_BUFFER_BYTES = 2**20
+
+# file header: magic, version, whether payloads were kept, wall clock start
+_HEADER = struct.Struct("=8sH?d")
+# every record starts with its type and the session it belongs to
+_RECORD = struct.Struct("=BI")
+RECORD_SESSION = 1
+RECORD_REQUEST = 2
+# session record: length of the export name that follows
+_SESSION = struct.Struct("=H")
+# request record: seconds since the trace started, latency in seconds, kind,
+# offset, length, error, length of the payload that follows
+_REQUEST = struct.Struct("=ddHQIII")
+
+TraceSession = collections.namedtuple("TraceSession", ("session", "volume"))
+TraceRequest = collections.namedtuple(
+    "TraceRequest",
+    ("session", "start", "latency", "kind", "offset", "length", "error",
+     "data"),
+)
+
+
+class TraceRecorder(object):
+    """
+    Appends the requests seen by NBD connections to a binary trace file
+
+    Records are packed fixed-size structs written through a large buffer,
+    so recording a request costs a dict operation and a struct.pack.
+    Write payloads are only kept when asked for and recording stops once
+    the file reaches max_bytes.
+    """
+    def __init__(self, path, payloads=False, max_bytes=None):
+        self.payloads = payloads
+        self.max_bytes = max_bytes
+        self._f = open(path, "wb", buffering=TRACE_BUFFER_BYTES)
+        self._lock = threading.Lock()
+        self._started_at = time.monotonic()
+        self._next_session = 0
+        self._written = 0
+        self._full = False
+        self._write(
+            _HEADER.pack(TRACE_MAGIC, TRACE_VERSION, payloads, time.time()))
+        threading.Thread(target=self._flush_loop, daemon=True).start()
+
+    def session(self, volume):
+        with self._lock:
+            session = self._next_session
+            self._next_session += 1
+            self._write(
+                _RECORD.pack(RECORD_SESSION, session) +
+                _SESSION.pack(len(volume)) + volume)
+        return SessionRecorder(self, session)
+
+    def record(self, session, started_at, latency, req, error):
+        data = b''
+        if self.payloads and req.data:
+            data = req.data
+        record = _RECORD.pack(RECORD_REQUEST, session) + _REQUEST.pack(
+            started_at - self._started_at, latency,
+            int.from_bytes(req.kind, byteorder="big"), req.offset,
+            req.length, error, len(data))
+        with self._lock:
+            # in one go so a full trace can't end up with half a record
+            self._write(record + data)
+
+    def close(self):
+        with self._lock:
+            self._f.close()
+
+    def _write(self, data):
+        if self._full:
+            return
+        if self.max_bytes and self._written + len(data) > self.max_bytes:
+            logging.warning("Trace is full -- no longer recording requests")
+            self._full = True
+            return
+        self._f.write(data)
+        self._written += len(data)
+
+    def _flush_loop(self):
+        while not self._f.closed:
+            time.sleep(FLUSH_INTERVAL)
+            with self._lock:
+                if not self._f.closed:
+                    self._f.flush()
+
+
+class SessionRecorder(object):
+    """
+    Times the requests on one connection from when they're read to when
+    they're answered
+    """
+    def __init__(self, recorder, session):
+        self._recorder = recorder
+        self._session = session
+        self._lock = threading.Lock()
+        self._pending = {}  # handle -> (request, started at)
+
+    def start(self, req):
+        with self._lock:
+            self._pending[req.handle] = (req, time.monotonic())
+
+    def finish(self, handle, error):
+        with self._lock:
+            pending = self._pending.pop(handle, None)
+        if pending is None:
+            return
+        req, started_at = pending
+        self._recorder.record(self._session, started_at,
+                              time.monotonic() - started_at, req, error)
+
+
+def read_trace(path):
+    """
+    Yield a TraceSession or TraceRequest for each record in the trace
+    """
+    with open(path, "rb") as f:
+        magic, version, _, _ = _HEADER.unpack(f.read(_HEADER.size))
+        if magic != TRACE_MAGIC or version != TRACE_VERSION:
+            raise ValueError("Not a version {} NBD trace: {}".format(
+                TRACE_VERSION, path))
+        while True:
+            header = f.read(_RECORD.size)
+            if len(header) < _RECORD.size:
+                # a trace cut off mid-record by the server going away
+                break
+            kind, session = _RECORD.unpack(header)
+            if kind == RECORD_SESSION:
+                name_len, = _SESSION.unpack(f.read(_SESSION.size))
+                yield TraceSession(session, f.read(name_len))
+            elif kind == RECORD_REQUEST:
+                fields = f.read(_REQUEST.size)
+                if len(fields) < _REQUEST.size:
+                    break
+                start, latency, req_kind, offset, length, error, data_len = \
+                    _REQUEST.unpack(fields)
+                data = f.read(data_len) if data_len else None
+                yield TraceRequest(session, start, latency,
+                                   req_kind.to_bytes(byteorder="big",
+                                                     length=2), offset,
+                                   length, error, data)
+            else:
+                raise ValueError("Unknown trace record type: {}".format(kind))
@@ -1,26 +1,47 @@
+import argparse
+import collections
+import fcntl
 import hashlib
+import importlib
+import itertools
 import json
+import multiprocessing
+import multiprocessing.connection
 import os
 import random
-import sys
+import socket
 import threading
 import time
 
-import rcp
+import rcp_tabulate_results
+
+DEFAULT_STORE = "results.jsonl"
 
 
 class PacketCountingMiddleware(object):
-    def __init__(self, wrapped, n=2):
+    """
+    Counts what a router puts on the wire and drops each send with
+    probability `loss` like the tests' FaultySocket
+    """
+    def __init__(self, wrapped, loss=0., rng=None):
         self.wrapped = wrapped
+        self.loss = loss
+        self.rng = rng or random.Random()
         self.lock = threading.Lock()
         self.total_sends = 0
         self.total_recvs = 0
-        self.n = n
+        self.total_bytes_sent = 0
+        self.total_drops = 0
 
     def sendto(self, msg, address):
         with self.lock:
             self.total_sends += 1
-        return self.wrapped.sendto(msg, address)
+            self.total_bytes_sent += len(msg)
+            drop = self.loss > 0 and self.rng.random() < self.loss
+            if drop:
+                self.total_drops += 1
+        if not drop:
+            return self.wrapped.sendto(msg, address)
 
     def recvfrom(self, n):
         with self.lock:
@@ -34,62 +55,240 @@ class PacketCountingMiddleware(object):
         return self.wrapped.close()
 
 
-def _log_datum(location, datum, condition):
-    results = {}
-    if os.path.exists(location):
-        with open(location) as f:
-            results = json.load(f)
-    if condition not in results:
-        results[condition] = [datum]
-    else:
-        results[condition].append(datum)
-    with open(location, 'w') as f:
-        json.dump(results, f, indent=4)
+def _free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
 
 
-def main():
-    src_addr, src_port, dst_addr, dst_port, condition = sys.argv[1:]
-    router = rcp.RCPRouter((src_addr, int(src_port)))
-    router.sock = PacketCountingMiddleware(router.sock)
-    sock = router.connect((dst_addr, int(dst_port)))
+def run_once(condition):
+    """
+    Send condition["messages"] messages of condition["msg_size"] bytes from
+    one router to another over lossy loopback and return the run's metrics
+    """
+    module = importlib.import_module(condition["module"])
+    rng = random.Random(condition["seed"])
+    server_addr = ("127.0.0.1", _free_port())
+    client_addr = ("127.0.0.1", _free_port())
+    server = module.RCPRouter(server_addr, **condition["router_args"])
+    client = module.RCPRouter(client_addr, **condition["router_args"])
+    server.sock = PacketCountingMiddleware(server.sock, condition["loss"],
+                                           random.Random(rng.random()))
+    client.sock = PacketCountingMiddleware(client.sock, condition["loss"],
+                                           random.Random(rng.random()))
+    server.listen()
+    client_sock = client.connect(server_addr)
+    server_sock = server.accept()
 
-    time_start = time.time()
-    random.seed()
-    sent_hash = hashlib.sha256()
-    sent_len = 0
-    for i in range(1000):
-        to_send = random.randbytes(random.randrange(200, 400))
-        sent_hash.update(to_send)
-        sent_len += len(to_send)
-        sock.send(to_send)
-        time.sleep(random.randrange(2, 20) / 1000)
+    messages = [
+        rng.randbytes(condition["msg_size"])
+        for _ in range(condition["messages"])
+    ]
+    sent_hash = hashlib.sha256(b''.join(messages)).hexdigest()
+    sent_len = sum(len(msg) for msg in messages)
 
+    gap_ms = condition.get("send_gap_ms")
+    time_start = time.monotonic()
+    for msg in messages:
+        client_sock.send(msg)
+        if gap_ms:
+            time.sleep(rng.uniform(*gap_ms) / 1000)
     recv_hash = hashlib.sha256()
     recv_len = 0
-    while recv_len != sent_len:
-        msg = sock.recv()
+    while recv_len < sent_len:
+        msg = server_sock.recv()
+        if not msg:
+            break
         recv_hash.update(msg)
         recv_len += len(msg)
+    total_time_s = time.monotonic() - time_start
+
+    client_sock.close()
+    server.close()
+    client.close()
+
+    result = dict(condition)
+    result.update({
+        "ok": recv_hash.hexdigest() == sent_hash,
+        "seconds": total_time_s,
+        "payload_bytes": sent_len,
+        "packets_sent": server.sock.total_sends + client.sock.total_sends,
+        "packets_dropped": server.sock.total_drops + client.sock.total_drops,
+        "wire_bytes":
+        server.sock.total_bytes_sent + client.sock.total_bytes_sent,
+        "timestamp": time.time(),
+    })
+    return result
+
+
+def _run_in_child(condition, conn):
+    try:
+        conn.send(run_once(condition))
+    except Exception as e:
+        conn.send(dict(condition, ok=False, error=repr(e)))
+    finally:
+        conn.close()
+
+
+def run_all(conditions, jobs, timeout):
+    """
+    Yield the results of up to `jobs` concurrent runs as they finish
+
+    Each run gets a fresh process so a wedged transfer can be killed after
+    `timeout` seconds without leaking threads or sockets into the next one.
+    """
+    pending = collections.deque(conditions)
+    running = {}  # result pipe -> (process, condition, deadline)
+    while pending or running:
+        while pending and len(running) < jobs:
+            condition = pending.popleft()
+            reader, writer = multiprocessing.Pipe(duplex=False)
+            process = multiprocessing.Process(target=_run_in_child,
+                                              args=(condition, writer),
+                                              daemon=True)
+            process.start()
+            writer.close()
+            running[reader] = (process, condition, time.monotonic() + timeout)
+        wait_s = min(deadline for _, _, deadline in running.values()) - \
+            time.monotonic()
+        for reader in multiprocessing.connection.wait(list(running),
+                                                      max(wait_s, 0)):
+            process, condition, _ = running.pop(reader)
+            try:
+                result = reader.recv()
+            except EOFError:
+                result = None
+            reader.close()
+            process.join()
+            if result is None:
+                result = dict(condition,
+                              ok=False,
+                              error=f"exited with {process.exitcode}")
+            yield result
+        now = time.monotonic()
+        for reader, (process, condition, deadline) in list(running.items()):
+            if deadline <= now:
+                process.kill()
+                process.join()
+                reader.close()
+                del running[reader]
+                yield dict(condition, ok=False, error="timeout")
+
+
+def append_result(location, result):
+    """
+    Append one result to the JSON lines store -- the lock keeps concurrent
+    runners from interleaving partial lines
+    """
+    line = json.dumps(result, sort_keys=True) + "\n"
+    with open(location, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            f.write(line)
+            f.flush()
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _parse_list(cast):
+    return lambda s: [cast(v) for v in s.split(",")]
+
+
+def _parse_router_arg(s):
+    name, _, values = s.partition("=")
+    parsed = []
+    for value in values.split(","):
+        try:
+            parsed.append(json.loads(value))
+        except ValueError:
+            parsed.append(value)
+    return name, parsed
+
+
+def _conditions(args):
+    names = [name for name, _ in args.router_arg]
+    arg_values = itertools.product(*[values for _, values in args.router_arg])
+    for values, loss, msg_size in itertools.product(list(arg_values),
+                                                    args.loss, args.msg_size):
+        for run in range(args.runs):
+            yield {
+                "variant": args.variant or args.module,
+                "module": args.module,
+                "router_args": dict(zip(names, values)),
+                "loss": loss,
+                "msg_size": msg_size,
+                "messages": args.messages,
+                # None for back-to-back sends
+                "send_gap_ms": args.send_gap_ms,
+                "run": run,
+                "seed": random.getrandbits(64),
+            }
+
+
+def _load_router_module(parser, name):
+    try:
+        module = importlib.import_module(name)
+    except ImportError as e:
+        parser.error(f"can't import --module {name}: {e}")
+    if not hasattr(module, "RCPRouter"):
+        # e.g. rcp_lib, whose sessions run over raw sockets rather than a
+        # UDP router
+        parser.error(f"--module {name} has no RCPRouter to benchmark")
+    return module
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Sweep RCP transfers over lossy loopback in parallel")
+    parser.add_argument("--module",
+                        default="rcp",
+                        help="module providing RCPRouter")
+    parser.add_argument("--variant",
+                        help="label for the results (default: --module)")
+    parser.add_argument("--loss", type=_parse_list(float), default=[0, .1, .3])
+    parser.add_argument("--msg-size",
+                        type=_parse_list(int),
+                        default=[128, 512, 2048])
+    parser.add_argument(
+        "--router-arg",
+        type=_parse_router_arg,
+        action="append",
+        default=[],
+        help="NAME=V1,V2 keyword argument to sweep for RCPRouter, "
+        "e.g. window=16,32,64")
+    parser.add_argument("--messages", type=int, default=1000)
+    parser.add_argument(
+        "--send-gap-ms",
+        type=_parse_list(float),
+        help="LO,HI pause drawn uniformly between sends, e.g. 2,20 for the "
+        "paced workload of the old benchmark (default: back-to-back)")
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--jobs", type=int, default=os.cpu_count())
+    parser.add_argument("--timeout",
+                        type=float,
+                        default=120.,
+                        help="seconds before a run is recorded as failed")
+    parser.add_argument("--store", default=DEFAULT_STORE)
+    args = parser.parse_args()
+    if args.send_gap_ms is not None and len(args.send_gap_ms) != 2:
+        parser.error("--send-gap-ms takes LO,HI")
+    _load_router_module(parser, args.module)
+
+    random.seed()
+    conditions = list(_conditions(args))
+    # interleave conditions so drift in machine load doesn't favor any one
+    random.shuffle(conditions)
+    for i, result in enumerate(run_all(conditions, args.jobs, args.timeout)):
+        append_result(args.store, result)
+        print(f"[{i + 1}/{len(conditions)}] {result['variant']} "
+              f"loss={result['loss']} msg_size={result['msg_size']} "
+              f"{result['router_args']} ok={result['ok']}")
 
-    total_time_s = time.time() - time_start
-    sock.close()
-    router.close()
-
-    if recv_hash.hexdigest() == sent_hash.hexdigest():
-        print(
-            f"Sent and received {sent_len} bytes. Confirmed hashes match: {sent_hash.hexdigest()}"
-        )
-    else:
-        raise ValueError(
-            f"Hash mismatch between sent bytes and received bytes: {sent_hash.hexdigest()} != {recv_hash.hexdigest()}"
-        )
-    print(
-        f"Toatal packets sent: {router.sock.total_sends} -- Total packets received: {router.sock.total_recvs}"
-    )
-
-    # packets received isn't meaningful here since we don't know how many packets our peer sent
-    # so just log the packets sent
-    _log_datum("results.json", [router.sock.total_sends, total_time_s], condition)
+    rcp_tabulate_results.report(
+        [
+            result for result in rcp_tabulate_results.load(args.store)
+            if result["variant"] == (args.variant or args.module)
+        ])
 
 
 if __name__ == "__main__":
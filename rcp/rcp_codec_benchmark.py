@@ -0,0 +1,30 @@
+import sys
+import timeit
+
+import rcp_lib
+
+
+def _bench(name, stmt, number):
+    total_s = min(timeit.repeat(stmt, number=number, repeat=5))
+    print(f"{name:<24} {total_s / number * 1e9:8.0f} ns/op")
+
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    syn = rcp_lib.RCPPacket(rcp_lib.RCPPacketType.SYN, 42, 0, b'x' * 256)
+    ack = rcp_lib.RCPPacket(rcp_lib.RCPPacketType.ACK, 42, 0xdeadbeef, b'')
+    syn_bytes = syn.to_bytes()
+    ack_bytes = ack.to_bytes()
+
+    _bench("encode syn", syn.to_bytes, number)
+    _bench("decode syn",
+           lambda: rcp_lib.RCPPacket.from_bytes(syn_bytes), number)
+    _bench("encode ack", ack.to_bytes, number)
+    _bench("decode ack",
+           lambda: rcp_lib.RCPPacket.from_bytes(ack_bytes), number)
+    _bench("scan ack window",
+           lambda: [ack.acked(i) for i in range(32)], number)
+
+
+if __name__ == "__main__":
+    main()
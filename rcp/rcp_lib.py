@@ -1,41 +1,205 @@
+import collections
+import ctypes
+import ctypes.util
 import enum
+import errno
+import functools
+import heapq
+import json
+import logging
+import math
+import mmap
+import os
 import random
+import select
+import selectors
 import socket
+import struct
 import sys
 import threading
 import time
 
 ETH_P_ALL = 3
+SO_ATTACH_FILTER = 26
+# classic BPF opcodes from linux/filter.h
+BPF_LD = 0x00
+BPF_W = 0x00
+BPF_ABS = 0x20
+BPF_JMP = 0x05
+BPF_JEQ = 0x10
+BPF_K = 0x00
+BPF_RET = 0x06
+# PACKET_MMAP from linux/if_packet.h
+SOL_PACKET = 263
+PACKET_RX_RING = 5
+PACKET_STATISTICS = 6
+PACKET_VERSION = 10
+PACKET_TX_RING = 13
+TPACKET_V3 = 2
+TP_STATUS_KERNEL = 0
+TP_STATUS_USER = 1
+TP_STATUS_AVAILABLE = 0
+TP_STATUS_SEND_REQUEST = 1
+TP_STATUS_WRONG_FORMAT = 4
+MAX_PACKET_SIZE = 65535
+DEFAULT_MTU = 1500
+IP_HEADER_SIZE = 8
+SHARED_SOCKET_BUFFER_SIZE = 2**23
+
+logger = logging.getLogger(__name__)
+
+
+class LinkModel(object):
+    """
+    Loss and latency applied to every packet the Router forwards
+    """
+    def __init__(self, loss=0., latency=0., jitter=0.):
+        self.loss = loss
+        self.latency = latency  # seconds
+        self.jitter = jitter  # seconds either side of latency
+        self._random = random.Random()
+
+    def drop(self):
+        return self.loss > 0 and self._random.random() < self.loss
+
+    def delay(self):
+        if not self.jitter:
+            return self.latency
+        return max(
+            self.latency + self._random.uniform(-self.jitter, self.jitter), 0)
+
+
+class RoutingTable(object):
+    """
+    Longest-prefix-match table from IPv4 addresses to interfaces
+
+    Rules are keyed by CIDR blocks like "192.168.1.0/24" or bare addresses
+    and lookups take the destination address as a 32 bit integer.
+    """
+    def __init__(self, rules=None):
+        # prefix length -> network address as an int -> interface
+        self._prefixes = {}
+        self._lengths = []
+        for cidr, iface in (rules or {}).items():
+            self.add(cidr, iface)
+
+    def add(self, cidr, iface):
+        addr, _, length = cidr.partition("/")
+        length = int(length) if length else 32
+        mask = (0xffffffff << (32 - length)) & 0xffffffff
+        network = struct.unpack(">I", socket.inet_aton(addr))[0] & mask
+        self._prefixes.setdefault(length, {})[network] = iface
+        self._lengths = sorted(self._prefixes, reverse=True)
+
+    def lookup(self, addr):
+        for length in self._lengths:
+            mask = (0xffffffff << (32 - length)) & 0xffffffff
+            iface = self._prefixes[length].get(addr & mask)
+            if iface is not None:
+                return iface
+        return None
 
 
 class Router(object):
-    def __init__(self, ifaces, route_rules):
+    def __init__(self, ifaces, route_rules, link_model=None, use_ring=False):
         self.ifaces = ifaces
-        self.route_rules = route_rules
+        self.routes = RoutingTable(route_rules)
+        self.link_model = link_model or LinkModel()
+        self.use_ring = use_ring
         self.iface2sock = {}
+        self.iface2ring = {}
+        self._delayed = []  # heap of (due, seq, iface, packet)
+        self._delayed_cv = threading.Condition()
+        self._delayed_seq = 0
 
     def start_routing(self):
         for iface in self.ifaces:
             sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW,
                                  socket.htons(ETH_P_ALL))
+            sock.bind((iface, 0))
             self.iface2sock[iface] = sock
-            thread = threading.Thread(target=lambda: self._listen_from(iface))
+            if self.use_ring:
+                ring = open_packet_ring(sock, dev_mtu(iface))
+                if ring is not None:
+                    self.iface2ring[iface] = ring
+        for iface in self.ifaces:
+            listen = self._listen_ring \
+                if iface in self.iface2ring else self._listen_from
+            thread = threading.Thread(target=listen, args=(iface, ))
             thread.start()
+        if self.link_model.latency or self.link_model.jitter:
+            threading.Thread(target=self._send_delayed).start()
 
     def _listen_from(self, iface):
         sock = self.iface2sock[iface]
-        sock.bind((iface, 0))
-        # TODO should be max IP packet size
+        buff = bytearray(MAX_PACKET_SIZE)
+        view = memoryview(buff)
+        dst_addr = struct.Struct(">I")
         while True:
-            packet = IPPacket.from_bytes(sock.recv(64))
-            dst_dotdec = packet.dst_addr.to_dotdec()
-            if dst_dotdec not in self.route_rules:
+            size, addr = sock.recvfrom_into(buff)
+            # the socket also sees everything we forward out of this iface
+            if addr[2] == socket.PACKET_OUTGOING or size < IP_HEADER_SIZE:
                 continue
-            # TODO generalize, but testing for now
-            if random.choice([True, False]):
+            route = self.routes.lookup(dst_addr.unpack_from(buff, 4)[0])
+            if route is None or self.link_model.drop():
                 continue
-            dst = self.iface2sock[self.route_rules[dst_dotdec]]
-            dst.send(packet.to_bytes())
+            delay = self.link_model.delay()
+            if delay:
+                self._delay(route, bytes(view[:size]), delay)
+            else:
+                self._send(route, view[:size])
+
+    def _listen_ring(self, iface):
+        ring = self.iface2ring[iface]
+        dst_addr = struct.Struct(">I")
+        while True:
+            routed = set()
+            for pkttype, frame in ring.recv_block():
+                if pkttype == socket.PACKET_OUTGOING or \
+                        len(frame) < IP_HEADER_SIZE:
+                    continue
+                route = self.routes.lookup(dst_addr.unpack_from(frame, 4)[0])
+                if route is None or self.link_model.drop():
+                    continue
+                delay = self.link_model.delay()
+                if delay:
+                    self._delay(route, bytes(frame), delay)
+                else:
+                    self._send(route, frame, flush=False)
+                    routed.add(route)
+            ring.release()
+            # one send per destination for the whole block
+            for route in routed:
+                if route in self.iface2ring:
+                    self.iface2ring[route].flush()
+
+    def _send(self, iface, packet, flush=True):
+        ring = self.iface2ring.get(iface)
+        if ring is None:
+            self.iface2sock[iface].send(packet)
+            return
+        ring.send(packet)
+        if flush:
+            ring.flush()
+
+    def _delay(self, iface, packet, delay):
+        with self._delayed_cv:
+            self._delayed_seq += 1
+            heapq.heappush(self._delayed, (time.monotonic() + delay,
+                                           self._delayed_seq, iface, packet))
+            self._delayed_cv.notify()
+
+    def _send_delayed(self):
+        while True:
+            with self._delayed_cv:
+                while True:
+                    wait_s = self._delayed[0][0] - time.monotonic() \
+                        if self._delayed else None
+                    if wait_s is not None and wait_s <= 0:
+                        break
+                    self._delayed_cv.wait(wait_s)
+                _, _, iface, packet = heapq.heappop(self._delayed)
+            self._send(iface, packet)
 
 
 class IPAddr(object):
@@ -47,19 +211,20 @@ class IPAddr(object):
 
     @classmethod
     def from_bytes(cls, b):
-        return cls(cls._bytes2addr(b))
+        addr = cls.__new__(cls)
+        addr._bytes = bytes(b)
+        return addr
 
     def to_dotdec(self):
         return self._bytes2addr(self._bytes)
 
     @staticmethod
     def _addr2bytes(addr):
-        parts = list(map(int, addr.split(".")))
-        return ''.join(map(chr, parts)).encode("latin")
+        return socket.inet_aton(addr)
 
     @staticmethod
     def _bytes2addr(b):
-        return ".".join(str(ord(c)) for c in b.decode("latin"))
+        return socket.inet_ntoa(b)
 
 
 class IPPacket(object):
@@ -81,10 +246,267 @@ class IPPacket(object):
         )
 
 
+class _SockFilter(ctypes.Structure):
+    _fields_ = [
+        ("code", ctypes.c_uint16),
+        ("jt", ctypes.c_uint8),
+        ("jf", ctypes.c_uint8),
+        ("k", ctypes.c_uint32),
+    ]
+
+
+class _SockFProg(ctypes.Structure):
+    _fields_ = [
+        ("len", ctypes.c_ushort),
+        ("filter", ctypes.POINTER(_SockFilter)),
+    ]
+
+
+def src_filter_program(src_addrs):
+    """
+    Classic BPF program accepting only packets whose source address is one
+    of src_addrs (as bytes)
+    """
+    n = len(src_addrs)
+    program = [(BPF_LD | BPF_W | BPF_ABS, 0, 0, 0)]
+    for i, addr in enumerate(src_addrs):
+        # jump past the remaining comparisons and the drop to the accept
+        program.append((BPF_JMP | BPF_JEQ | BPF_K, n - i, 0,
+                        struct.unpack(">I", addr)[0]))
+    program.append((BPF_RET | BPF_K, 0, 0, 0))
+    program.append((BPF_RET | BPF_K, 0, 0, 0xffffffff))
+    return program
+
+
+def attach_src_filter(sock, src_addrs):
+    """
+    Have the kernel drop packets from anyone but src_addrs before they
+    reach the socket, returning False if the filter couldn't be attached
+    in which case callers need to keep filtering themselves
+    """
+    program = src_filter_program(src_addrs)
+    filters = (_SockFilter * len(program))(*program)
+    fprog = _SockFProg(len(program), filters)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER, bytes(fprog))
+    except OSError as e:
+        logger.warning("Falling back to filtering packets in Python: %s",
+                       e)
+        return False
+    return True
+
+
+def dev_mtu(dev):
+    try:
+        with open("/sys/class/net/{}/mtu".format(dev)) as f:
+            return int(f.read())
+    except (OSError, ValueError):
+        return DEFAULT_MTU
+
+
+RING_BLOCK_SIZE = 2**18  # bytes
+RING_BLOCK_NR = 16
+# only bounds the number of RX frames -- V3 packs variable sized frames into
+# each block
+RING_FRAME_SIZE = 2**11  # bytes
+# how long the kernel holds a partly filled block before handing it over
+RING_RETIRE_MS = 1
+
+# tpacket_req3
+_TPACKET_REQ3 = struct.Struct("=7I")
+# block_status, num_pkts, offset_to_first_pkt of tpacket_block_desc
+_BLOCK_DESC = struct.Struct("=III")
+_BLOCK_DESC_OFFSET = 8
+# tp_next_offset, tp_snaplen, tp_mac of tpacket3_hdr
+_FRAME_HDR = struct.Struct("=I8xI8xH")
+_STATUS = struct.Struct("=I")
+_TP_LEN_OFFSET = 16
+_TP_STATUS_OFFSET = 20
+# sll_pkttype of the sockaddr_ll following the aligned tpacket3_hdr
+_SLL_PKTTYPE_OFFSET = 58
+# TPACKET3_HDRLEN - sizeof(struct sockaddr_ll)
+_TX_DATA_OFFSET = 48
+# tp_packets, tp_drops, tp_freeze_q_cnt of tpacket_stats_v3
+_RING_STATS = struct.Struct("=3I")
+
+
+class PacketRing(object):
+    """
+    TPACKET_V3 RX and TX rings memory-mapped from an AF_PACKET socket
+
+    The kernel writes received frames straight into the RX ring and hands
+    them over a block at a time, so one wakeup yields every frame in the
+    block as a memoryview with no recv or copy. Views are only valid until
+    the block is released. Sends are copied into TX frames and go out
+    together on the next flush. If the kernel refuses the TX ring, sends go
+    through the socket as usual.
+    """
+    def __init__(self,
+                 sock,
+                 mtu=DEFAULT_MTU,
+                 block_size=RING_BLOCK_SIZE,
+                 block_nr=RING_BLOCK_NR,
+                 retire_ms=RING_RETIRE_MS):
+        self.sock = sock
+        self._rx_block_size = block_size
+        self._rx_block_nr = block_nr
+        self._rx_block = 0
+        self._rx_held = False
+        sock.setsockopt(SOL_PACKET, PACKET_VERSION, TPACKET_V3)
+        sock.setsockopt(
+            SOL_PACKET, PACKET_RX_RING,
+            _TPACKET_REQ3.pack(block_size, block_nr, RING_FRAME_SIZE,
+                               block_size // RING_FRAME_SIZE * block_nr,
+                               retire_ms, 0, 0))
+        # room for the link header and the tpacket3_hdr ahead of the data
+        frame_size = RING_FRAME_SIZE
+        while frame_size < mtu + 64 + _TX_DATA_OFFSET:
+            frame_size *= 2
+        tx_block_size = max(block_size, frame_size)
+        self._tx_base = block_size * block_nr
+        self._tx_frame_size = frame_size
+        self._tx_frame_nr = tx_block_size // frame_size * block_nr
+        self._tx_frame = 0
+        self._tx_pending = 0
+        self._tx_lock = threading.Lock()
+        try:
+            sock.setsockopt(
+                SOL_PACKET, PACKET_TX_RING,
+                _TPACKET_REQ3.pack(tx_block_size, block_nr, frame_size,
+                                   self._tx_frame_nr, 0, 0, 0))
+            tx_size = tx_block_size * block_nr
+        except OSError as e:
+            logger.warning("Sending without a TX ring: %s", e)
+            self._tx_frame_nr = 0
+            tx_size = 0
+        try:
+            self._ring = mmap.mmap(sock.fileno(), self._tx_base + tx_size)
+        except OSError:
+            self._unmap_rings()
+            raise
+        self._view = memoryview(self._ring)
+        self._poll = select.poll()
+        self._poll.register(sock, select.POLLIN | select.POLLERR)
+
+    def _unmap_rings(self):
+        empty = _TPACKET_REQ3.pack(0, 0, 0, 0, 0, 0, 0)
+        self.sock.setsockopt(SOL_PACKET, PACKET_RX_RING, empty)
+        if self._tx_frame_nr:
+            self.sock.setsockopt(SOL_PACKET, PACKET_TX_RING, empty)
+
+    def recv_block(self, timeout=None):
+        """
+        Wait up to timeout seconds for the next block of frames and return
+        them as (pkttype, view) pairs, or an empty list on timeout -- the
+        block must be released once the views are no longer needed
+        """
+        offset = self._rx_block * self._rx_block_size
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            status, num_pkts, first = _BLOCK_DESC.unpack_from(
+                self._ring, offset + _BLOCK_DESC_OFFSET)
+            if status & TP_STATUS_USER:
+                break
+            if deadline is None:
+                self._poll.poll()
+                continue
+            remaining_s = deadline - time.monotonic()
+            if remaining_s <= 0:
+                return []
+            self._poll.poll(remaining_s * 1000)
+        self._rx_held = True
+        frames = []
+        frame = offset + first
+        for _ in range(num_pkts):
+            next_offset, snaplen, mac = _FRAME_HDR.unpack_from(
+                self._ring, frame)
+            frames.append((self._ring[frame + _SLL_PKTTYPE_OFFSET],
+                           self._view[frame + mac:frame + mac + snaplen]))
+            frame += next_offset
+        return frames
+
+    def release(self):
+        """
+        Hand the current RX block back to the kernel
+        """
+        if not self._rx_held:
+            return
+        _STATUS.pack_into(
+            self._ring,
+            self._rx_block * self._rx_block_size + _BLOCK_DESC_OFFSET,
+            TP_STATUS_KERNEL)
+        self._rx_block = (self._rx_block + 1) % self._rx_block_nr
+        self._rx_held = False
+
+    def stats(self):
+        """
+        Packets received and dropped for want of a free block since the last
+        call
+        """
+        packets, drops, _ = _RING_STATS.unpack(
+            self.sock.getsockopt(SOL_PACKET, PACKET_STATISTICS,
+                                 _RING_STATS.size))
+        return packets, drops
+
+    def send(self, data):
+        """
+        Queue data in the next TX frame, waiting for the kernel to drain the
+        ring if it's full
+        """
+        if not self._tx_frame_nr:
+            self.sock.send(data)
+            return
+        if len(data) > self._tx_frame_size - _TX_DATA_OFFSET:
+            raise OSError(errno.EMSGSIZE, os.strerror(errno.EMSGSIZE))
+        with self._tx_lock:
+            frame = self._tx_base + self._tx_frame * self._tx_frame_size
+            status, = _STATUS.unpack_from(self._ring,
+                                          frame + _TP_STATUS_OFFSET)
+            if status not in (TP_STATUS_AVAILABLE, TP_STATUS_WRONG_FORMAT):
+                # blocks until every queued frame has gone out
+                self.sock.send(b'')
+                self._tx_pending = 0
+            start = frame + _TX_DATA_OFFSET
+            self._ring[start:start + len(data)] = data
+            _STATUS.pack_into(self._ring, frame + _TP_LEN_OFFSET, len(data))
+            _STATUS.pack_into(self._ring, frame + _TP_STATUS_OFFSET,
+                              TP_STATUS_SEND_REQUEST)
+            self._tx_frame = (self._tx_frame + 1) % self._tx_frame_nr
+            self._tx_pending += 1
+
+    def flush(self):
+        """
+        Have the kernel send every queued TX frame with one syscall
+        """
+        with self._tx_lock:
+            if not self._tx_pending:
+                return
+            try:
+                self.sock.send(b'', socket.MSG_DONTWAIT)
+            except BlockingIOError:
+                # the frames stay queued for the next flush
+                return
+            self._tx_pending = 0
+
+
+def open_packet_ring(sock, mtu=DEFAULT_MTU, **kwargs):
+    """
+    Map a PacketRing onto sock, returning None if the kernel won't allow it
+    in which case callers need to keep using recv and send
+    """
+    try:
+        return PacketRing(sock, mtu, **kwargs)
+    except OSError as e:
+        logger.warning("Falling back to recv without a ring: %s", e)
+        return None
+
+
 class IPDump(object):
-    def __init__(self, dev, src):
+    def __init__(self, dev, src, use_bpf=True, use_ring=False):
         self.dev = dev
         self.src = src
+        self.use_bpf = use_bpf
+        self.use_ring = use_ring
 
     def start(self):
         thread = threading.Thread(target=self._dump)
@@ -93,152 +515,1520 @@ class IPDump(object):
     def _dump(self):
         sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW,
                              socket.htons(ETH_P_ALL))
+        if self.use_bpf:
+            attach_src_filter(sock, [IPAddr(self.src).to_bytes()])
         sock.bind((self.dev, 0))
+        ring = open_packet_ring(sock, dev_mtu(self.dev)) \
+            if self.use_ring else None
         while True:
-            packet = IPPacket.from_bytes(sock.recv(64))
-            if self.src != packet.src_addr.to_dotdec():
+            if ring is None:
+                self._print(IPPacket.from_bytes(sock.recv(MAX_PACKET_SIZE)))
                 continue
-            print("{} got packet from {}: {}".format(
-                self.dev, packet.src_addr.to_dotdec(), packet.data))
+            for _, frame in ring.recv_block():
+                self._print(IPPacket.from_bytes(bytes(frame)))
+            ring.release()
+
+    def _print(self, packet):
+        # still needed for anything queued before the filter attached
+        if self.src != packet.src_addr.to_dotdec():
+            return
+        print("{} got packet from {}: {}".format(
+            self.dev, packet.src_addr.to_dotdec(), packet.data))
 
 
 class IPCxn(object):
-    def __init__(self, src_addr_dotdec, dst_addr_dotdec, dev):
+    def __init__(self,
+                 src_addr_dotdec,
+                 dst_addr_dotdec,
+                 dev,
+                 sock=None,
+                 use_bpf=True,
+                 use_ring=False):
         self.src_addr = IPAddr(src_addr_dotdec)
         self.dst_addr = IPAddr(dst_addr_dotdec)
         self.dev = dev
-        self.sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW,
-                                  socket.htons(ETH_P_ALL))
-        self.sock.bind((dev, 0))
+        self.ring = None
+        if sock is None:
+            sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW,
+                                 socket.htons(ETH_P_ALL))
+            if use_bpf:
+                attach_src_filter(sock, [self.dst_addr.to_bytes()])
+            sock.bind((dev, 0))
+            if use_ring:
+                # trades up to RING_RETIRE_MS of latency per packet for
+                # far fewer syscalls under load
+                self.ring = open_packet_ring(sock, self.mtu())
+        self.sock = sock
+        self._ring_frames = collections.deque()
+
+    def mtu(self):
+        return dev_mtu(self.dev)
 
     def send_data(self, data):
         packet = IPPacket(self.src_addr, self.dst_addr, data)
-        self.sock.send(packet.to_bytes())
+        if self.ring is None:
+            self.sock.send(packet.to_bytes())
+            return
+        self.ring.send(packet.to_bytes())
+        self.ring.flush()
 
     def recv_data(self):
+        if self.ring is not None:
+            return self._recv_ring()
         while True:
-            packet = IPPacket.from_bytes(self.sock.recv(64))
+            packet = IPPacket.from_bytes(self.sock.recv(MAX_PACKET_SIZE))
+            # still needed for anything queued before the filter attached or
+            # if it couldn't be
             if self.dst_addr.to_bytes() != packet.src_addr.to_bytes():
                 continue
             return packet.data
 
+    def _recv_ring(self):
+        src = self.dst_addr.to_bytes()
+        while not self._ring_frames:
+            # copy out every frame in the block so it can go straight back
+            # to the kernel
+            for _, frame in self.ring.recv_block():
+                if frame[:4] == src:
+                    self._ring_frames.append(bytes(frame[IP_HEADER_SIZE:]))
+            self.ring.release()
+        return self._ring_frames.popleft()
+
 
 class RCPPacketType(enum.Enum):
     SYN = 1
     ACK = 2
+    PARITY = 3
+    SYN_ACK = 4  # a SYN with an ACK riding along
+
+
+_PTYPES = {ptype.value: ptype for ptype in RCPPacketType}
+
+
+DEFAULT_WINDOW = 32  # packets
+MAX_WINDOW = 2**16 - 1  # packets
+# payload size assumed of a peer until it advertises its own
+DEFAULT_MSS = 256  # bytes
+MAX_MSS = 2**16 - 1  # bytes
+SEQ_MODULUS = 2**32
+
+
+def seq_diff(a, b):
+    """
+    Signed distance from sequence number b to a using serial number
+    arithmetic (RFC 1982) so that indices can wrap around
+    """
+    return (a - b + SEQ_MODULUS // 2) % SEQ_MODULUS - SEQ_MODULUS // 2
 
 
 class RCPPacket(object):
-    def __init__(self, ptype, index, acks, data):
-        assert len(acks) == 32
+    # type (1 byte), index (4 bytes), window (2 bytes), mss (2 bytes)
+    HEADER = struct.Struct(">BIHH")
+    # which stream a SYN packet belongs to (2 bytes) and its index within
+    # that stream (4 bytes)
+    STREAM_HEADER = struct.Struct(">HI")
+    # the index a SYN_ACK's ACK is for (4 bytes)
+    ACK_HEADER = struct.Struct(">I")
+
+    def __init__(self,
+                 ptype,
+                 index,
+                 acks,
+                 data,
+                 window=DEFAULT_WINDOW,
+                 mss=DEFAULT_MSS,
+                 stream=0,
+                 stream_index=0,
+                 ack_index=0):
+        """
+        window is the sender's receive window in packets which ACK packets
+        follow with a window bit mask where bit i is set if the packet at
+        index + i has been received. mss is the largest payload the sender
+        will accept.
+
+        SYN packets follow the header with their stream and stream_index.
+        Every stream in a session shares the session's index space, which
+        ACKs and congestion control work in, while stream_index orders a
+        stream's packets among themselves.
+
+        SYN_ACK packets are SYN packets that also acknowledge what their
+        sender has received, following the stream header with ack_index and
+        the same bit mask as an ACK for that index.
+
+        PARITY packets carry Reed-Solomon parity over the group of SYN
+        packets starting at index -- see FEC_HEADER for their payload.
+        """
         self.ptype = ptype
         self.index = index
         self.acks = acks
         self.data = data
+        self.window = window
+        self.mss = mss
+        self.stream = stream
+        self.stream_index = stream_index
+        self.ack_index = ack_index
+
+    def acked(self, i):
+        return bool((self.acks >> i) & 1)
 
     def to_bytes(self):
-        acks_int = sum(int(self.acks[i]) << i for i in range(len(self.acks)))
-        return self.ptype.value.to_bytes(byteorder='big', length=1) + \
-            self.index.to_bytes(byteorder='big', length=4) + \
-            acks_int.to_bytes(byteorder='big', length=4) + \
-            self.data
+        header = self.HEADER.pack(self.ptype.value, self.index, self.window,
+                                  self.mss)
+        if self.ptype is RCPPacketType.ACK:
+            return header + self.acks.to_bytes(
+                byteorder='big', length=(self.window + 7) // 8) + self.data
+        if self.ptype is RCPPacketType.SYN:
+            return header + self.STREAM_HEADER.pack(
+                self.stream, self.stream_index) + self.data
+        if self.ptype is RCPPacketType.SYN_ACK:
+            return header + self.STREAM_HEADER.pack(
+                self.stream, self.stream_index) + self.ACK_HEADER.pack(
+                    self.ack_index) + self.acks.to_bytes(
+                        byteorder='big',
+                        length=(self.window + 7) // 8) + self.data
+        return header + self.data
 
     @classmethod
     def from_bytes(cls, b):
-        ptype_int = int.from_bytes(b[0:1], byteorder='big')
-        index_int = int.from_bytes(b[1:5], byteorder='big')
-        acks_int = int.from_bytes(b[5:9], byteorder='big')
-        data = b[9:]
+        """
+        Decode a packet, raising ValueError if b isn't a well-formed one
+        """
+        try:
+            return cls._decode(b)
+        except struct.error as e:
+            raise ValueError("Truncated RCP packet: {}".format(e)) from e
+
+    @classmethod
+    def _decode(cls, b):
+        ptype_int, index_int, window, mss = cls.HEADER.unpack_from(b)
+        ptype = _PTYPES.get(ptype_int)
+        if ptype is None:
+            raise ValueError("Unknown RCP packet type {}".format(ptype_int))
+        data_start = cls.HEADER.size
+        acks_int = 0
+        stream = stream_index = ack_index = 0
+        if ptype is RCPPacketType.ACK:
+            data_start += (window + 7) // 8
+            acks_int = int.from_bytes(b[cls.HEADER.size:data_start],
+                                      byteorder='big')
+        elif ptype in (RCPPacketType.SYN, RCPPacketType.SYN_ACK):
+            stream, stream_index = cls.STREAM_HEADER.unpack_from(b, data_start)
+            data_start += cls.STREAM_HEADER.size
+        if ptype is RCPPacketType.SYN_ACK:
+            ack_index, = cls.ACK_HEADER.unpack_from(b, data_start)
+            acks_start = data_start + cls.ACK_HEADER.size
+            data_start = acks_start + (window + 7) // 8
+            acks_int = int.from_bytes(b[acks_start:data_start],
+                                      byteorder='big')
+        if ptype is RCPPacketType.PARITY and \
+                len(b) - data_start < FEC_HEADER.size:
+            raise ValueError("Truncated RCP parity header")
         return cls(
-            RCPPacketType(ptype_int),
+            ptype,
             index_int,
-            [bool((acks_int >> i) & 1) for i in range(32)],
-            data,
+            acks_int,
+            memoryview(b)[data_start:],
+            window=window,
+            mss=mss,
+            stream=stream,
+            stream_index=stream_index,
+            ack_index=ack_index,
         )
 
 
+MAX_FEC_GROUP = 64  # SYN packets covered by one set of parity packets
+MAX_FEC_PARITY = 32  # parity packets per group
+FEC_GROUP_SIZE = 16  # packets
+# a partial group gets its parity once its first packet has waited this long
+FEC_GROUP_DELAY = .005  # seconds
+FEC_INITIAL_LOSS = .05  # assumed until the receiver reports what it sees
+# weight of each parity packet in the receiver's running loss estimate
+FEC_LOSS_GAIN = .02
+# standard deviations of loss above the mean a group's parity should cover
+FEC_MARGIN = 2.
+# PARITY payloads start with the group's size, which of its parity packets
+# this is and a count of all the parity packets sent before it, followed by
+# the parity itself
+FEC_HEADER = struct.Struct(">BBH")
+FEC_SEQ_MODULUS = 2**16
+# each packet's payload is coded prefixed with its length, so packets of
+# different lengths come back out at the right size, and its stream header
+FEC_LENGTH = struct.Struct(">H")
+FEC_OVERHEAD = FEC_HEADER.size + FEC_LENGTH.size  # bytes
+# ACKs from a receiver getting parity carry the fraction of parity packets
+# it's seen go missing, scaled to 16 bits
+FEC_LOSS = struct.Struct(">H")
+_FEC_LOSS_SCALE = 2**16 - 1
+
+
+def _gf_tables():
+    # log and antilog tables of GF(2^8) under x^8 + x^4 + x^3 + x^2 + 1 with
+    # the antilogs repeated so products never need reducing mod 255
+    exp, log = [0] * 510, [0] * 256
+    x = 1
+    for i in range(255):
+        exp[i] = exp[i + 255] = x
+        log[x] = i
+        x <<= 1
+        if x & 0x100:
+            x ^= 0x11d
+    return exp, log
+
+
+_GF_EXP, _GF_LOG = _gf_tables()
+
+
+def _gf_mul(a, b):
+    if not a or not b:
+        return 0
+    return _GF_EXP[_GF_LOG[a] + _GF_LOG[b]]
+
+
+def _gf_inv(a):
+    return _GF_EXP[255 - _GF_LOG[a]]
+
+
+@functools.lru_cache(maxsize=256)
+def _gf_scale_table(c):
+    # multiplying every byte of a payload by c is then one bytes.translate
+    return bytes(_gf_mul(c, x) for x in range(256))
+
+
+def fec_coefficient(row, column):
+    """
+    Weight of the packet at column of a group in its parity packet row
+
+    The weights form a Cauchy matrix, every square submatrix of which is
+    invertible, so any `size` of a group's packets and its parity are
+    enough to rebuild the rest.
+    """
+    return _gf_inv(row ^ (MAX_FEC_PARITY + column))
+
+
+def fec_symbol(packet):
+    """
+    What a SYN packet contributes to its group's parity
+    """
+    return FEC_LENGTH.pack(len(packet.data)) + RCPPacket.STREAM_HEADER.pack(
+        packet.stream, packet.stream_index) + packet.data
+
+
+def fec_combine(symbols, coefficients, size):
+    """
+    Sum over GF(2^8) of each symbol times its coefficient, with symbols
+    zero-padded to size bytes
+    """
+    acc = 0
+    for symbol, c in zip(symbols, coefficients):
+        if not c:
+            continue
+        if c != 1:
+            symbol = symbol.translate(_gf_scale_table(c))
+        acc ^= int.from_bytes(symbol, 'big') << 8 * (size - len(symbol))
+    return acc.to_bytes(size, 'big')
+
+
+def _gf_invert(matrix):
+    n = len(matrix)
+    rows = [row[:] + [int(i == j) for j in range(n)]
+            for i, row in enumerate(matrix)]
+    for col in range(n):
+        pivot = next(r for r in range(col, n) if rows[r][col])
+        rows[col], rows[pivot] = rows[pivot], rows[col]
+        inv = _gf_inv(rows[col][col])
+        rows[col] = [_gf_mul(inv, v) for v in rows[col]]
+        for r in range(n):
+            factor = rows[r][col]
+            if r != col and factor:
+                rows[r] = [
+                    v ^ _gf_mul(factor, p) for v, p in zip(rows[r], rows[col])
+                ]
+    return [row[n:] for row in rows]
+
+
+def fec_encode(symbols, count):
+    """
+    The `count` parity symbols of a group of symbols
+    """
+    size = max(len(symbol) for symbol in symbols)
+    return [
+        fec_combine(
+            symbols,
+            [fec_coefficient(row, col) for col in range(len(symbols))], size)
+        for row in range(count)
+    ]
+
+
+def fec_decode(present, parities, missing):
+    """
+    Rebuild the symbols at the `missing` columns of a group from the
+    {column: symbol} that arrived and at least as many {row: parity}
+    """
+    rows = sorted(parities)[:len(missing)]
+    size = len(parities[rows[0]])
+    columns = list(present)
+    symbols = [present[col] for col in columns]
+    # take what the packets we have contribute out of each parity, leaving
+    # just the missing packets' share
+    syndromes = [
+        fec_combine(symbols + [parities[row]],
+                    [fec_coefficient(row, col) for col in columns] + [1],
+                    size) for row in rows
+    ]
+    inverse = _gf_invert([[fec_coefficient(row, col) for col in missing]
+                          for row in rows])
+    return {
+        col: fec_combine(syndromes, inverse[i], size)
+        for i, col in enumerate(missing)
+    }
+
+
+ACK_DELAY = .005  # seconds
+# largest share of a packet's payload set aside for an ACK to ride along
+ACK_ROOM_SHARE = 1 / 64
+COALESCE_DELAY = .005  # seconds
+MIN_RTO = .02  # seconds
+MAX_RTO = 2.  # seconds
+INITIAL_CWND = 4  # packets
+MIN_CWND = 2  # packets
+MAX_BACKOFF = 3  # doublings of the RTO for a packet retransmitted repeatedly
+# number of later packets that must be acked before a gap is presumed lost
+FAST_RETRANSMIT_THRESHOLD = 3
+
+
+class _Flight(object):
+    """
+    Retransmission state of a packet that's been sent but not acked
+    """
+    __slots__ = ("sent_at", "deadline", "retransmits", "lost")
+
+    def __init__(self, sent_at, deadline):
+        self.sent_at = sent_at
+        self.deadline = deadline
+        self.retransmits = 0
+        # set when the ACK bitmap shows the packet was skipped over
+        self.lost = False
+
+
+class _FecGroup(object):
+    """
+    Parity received for a group of SYN packets
+    """
+    __slots__ = ("size", "parities", "done")
+
+    def __init__(self, size):
+        self.size = size
+        self.parities = {}  # row -> parity symbol
+        # set once every packet in the group is in hand
+        self.done = False
+
+
+class _RecvStream(object):
+    """
+    Reassembly state of one stream of a session
+    """
+    __slots__ = ("next_ix", "ready")
+
+    def __init__(self):
+        self.next_ix = 0  # stream index of the next packet to deliver
+        self.ready = {}  # stream index -> index of received, undelivered
+
+
+class RCPStats(object):
+    """
+    Running counters of what a session has done on the wire
+    """
+    __slots__ = ("packets_sent", "bytes_sent", "timeout_retransmits",
+                 "fast_retransmits", "window_cuts", "packets_received",
+                 "duplicate_packets", "out_of_window_packets", "acks_sent",
+                 "acks_received", "ack_delay_total", "ack_delay_max",
+                 "delayed_acks", "piggybacked_acks", "window_probes",
+                 "rtt_last", "rtt_min", "bytes_queued",
+                 "bytes_delivered", "fec_parity_sent", "fec_recovered",
+                 "last_app_send", "last_app_recv")
+
+    def __init__(self):
+        for name in self.__slots__:
+            setattr(self, name, 0)
+        self.rtt_last = None
+        self.rtt_min = None
+        self.last_app_send = None
+        self.last_app_recv = None
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
 class RCPCxn(object):
-    def __init__(self, ipcxn, timeout=.1):
+    def __init__(self,
+                 ipcxn,
+                 timeout=.1,
+                 window=DEFAULT_WINDOW,
+                 mss=None,
+                 nodelay=False,
+                 coalesce_delay=COALESCE_DELAY,
+                 fec=False):
+        assert 0 < window <= MAX_WINDOW
         self.ipcxn = ipcxn
+        # our receive window -- the send window is the smaller of our window
+        # and whatever our peer advertises in its packets
+        self.window = window
+        self.peer_window = min(window, DEFAULT_WINDOW)
+        # likewise for the largest payload, which defaults to whatever fits
+        # in the device's MTU
+        if mss is None:
+            mtu = ipcxn.mtu() if hasattr(ipcxn, "mtu") else DEFAULT_MTU
+            mss = mtu - IP_HEADER_SIZE - RCPPacket.HEADER.size - \
+                RCPPacket.STREAM_HEADER.size
+        assert 0 < mss <= MAX_MSS
+        self.mss = mss
+        self.peer_mss = min(mss, DEFAULT_MSS)
+        # partial packets wait up to coalesce_delay for more data unless
+        # nodelay is set
+        self.nodelay = nodelay
+        self.coalesce_delay = coalesce_delay
+        self.pending = {}  # stream -> partial packet
+        self.flush_at = None
         self.send_ix = 0  # index of the next addition to the queue
-        self.send_queue = []
+        self.send_una = 0  # index of the first unacked packet
+        self.send_nxt = 0  # index of the next packet to send for the first time
+        self.stream_ix = {}  # stream -> stream index of its next packet
+        self.send_buffer = {}  # index -> packet for queued, unacked packets
+        self.in_flight = {}  # index -> _Flight for sent, unacked packets
+        self.peer_ix = 0  # index of the first packet our peer hasn't delivered
         self.recv_ix = 0  # index of the first entry in the queue
-        self.recv_queue = [None] * 32
+        # ring buffer where the entry for recv_ix sits at recv_head
+        self.recv_queue = [None] * window
+        self.recv_head = 0
+        # bit i is set if the entry for recv_ix + i has been filled
+        self.recv_acks = 0
+        # and in this one if it's been delivered -- streams deliver
+        # independently so entries can be taken out of order
+        self.recv_taken = 0
+        self.recv_streams = {}  # stream -> _RecvStream
+        # ACKs are only sent when there's something new to tell our peer and
+        # ride along on outgoing packets where they can
+        self.ack_pending = False
+        self.next_ack = None
+        # bytes an ACK adds to a SYN packet
+        self.ack_room = RCPPacket.ACK_HEADER.size + (window + 7) // 8
+        # when to next check whether our peer's full window has opened back up
+        self.probe_at = None
+        self.probes = 0
+        # timeout is the initial retransmission timeout until we have an RTT
+        # sample
         self.timeout = timeout
+        self.rto = timeout
+        self.srtt = None
+        self.rttvar = None
+        # congestion window in packets, grown and cut AIMD-style
+        self.cwnd = INITIAL_CWND
+        self.ssthresh = window
+        # no further window cuts until packets sent after a loss are lost
+        self.recover_ix = 0
+        # with fec set, each group of packets we send is followed by enough
+        # Reed-Solomon parity for our peer to rebuild the ones the loss it
+        # reports would cost without waiting on retransmissions
+        self.fec = fec
+        self.fec_loss = FEC_INITIAL_LOSS
+        self.fec_first = 0  # index of the first packet in the open group
+        self.fec_symbols = []  # coded payloads of the open group's packets
+        self.fec_flush_at = None
+        self.fec_seq = 0  # parity packets we've sent
+        # and whether or not we send it, parity from our peer is used to
+        # rebuild what we've lost of its packets
+        self.peer_fec = False
+        self.fec_groups = {}  # index of first packet -> _FecGroup
+        self.fec_recv_seq = None  # count of parity packets we next expect
+        self.fec_recv_loss = 0.
+        # payloads delivered recently enough to still be needed for decoding
+        self.fec_delivered = {}
         self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        # called whenever there may be something new to send -- an event loop
+        # driving the connection swaps this out for its own wakeup
+        self.notify = self.wakeup.set
+        # when we next need to be polled or None if only when woken
+        self.deadline = 0.
+        self.last_recv = time.monotonic()
+        self.closed = False
+        # signalled when the head of the receive queue is filled
+        self.readable = threading.Condition(self.lock)
+        self.counters = RCPStats()
+        self.ack_scheduled_at = None
+        # optionally called as observer(cxn, event, index) on "retransmit",
+        # "fast_retransmit", "duplicate", "out_of_window", "window_cut" and
+        # "fec_recovered" events -- it runs under the connection's lock so must be quick
+        self.observer = None
 
     def start(self):
         threading.Thread(target=self._send_loop).start()
         threading.Thread(target=self._recv_loop).start()
 
     def _send_loop(self):
+        wait_s = 0
         while True:
-            # only send within 32 packets of the lowest one because the other
-            # end will discard anything else
-            to_send = []
-            with self.lock:
-                for packet in self.send_queue:
-                    if not to_send:
-                        to_send.append(packet)
-                    elif (packet.index - to_send[0].index) < 32:
-                        to_send.append(packet)
-            for packet in to_send:
+            self.wakeup.wait(wait_s)
+            self.wakeup.clear()
+            now = time.monotonic()
+            for packet in self._poll(now):
                 self.ipcxn.send_data(packet.to_bytes())
-            self.ipcxn.send_data(self._ack_packet().to_bytes())
-            time.sleep(self.timeout)
+            wait_s = None if self.deadline is None else self.deadline - now
+
+    def _poll(self, now):
+        """
+        Return the packets due to be sent as of now and update the deadline
+        by which we next need to be polled
+        """
+        with self.lock:
+            if self.flush_at is not None and now >= self.flush_at:
+                self._flush_pending()
+            to_send = self._due_packets(now)
+            if self.ack_pending and self._piggyback(to_send):
+                self._count_ack(now, piggybacked=True)
+            elif self.ack_pending and now >= self.next_ack:
+                to_send.append(self._ack_packet())
+                self._count_ack(now)
+            deadlines = [f.deadline for f in self.in_flight.values()] + [
+                at for at in (self.next_ack, self.flush_at, self.fec_flush_at,
+                              self.probe_at) if at is not None
+            ]
+            self.deadline = min(deadlines) if deadlines else None
+        return to_send
+
+    def _due_packets(self, now):
+        """
+        Pick out sent packets whose retransmission timers have expired and
+        new packets the congestion window has room for
+        """
+        to_send = []
+        timed_out = False
+        for index, flight in self.in_flight.items():
+            if now < flight.deadline:
+                continue
+            if flight.lost:
+                flight.lost = False
+                self.counters.fast_retransmits += 1
+                self._observe("fast_retransmit", index)
+            else:
+                if seq_diff(index, self.recover_ix) >= 0:
+                    timed_out = True
+                self.counters.timeout_retransmits += 1
+                self._observe("retransmit", index)
+            flight.retransmits += 1
+            flight.deadline = now + min(
+                self.rto * 2**min(flight.retransmits, MAX_BACKOFF), MAX_RTO)
+            to_send.append(self.send_buffer[index])
+        if timed_out:
+            self._cut_window()
+        # only send within the window of the first packet the other end has
+        # yet to deliver because it will discard anything else
+        send_window = min(self.window, self.peer_window)
+        # packets covered by parity may have to wait on the rest of their
+        # group before our peer can rebuild them
+        rto = self.rto + FEC_GROUP_DELAY if self.fec else self.rto
+        while (self.send_nxt != self.send_ix
+               and seq_diff(self.send_nxt, self.peer_ix) < send_window
+               and len(self.in_flight) < min(int(self.cwnd), send_window)):
+            self.in_flight[self.send_nxt] = _Flight(now, now + rto)
+            packet = self.send_buffer[self.send_nxt]
+            to_send.append(packet)
+            if self.fec:
+                self._fec_add(packet, now, send_window, to_send)
+            self.send_nxt = (self.send_nxt + 1) % SEQ_MODULUS
+        if self.fec_symbols and now >= self.fec_flush_at:
+            self._fec_close(to_send)
+        self._probe_window(now, send_window, to_send)
+        self.counters.packets_sent += len(to_send)
+        self.counters.bytes_sent += sum(len(p.data) for p in to_send)
+        return to_send
+
+    def _probe_window(self, now, send_window, to_send):
+        # with our peer's window full and nothing in flight, only an ACK from
+        # our peer can get us going again so if that's lost we have to ask
+        if (self.in_flight or self.send_nxt == self.send_ix
+                or seq_diff(self.send_nxt, self.peer_ix) < send_window):
+            self.probe_at = None
+            self.probes = 0
+        elif self.probe_at is None:
+            self.probe_at = now + self.rto
+        elif now >= self.probe_at:
+            # anything it can't take is answered with an ACK straight away
+            to_send.append(self.send_buffer[self.send_nxt])
+            self.probes += 1
+            self.probe_at = now + min(
+                self.rto * 2**min(self.probes, MAX_BACKOFF), MAX_RTO)
+            self.counters.window_probes += 1
+
+    def _piggyback(self, to_send):
+        """
+        Put our pending ACK on whichever SYN packets have room for it,
+        returning whether any did
+        """
+        room = min(self.mss, self.peer_mss) - self.ack_room
+        carried = False
+        for i, packet in enumerate(to_send):
+            if packet.ptype is not RCPPacketType.SYN or len(packet.data) > room:
+                continue
+            to_send[i] = RCPPacket(
+                RCPPacketType.SYN_ACK,
+                packet.index,
+                self.recv_acks,
+                packet.data,
+                window=self.window,
+                mss=self.mss,
+                stream=packet.stream,
+                stream_index=packet.stream_index,
+                ack_index=self.recv_ix,
+            )
+            carried = True
+        return carried
+
+    def _fec_add(self, packet, now, send_window, to_send):
+        # groups are made up of packets in the order they're first sent --
+        # retransmissions aren't covered
+        if not self.fec_symbols:
+            self.fec_first = packet.index
+            self.fec_flush_at = now + FEC_GROUP_DELAY
+        self.fec_symbols.append(fec_symbol(packet))
+        # our peer can only rebuild packets that fit in its window
+        if len(self.fec_symbols) >= min(FEC_GROUP_SIZE, send_window):
+            self._fec_close(to_send)
+
+    def _fec_close(self, to_send):
+        """
+        Send the parity of the open group
+
+        Parity isn't retransmitted nor held back by the congestion window,
+        and its share of what we send is sized to the loss our peer reports.
+        """
+        size = len(self.fec_symbols)
+        count = self._fec_parity_count(size)
+        for row, parity in enumerate(fec_encode(self.fec_symbols, count)):
+            to_send.append(
+                RCPPacket(
+                    RCPPacketType.PARITY,
+                    self.fec_first,
+                    0,
+                    FEC_HEADER.pack(size, row, self.fec_seq) + parity,
+                    window=self.window,
+                    mss=self.mss,
+                ))
+            self.fec_seq = (self.fec_seq + 1) % FEC_SEQ_MODULUS
+        self.counters.fec_parity_sent += count
+        self.fec_symbols = []
+        self.fec_flush_at = None
+
+    def _fec_parity_count(self, size):
+        # enough parity for all but the unluckiest groups to lose no more
+        # packets than it covers, taking the parity's own losses into account
+        p = self.fec_loss
+        count = math.ceil((size * p + FEC_MARGIN * math.sqrt(size * p *
+                                                             (1 - p))) /
+                          max(1 - p, .5))
+        return min(max(count, 1), size, MAX_FEC_PARITY)
+
+    def _count_ack(self, now, piggybacked=False):
+        if piggybacked:
+            self.counters.piggybacked_acks += 1
+        else:
+            self.counters.acks_sent += 1
+        if self.ack_scheduled_at is not None:
+            delay = now - self.ack_scheduled_at
+            self.counters.delayed_acks += 1
+            self.counters.ack_delay_total += delay
+            self.counters.ack_delay_max = max(self.counters.ack_delay_max,
+                                              delay)
+        self.ack_scheduled_at = None
+        self.ack_pending = False
+        self.next_ack = None
+
+    def _observe(self, event, index):
+        if self.observer is not None:
+            self.observer(self, event, index)
 
     def _ack_packet(self):
-        acks = [(self.recv_queue[i] is not None) for i in range(32)]
+        data = b''
+        if self.peer_fec:
+            data = FEC_LOSS.pack(round(self.fec_recv_loss * _FEC_LOSS_SCALE))
         return RCPPacket(
             RCPPacketType.ACK,
             self.recv_ix,
-            acks,
-            b'',
+            self.recv_acks,
+            data,
+            window=self.window,
+            mss=self.mss,
         )
 
     def _recv_loop(self):
         while True:
-            packet = RCPPacket.from_bytes(self.ipcxn.recv_data())
-            if packet.ptype == RCPPacketType.SYN:
-                with self.lock:
-                    ix = packet.index - self.recv_ix
-                    if ix >= 32 or ix < 0:
-                        # disregard as it's outside our current window
-                        continue
-                    self.recv_queue[ix] = packet
-            elif packet.ptype == RCPPacketType.ACK:
-                with self.lock:
-                    for i in range(len(self.send_queue) - 1, -1, -1):
-                        q_packet = self.send_queue[i]
-                        if q_packet.index < packet.index:
-                            del self.send_queue[i]
-                        if (q_packet.index - packet.index) < 32:
-                            if packet.acks[q_packet.index - packet.index]:
-                                del self.send_queue[i]
+            try:
+                packet = RCPPacket.from_bytes(self.ipcxn.recv_data())
+            except ValueError as e:
+                logger.debug("Dropping malformed packet: %s", e)
+                continue
+            self._on_packet(packet)
 
-    def send(self, data):
+    def _on_packet(self, packet):
         with self.lock:
+            # the send path reads these under the lock too
+            self.peer_window = max(packet.window, 1)
+            self.peer_mss = max(packet.mss, 1)
+            self.last_recv = time.monotonic()
+            if packet.ptype in (RCPPacketType.SYN, RCPPacketType.SYN_ACK):
+                if packet.ptype is RCPPacketType.SYN_ACK:
+                    self.counters.acks_received += 1
+                    self._process_ack(packet.ack_index, packet.acks,
+                                      self.last_recv)
+                self.counters.packets_received += 1
+                self._on_syn(packet)
+            elif packet.ptype == RCPPacketType.ACK:
+                self.counters.acks_received += 1
+                if self.fec and len(packet.data) >= FEC_LOSS.size:
+                    self.fec_loss = FEC_LOSS.unpack_from(
+                        packet.data)[0] / _FEC_LOSS_SCALE
+                self._process_ack(packet.index, packet.acks, self.last_recv)
+            elif packet.ptype == RCPPacketType.PARITY:
+                self.counters.packets_received += 1
+                self._on_parity(packet)
+        self.notify()
+
+    def _on_syn(self, packet):
+        ix = seq_diff(packet.index, self.recv_ix)
+        if not self._store_packet(packet):
+            # we already have it so our ACK must have been lost, or it's
+            # outside our window so our peer needs to hear where that is
+            self._schedule_ack(0)
+            return
+        if self.fec_groups:
+            self._fec_recover_index(packet.index)
+        below = (1 << ix) - 1
+        if ~self.recv_acks & below or self.recv_acks >> (ix + 1):
+            # a gap opening up is a loss our peer should hear about as soon
+            # as possible, as is one being filled
+            self._schedule_ack(0)
+        else:
+            # otherwise hold off briefly to cover several packets with one
+            # ACK
+            self._schedule_ack()
+
+    def _store_packet(self, packet):
+        """
+        Put a SYN packet in the receive queue, returning whether it was new
+        """
+        ix = seq_diff(packet.index, self.recv_ix)
+        if ix < 0 or (ix < self.window and (self.recv_acks >> ix) & 1):
+            self.counters.duplicate_packets += 1
+            self._observe("duplicate", packet.index)
+            return False
+        if ix >= self.window:
+            # disregard as it's outside our current window
+            self.counters.out_of_window_packets += 1
+            self._observe("out_of_window", packet.index)
+            return False
+        self.recv_queue[(self.recv_head + ix) % self.window] = packet
+        self.recv_acks |= 1 << ix
+        stream = self._recv_stream(packet.stream)
+        stream.ready[packet.stream_index] = packet.index
+        if packet.stream_index == stream.next_ix:
+            self.readable.notify_all()
+        return True
+
+    def _recv_stream(self, stream):
+        recv_stream = self.recv_streams.get(stream)
+        if recv_stream is None:
+            recv_stream = self.recv_streams[stream] = _RecvStream()
+        return recv_stream
+
+    def _on_parity(self, packet):
+        self.peer_fec = True
+        size, row, seq = FEC_HEADER.unpack_from(packet.data)
+        self._fec_count_loss(seq)
+        first = packet.index
+        for other in [
+                other for other, group in self.fec_groups.items()
+                if seq_diff(other + group.size, self.recv_ix) <= 0
+        ]:
+            # every packet in the group has already been delivered
+            del self.fec_groups[other]
+        if seq_diff(first + size, self.recv_ix) <= 0 or \
+                seq_diff(first, self.recv_ix) >= self.window:
+            return
+        group = self.fec_groups.get(first)
+        if group is None:
+            group = self.fec_groups[first] = _FecGroup(size)
+        if not group.done:
+            group.parities[row] = packet.data[FEC_HEADER.size:]
+            self._schedule_ack()
+            self._fec_recover(first, group)
+
+    def _fec_count_loss(self, seq):
+        # parity is never retransmitted so gaps in its sequence are losses
+        if self.fec_recv_seq is None:
+            self.fec_recv_seq = seq
+        lost = (seq - self.fec_recv_seq) % FEC_SEQ_MODULUS
+        if lost >= FEC_SEQ_MODULUS // 2:
+            # arrived out of order and already counted as lost
+            return
+        self.fec_recv_seq = (seq + 1) % FEC_SEQ_MODULUS
+        # a running average over packets of 1 for each lost and 0 for this one
+        keep = (1 - FEC_LOSS_GAIN)**lost
+        self.fec_recv_loss = (1 - keep * (1 - self.fec_recv_loss)) * \
+            (1 - FEC_LOSS_GAIN)
+
+    def _fec_recover_index(self, index):
+        for first, group in self.fec_groups.items():
+            if 0 <= seq_diff(index, first) < group.size:
+                if not group.done:
+                    self._fec_recover(first, group)
+                return
+
+    def _fec_recover(self, first, group):
+        present = {}
+        missing = []
+        for col in range(group.size):
+            packet = self._fec_packet((first + col) % SEQ_MODULUS)
+            if packet is None:
+                missing.append(col)
+            else:
+                present[col] = fec_symbol(packet)
+        if not missing:
+            group.done = True
+            return
+        if len(missing) > len(group.parities):
+            return
+        for col, symbol in fec_decode(present, group.parities,
+                                      missing).items():
+            index = (first + col) % SEQ_MODULUS
+            length, = FEC_LENGTH.unpack_from(symbol)
+            stream, stream_index = RCPPacket.STREAM_HEADER.unpack_from(
+                symbol, FEC_LENGTH.size)
+            start = FEC_LENGTH.size + RCPPacket.STREAM_HEADER.size
             packet = RCPPacket(
                 RCPPacketType.SYN,
-                self.send_ix,
-                [True] * 32,
-                data,
+                index,
+                0,
+                memoryview(symbol)[start:start + length],
+                window=self.peer_window,
+                mss=self.peer_mss,
+                stream=stream,
+                stream_index=stream_index,
             )
-            self.send_queue.append(packet)
-            self.send_ix += 1
+            if self._store_packet(packet):
+                self.counters.fec_recovered += 1
+                self._observe("fec_recovered", index)
+        group.done = True
+        group.parities = {}
+
+    def _fec_packet(self, index):
+        ix = seq_diff(index, self.recv_ix)
+        if ix < 0:
+            return self.fec_delivered.get(index)
+        if ix < self.window and (self.recv_acks >> ix) & 1:
+            return self.recv_queue[(self.recv_head + ix) % self.window]
+        return None
+
+    def _schedule_ack(self, delay=ACK_DELAY):
+        now = time.monotonic()
+        if not self.ack_pending:
+            self.ack_pending = True
+            self.ack_scheduled_at = now
+        if self.next_ack is None or now + delay < self.next_ack:
+            self.next_ack = now + delay
+
+    def _process_ack(self, ack_index, acks, now):
+        if seq_diff(ack_index, self.peer_ix) > 0:
+            self.peer_ix = ack_index
+        acked = 0
+        # everything before the ACK's index has been delivered
+        while (seq_diff(ack_index, self.send_una) > 0
+               and self.send_una != self.send_nxt):
+            acked += self._ack_one(self.send_una, now)
+            self.send_una = (self.send_una + 1) % SEQ_MODULUS
+        # and the bitmap covers whatever has arrived out of order
+        bits = acks
+        while bits:
+            low = bits & -bits
+            bits ^= low
+            index = (ack_index + low.bit_length() - 1) % SEQ_MODULUS
+            if seq_diff(index, self.send_nxt) >= 0:
+                break
+            acked += self._ack_one(index, now)
+        while (self.send_una != self.send_nxt
+               and self.send_una not in self.send_buffer):
+            self.send_una = (self.send_una + 1) % SEQ_MODULUS
+
+        highest = acks.bit_length() - 1
+        loss = False
+        for index, flight in self.in_flight.items():
+            offset = seq_diff(index, ack_index)
+            if offset < 0 or highest - offset < FAST_RETRANSMIT_THRESHOLD:
+                continue
+            if not flight.retransmits and not flight.lost:
+                flight.lost = True
+                flight.deadline = now
+                loss = loss or seq_diff(index, self.recover_ix) >= 0
+        if loss:
+            self._cut_window()
+        for _ in range(acked):
+            if self.cwnd < self.ssthresh:
+                self.cwnd += 1
+            else:
+                self.cwnd += 1 / self.cwnd
+        self.cwnd = min(self.cwnd, self.window)
+
+    def _ack_one(self, index, now):
+        if self.send_buffer.pop(index, None) is None:
+            return 0
+        flight = self.in_flight.pop(index, None)
+        # per Karn only trust samples from packets sent once
+        if flight and not flight.retransmits:
+            self._sample_rtt(now - flight.sent_at)
+        return 1
+
+    def _cut_window(self):
+        self.ssthresh = max(self.cwnd / 2, MIN_CWND)
+        self.cwnd = self.ssthresh
+        self.recover_ix = self.send_ix
+        self.counters.window_cuts += 1
+        self._observe("window_cut", self.send_una)
+
+    def _sample_rtt(self, rtt):
+        self.counters.rtt_last = rtt
+        if self.counters.rtt_min is None or rtt < self.counters.rtt_min:
+            self.counters.rtt_min = rtt
+        # per RFC 6298
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = .75 * self.rttvar + .25 * abs(self.srtt - rtt)
+            self.srtt = .875 * self.srtt + .125 * rtt
+        self.rto = min(max(self.srtt + 4 * self.rttvar, MIN_RTO), MAX_RTO)
+
+    def send(self, data, stream=0):
+        """
+        Queue data on a stream, cutting it into packets of the negotiated
+        payload size and holding back any partial packet to coalesce with
+        later sends
+
+        Streams are numbered 0 to 65535 and need no setting up. All of a
+        session's streams share its window and congestion control but each
+        is delivered in order on its own, so a loss on one doesn't hold up
+        the others. Packets stay in the shared window until their own stream
+        is read though, so a stream nobody reads stalls the rest once it
+        fills the window.
+        """
+        with self.lock:
+            self.counters.bytes_queued += len(data)
+            self.counters.last_app_send = time.monotonic()
+            pending = self.pending.pop(stream, b'')
+            buff = pending + data if pending else data
+            view = memoryview(buff)
+            mss = min(self.mss, self.peer_mss)
+            if self.ack_room <= mss * ACK_ROOM_SHARE:
+                # leave room for an ACK to ride along
+                mss -= self.ack_room
+            if self.fec:
+                # leave room for the parity packets' extra header
+                mss -= FEC_OVERHEAD
+            offset = 0
+            while len(buff) - offset >= mss:
+                self._queue_packet(bytes(view[offset:offset + mss]), stream)
+                offset += mss
+            if offset < len(buff):
+                self.pending[stream] = bytes(view[offset:])
+                if self.nodelay:
+                    self._flush_pending()
+            if self.pending and self.flush_at is None:
+                self.flush_at = time.monotonic() + self.coalesce_delay
+            elif not self.pending:
+                self.flush_at = None
+        self.notify()
 
-    def recv(self):
+    def flush(self):
+        """
+        Send any partial packets right away
+        """
+        with self.lock:
+            self._flush_pending()
+        self.notify()
+
+    def _flush_pending(self):
+        for stream, data in self.pending.items():
+            self._queue_packet(data, stream)
+        self.pending = {}
+        self.flush_at = None
+
+    def _queue_packet(self, data, stream=0):
+        stream_index = self.stream_ix.get(stream, 0)
+        self.stream_ix[stream] = (stream_index + 1) % SEQ_MODULUS
+        self.send_buffer[self.send_ix] = RCPPacket(
+            RCPPacketType.SYN,
+            self.send_ix,
+            0,
+            data,
+            window=self.window,
+            mss=self.mss,
+            stream=stream,
+            stream_index=stream_index,
+        )
+        self.send_ix = (self.send_ix + 1) % SEQ_MODULUS
+
+    def recv(self, stream=0):
         while True:
-            data = b''
-            with self.lock:
-                while self.recv_queue[0] is not None:
-                    packet = self.recv_queue.pop(0)
-                    self.recv_queue.append(None)
-                    self.recv_ix += 1
-                    data += packet.data
-            if data:
-                yield data
-            time.sleep(.1)
+            views = self.recv_views(stream)
+            if not views:
+                return
+            yield b''.join(views)
+
+    def recv_views(self, stream=0):
+        """
+        Block until data is available on the stream and return all its
+        contiguous payloads as a list of memoryviews into the received
+        packets, or an empty list once the connection is closed
+        """
+        views = []
+        with self.readable:
+            recv_stream = self._recv_stream(stream)
+            self.readable.wait_for(
+                lambda: self.closed or recv_stream.next_ix in recv_stream.ready)
+            while recv_stream.next_ix in recv_stream.ready:
+                ix = seq_diff(recv_stream.ready.pop(recv_stream.next_ix),
+                              self.recv_ix)
+                views.append(self.recv_queue[(self.recv_head + ix) %
+                                             self.window].data)
+                self.recv_taken |= 1 << ix
+                recv_stream.next_ix = (recv_stream.next_ix + 1) % SEQ_MODULUS
+            # the window only moves past entries every stream is done with
+            while self.recv_taken & 1:
+                if self.peer_fec:
+                    self.fec_delivered[self.recv_ix] = self.recv_queue[
+                        self.recv_head]
+                self.recv_queue[self.recv_head] = None
+                self.recv_head = (self.recv_head + 1) % self.window
+                self.recv_acks >>= 1
+                self.recv_taken >>= 1
+                self.recv_ix = (self.recv_ix + 1) % SEQ_MODULUS
+            while len(self.fec_delivered) > MAX_FEC_GROUP:
+                del self.fec_delivered[next(iter(self.fec_delivered))]
+            self.counters.bytes_delivered += sum(len(v) for v in views)
+            self.counters.last_app_recv = time.monotonic()
+            # let our peer know the window has opened back up
+            self._schedule_ack()
+        self.notify()
+        return views
+
+    def stats(self):
+        """
+        Snapshot of the session's counters along with its current RTT
+        estimates and how full its windows are
+
+        Data queued but not in flight while the congestion window is full
+        points at the network, whereas an empty send queue and nothing in
+        flight points at the application.
+        """
+        with self.lock:
+            now = time.monotonic()
+            stats = self.counters.as_dict()
+            # report how long the application has left us idle rather than
+            # raw clock readings
+            for name in ("last_app_send", "last_app_recv"):
+                at = stats.pop(name)
+                stats[name.replace("last_", "") + "_idle_s"] = \
+                    None if at is None else now - at
+            send_window = min(self.window, self.peer_window)
+            stats.update({
+                "srtt": self.srtt,
+                "rttvar": self.rttvar,
+                "rto": self.rto,
+                "cwnd": self.cwnd,
+                "ssthresh": self.ssthresh,
+                "send_window": send_window,
+                "packets_in_flight": len(self.in_flight),
+                "bytes_in_flight": sum(
+                    len(self.send_buffer[index].data)
+                    for index in self.in_flight),
+                "send_window_occupancy": len(self.in_flight) / send_window,
+                "packets_queued": seq_diff(self.send_ix, self.send_nxt),
+                "bytes_pending": sum(len(p) for p in self.pending.values()),
+                "streams": len(self.recv_streams),
+                "recv_window_occupancy":
+                bin(self.recv_acks).count("1") / self.window,
+                "ack_delay_mean":
+                self.counters.ack_delay_total / self.counters.delayed_acks
+                if self.counters.delayed_acks else None,
+                "idle_s": now - self.last_recv,
+                "fec_loss": self.fec_loss if self.fec else None,
+                "fec_recv_loss":
+                self.fec_recv_loss if self.peer_fec else None,
+            })
+        return stats
+
+    def _close(self):
+        with self.readable:
+            self.closed = True
+            self.readable.notify_all()
+
+
+class StatsDumper(object):
+    """
+    Log a JSON snapshot of source.stats() every interval seconds, where
+    source is an RCPCxn or an RCPEventLoop
+    """
+    def __init__(self, source, interval=1., log=None):
+        self.source = source
+        self.interval = interval
+        self.log = log or logger.info
+        self._stopped = threading.Event()
+
+    def start(self):
+        threading.Thread(target=self._dump, daemon=True).start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _dump(self):
+        while not self._stopped.wait(self.interval):
+            self.log("RCP stats: %s",
+                     json.dumps(self.source.stats(), sort_keys=True))
+
+
+class _IOVec(ctypes.Structure):
+    _fields_ = [
+        ("iov_base", ctypes.c_void_p),
+        ("iov_len", ctypes.c_size_t),
+    ]
+
+
+class _MsgHdr(ctypes.Structure):
+    _fields_ = [
+        ("msg_name", ctypes.c_void_p),
+        ("msg_namelen", ctypes.c_uint32),
+        ("msg_iov", ctypes.POINTER(_IOVec)),
+        ("msg_iovlen", ctypes.c_size_t),
+        ("msg_control", ctypes.c_void_p),
+        ("msg_controllen", ctypes.c_size_t),
+        ("msg_flags", ctypes.c_int),
+    ]
+
+
+class _MMsgHdr(ctypes.Structure):
+    _fields_ = [
+        ("msg_hdr", _MsgHdr),
+        ("msg_len", ctypes.c_uint),
+    ]
+
+
+def _load_libc():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        libc.recvmmsg
+        libc.sendmmsg
+        return libc
+    except (OSError, AttributeError):
+        return None
+
+
+_libc = _load_libc()
+MSG_DONTWAIT = 0x40
+
+
+class BatchedSocket(object):
+    """
+    Non-blocking datagram socket that receives and sends in batches
+
+    Received datagrams land in preallocated buffers, many per syscall with
+    recvmmsg where libc has it and through a recv_into loop otherwise.
+    Sends are queued until flush() which hands them all to sendmmsg.
+    """
+    def __init__(self, sock, batch_size=64, buffer_size=MAX_PACKET_SIZE):
+        sock.setblocking(False)
+        self.sock = sock
+        self.outbox = []
+        self._buffers = [bytearray(buffer_size) for _ in range(batch_size)]
+        self._views = [memoryview(buff) for buff in self._buffers]
+        self._recv_msgs = None
+        if _libc is not None:
+            self._iovecs = (_IOVec * batch_size)()
+            self._recv_msgs = (_MMsgHdr * batch_size)()
+            for i, buff in enumerate(self._buffers):
+                self._iovecs[i].iov_base = ctypes.addressof(
+                    (ctypes.c_char * buffer_size).from_buffer(buff))
+                self._iovecs[i].iov_len = buffer_size
+                self._recv_msgs[i].msg_hdr.msg_iov = ctypes.pointer(
+                    self._iovecs[i])
+                self._recv_msgs[i].msg_hdr.msg_iovlen = 1
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def close(self):
+        return self.sock.close()
+
+    def send(self, data):
+        self.outbox.append(data)
+        return len(data)
+
+    def recv_batch(self):
+        """
+        Return whatever datagrams are ready, up to one batch, as memoryviews
+        that are only valid until the next call
+        """
+        if self._recv_msgs is not None:
+            count = _libc.recvmmsg(self.sock.fileno(), self._recv_msgs,
+                                   len(self._buffers), MSG_DONTWAIT, None)
+            if count < 0:
+                err = ctypes.get_errno()
+                if err in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return []
+                raise OSError(err, os.strerror(err))
+            return [
+                self._views[i][:self._recv_msgs[i].msg_len]
+                for i in range(count)
+            ]
+        batch = []
+        for view in self._views:
+            try:
+                size = self.sock.recv_into(view)
+            except BlockingIOError:
+                break
+            batch.append(view[:size])
+        return batch
+
+    def flush(self):
+        """
+        Send as much of the outbox as the socket will take, leaving the
+        rest for the next flush
+        """
+        while self.outbox:
+            if _libc is None:
+                try:
+                    self.sock.send(self.outbox[0])
+                except BlockingIOError:
+                    return
+                del self.outbox[0]
+                continue
+            batch = self.outbox[:len(self._buffers)]
+            msgs = (_MMsgHdr * len(batch))()
+            iovecs = (_IOVec * len(batch))()
+            refs = []
+            for i, data in enumerate(batch):
+                buff = ctypes.c_char_p(bytes(data))
+                refs.append(buff)
+                iovecs[i].iov_base = ctypes.cast(buff, ctypes.c_void_p)
+                iovecs[i].iov_len = len(data)
+                msgs[i].msg_hdr.msg_iov = ctypes.pointer(iovecs[i])
+                msgs[i].msg_hdr.msg_iovlen = 1
+            sent = _libc.sendmmsg(self.sock.fileno(), msgs, len(batch),
+                                  MSG_DONTWAIT)
+            if sent < 0:
+                err = ctypes.get_errno()
+                if err in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise OSError(err, os.strerror(err))
+            del self.outbox[:sent]
+
+
+class TimerWheel(object):
+    """
+    Hashed timing wheel of (deadline, item) entries
+
+    Scheduling is O(1) and entries are never cancelled -- owners that
+    reschedule should ignore stale entries as they expire.
+    """
+    def __init__(self, tick=.005, size=512):
+        self.tick = tick
+        self.slots = [[] for _ in range(size)]
+        self.current = int(time.monotonic() / tick)
+
+    def add(self, deadline, item):
+        # anything already due goes in the current slot
+        tick = max(int(deadline / self.tick), self.current)
+        self.slots[tick % len(self.slots)].append((deadline, item))
+
+    def expire(self, now):
+        expired = []
+        now_tick = int(now / self.tick)
+        for tick in range(self.current,
+                          min(now_tick, self.current + len(self.slots)) + 1):
+            slot = self.slots[tick % len(self.slots)]
+            if not slot:
+                continue
+            pending = [entry for entry in slot if entry[0] > now]
+            if len(pending) != len(slot):
+                expired.extend(item for deadline, item in slot
+                               if deadline <= now)
+                slot[:] = pending
+        # stay on the current tick as entries may still land in it
+        self.current = max(self.current, now_tick)
+        return expired
+
+    def next_timeout(self, now):
+        for i in range(len(self.slots)):
+            tick = self.current + i
+            slot = self.slots[tick % len(self.slots)]
+            # slots also hold entries for later turns of the wheel
+            due = [d for d, _ in slot if d < (tick + 1) * self.tick]
+            if due:
+                return max(min(due) - now, 0)
+        # all that's left are entries for later turns of the wheel, which
+        # are rare enough to just look through
+        pending = [deadline for slot in self.slots for deadline, _ in slot]
+        if not pending:
+            return None
+        return max(min(pending) - now, 0)
+
+
+class RCPEventLoop(object):
+    """
+    Drive any number of RCP sessions from a single thread
+
+    Sessions on the same device share one raw socket and incoming packets are
+    demultiplexed by address. Retransmission, ACK and session timeout timers
+    all live in one TimerWheel so an idle session costs nothing until one of
+    its timers fires. Idle sessions don't send ACKs either, so any
+    session_timeout applies to sessions whose peer has sent nothing for
+    that long.
+    """
+    def __init__(self,
+                 session_timeout=None,
+                 tick=.005,
+                 wheel_size=512,
+                 batch_size=64):
+        self.session_timeout = session_timeout
+        self.batch_size = batch_size
+        self.selector = selectors.DefaultSelector()
+        self.wheel = TimerWheel(tick, wheel_size)
+        self.dev2sock = {}
+        # (local address bytes, peer address bytes) -> RCPCxn
+        self.sessions = {}
+        self._deadlines = {}  # RCPCxn -> deadline it's scheduled in the wheel
+        self._ready = set()
+        self._ready_lock = threading.Lock()
+        self._waker_r, self._waker_w = socket.socketpair()
+        self._waker_r.setblocking(False)
+        self._waker_w.setblocking(False)
+        self.selector.register(self._waker_r, selectors.EVENT_READ)
+        self._thread_id = None
+
+    def connect(self, src_addr_dotdec, dst_addr_dotdec, dev, **kwargs):
+        sock = self.dev2sock.get(dev)
+        if sock is None:
+            sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW,
+                                 socket.htons(ETH_P_ALL))
+            sock.bind((dev, 0))
+            # every session's packets queue up here between iterations
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
+                            SHARED_SOCKET_BUFFER_SIZE)
+            sock = BatchedSocket(sock, batch_size=self.batch_size)
+            self.dev2sock[dev] = sock
+            self.selector.register(sock, selectors.EVENT_READ)
+        cxn = RCPCxn(IPCxn(src_addr_dotdec, dst_addr_dotdec, dev, sock=sock),
+                     **kwargs)
+        cxn.notify = functools.partial(self._mark_ready, cxn)
+        key = (cxn.ipcxn.src_addr.to_bytes(), cxn.ipcxn.dst_addr.to_bytes())
+        with self._ready_lock:
+            self.sessions[key] = cxn
+        cxn.notify()
+        return cxn
+
+    def start(self):
+        threading.Thread(target=self.run_forever).start()
+
+    def run_forever(self):
+        self._thread_id = threading.get_ident()
+        while True:
+            timeout = self.wheel.next_timeout(time.monotonic())
+            for key, _ in self.selector.select(timeout):
+                if key.fileobj is self._waker_r:
+                    self._drain_waker()
+                else:
+                    self._read(key.fileobj)
+            now = time.monotonic()
+            with self._ready_lock:
+                ready, self._ready = self._ready, set()
+            for cxn in self.wheel.expire(now):
+                deadline = self._deadlines.get(cxn)
+                if deadline is not None and deadline <= now:
+                    del self._deadlines[cxn]
+                    ready.add(cxn)
+            for cxn in ready:
+                self._service(cxn, now)
+            for sock in self.dev2sock.values():
+                sock.flush()
+
+    def _mark_ready(self, cxn):
+        with self._ready_lock:
+            self._ready.add(cxn)
+        if threading.get_ident() != self._thread_id:
+            try:
+                self._waker_w.send(b'\x00')
+            except BlockingIOError:
+                # the loop already has a wakeup pending
+                pass
+
+    def stats(self):
+        """
+        Stats of every live session keyed by "local address -> peer address"
+        """
+        with self._ready_lock:
+            sessions = list(self.sessions.values())
+        return {
+            "{} -> {}".format(cxn.ipcxn.src_addr.to_dotdec(),
+                              cxn.ipcxn.dst_addr.to_dotdec()): cxn.stats()
+            for cxn in sessions
+        }
+
+    def _drain_waker(self):
+        try:
+            while self._waker_r.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def _read(self, sock):
+        while True:
+            batch = sock.recv_batch()
+            if not batch:
+                return
+            for view in batch:
+                # copy out of the socket's buffers as packets hold onto
+                # their payloads
+                packet = IPPacket.from_bytes(bytes(view))
+                cxn = self.sessions.get(
+                    (packet.dst_addr.to_bytes(), packet.src_addr.to_bytes()))
+                if cxn is None:
+                    continue
+                try:
+                    rcp_packet = RCPPacket.from_bytes(packet.data)
+                except ValueError as e:
+                    logger.debug("Dropping malformed packet: %s", e)
+                    continue
+                cxn._on_packet(rcp_packet)
+
+    def _service(self, cxn, now):
+        if self.session_timeout is not None and \
+                now - cxn.last_recv >= self.session_timeout:
+            self._expire(cxn)
+            return
+        for packet in cxn._poll(now):
+            # queued on the device's BatchedSocket until the loop flushes
+            cxn.ipcxn.send_data(packet.to_bytes())
+        deadline = cxn.deadline
+        if self.session_timeout is not None:
+            expires = cxn.last_recv + self.session_timeout
+            deadline = expires if deadline is None else min(deadline, expires)
+        if deadline is not None and self._deadlines.get(cxn) != deadline:
+            self._deadlines[cxn] = deadline
+            self.wheel.add(deadline, cxn)
+
+    def _expire(self, cxn):
+        with self._ready_lock:
+            self.sessions.pop((cxn.ipcxn.src_addr.to_bytes(),
+                               cxn.ipcxn.dst_addr.to_bytes()), None)
+        self._deadlines.pop(cxn, None)
+        cxn._close()
 
 
 def main():
@@ -247,7 +2037,7 @@ def main():
         "192.168.1.1": "veth1",
         "192.168.1.2": "veth2",
     }
-    router = Router(["veth1", "veth2"], route_rules)
+    router = Router(["veth1", "veth2"], route_rules, LinkModel(loss=.5))
     router.start_routing()
 
     # IPDump("veth0", "192.168.1.2").start()
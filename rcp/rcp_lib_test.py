@@ -0,0 +1,1152 @@
+import json
+import socket
+import struct
+import threading
+import time
+import unittest
+from unittest import mock
+
+import rcp_lib
+
+
+class TestRCPPacket(unittest.TestCase):
+    def test_encode_ack(self):
+        p = rcp_lib.RCPPacket(
+            ptype=rcp_lib.RCPPacketType.ACK,
+            index=42,
+            acks=0x0000ffff,
+            data=b'',
+        )
+        expected = b'\x02\x00\x00\x00\x2a\x00\x20\x01\x00\x00\x00\xff\xff'
+        self.assertEqual(expected, p.to_bytes())
+
+    def test_encode_syn(self):
+        p = rcp_lib.RCPPacket(
+            ptype=rcp_lib.RCPPacketType.SYN,
+            index=42,
+            acks=0,
+            data=b'Hello, world!',
+            window=1024,
+            mss=1472,
+            stream=3,
+            stream_index=7,
+        )
+        expected = b'\x01\x00\x00\x00\x2a\x04\x00\x05\xc0\x00\x03' + \
+            b'\x00\x00\x00\x07Hello, world!'
+        self.assertEqual(expected, p.to_bytes())
+
+    def test_decode_syn(self):
+        encoded = b'\x01\x00\x00\x00\x2a\x04\x00\x05\xc0\x00\x03' + \
+            b'\x00\x00\x00\x07Hello, world!'
+        p = rcp_lib.RCPPacket.from_bytes(encoded)
+        self.assertEqual(rcp_lib.RCPPacketType.SYN, p.ptype)
+        self.assertEqual(42, p.index)
+        self.assertEqual(3, p.stream)
+        self.assertEqual(7, p.stream_index)
+        self.assertEqual(b'Hello, world!', p.data)
+
+    def test_syn_ack_round_trip(self):
+        p = rcp_lib.RCPPacket(
+            ptype=rcp_lib.RCPPacketType.SYN_ACK,
+            index=42,
+            acks=0x0000ffff,
+            data=b'Hello, world!',
+            stream=3,
+            stream_index=7,
+            ack_index=9,
+        )
+        encoded = p.to_bytes()
+        self.assertEqual(
+            b'\x04\x00\x00\x00\x2a\x00\x20\x01\x00\x00\x03\x00\x00\x00\x07' +
+            b'\x00\x00\x00\x09\x00\x00\xff\xffHello, world!', encoded)
+        decoded = rcp_lib.RCPPacket.from_bytes(encoded)
+        self.assertEqual(rcp_lib.RCPPacketType.SYN_ACK, decoded.ptype)
+        self.assertEqual(9, decoded.ack_index)
+        self.assertEqual(0x0000ffff, decoded.acks)
+        self.assertEqual(7, decoded.stream_index)
+        self.assertEqual(b'Hello, world!', decoded.data)
+
+    def test_decode_ack(self):
+        encoded = b'\x02\x00\x00\x00\x2a\x00\x20\x01\x00\x00\x00\xff\xff'
+        p = rcp_lib.RCPPacket.from_bytes(encoded)
+        self.assertEqual(rcp_lib.RCPPacketType.ACK, p.ptype)
+        self.assertEqual(42, p.index)
+        self.assertEqual(32, p.window)
+        self.assertEqual(256, p.mss)
+        self.assertEqual([True] * 16 + [False] * 16,
+                         [p.acked(i) for i in range(32)])
+        self.assertEqual(b'', p.data)
+
+    def test_decode_ack_large_window(self):
+        encoded = b'\x02\x00\x00\x00\x2a\x00\x48\x01\x00' + b'\x80' + \
+            b'\x00' * 8 + b'data'
+        p = rcp_lib.RCPPacket.from_bytes(encoded)
+        self.assertEqual(72, p.window)
+        self.assertEqual([71], [i for i in range(72) if p.acked(i)])
+        self.assertEqual(b'data', p.data)
+
+    def test_decode_unknown_type(self):
+        encoded = b'\x09\x00\x00\x00\x2a\x00\x20\x01\x00'
+        with self.assertRaises(ValueError):
+            rcp_lib.RCPPacket.from_bytes(encoded)
+
+    def test_decode_truncated(self):
+        syn = b'\x01\x00\x00\x00\x2a\x04\x00\x05\xc0\x00\x03'
+        for encoded in (b'', b'\x01\x00', syn, b'\x03' + syn[1:9] + b'\x01'):
+            with self.assertRaises(ValueError):
+                rcp_lib.RCPPacket.from_bytes(encoded)
+
+    def test_seq_diff_wraps(self):
+        self.assertEqual(3, rcp_lib.seq_diff(1, 2**32 - 2))
+        self.assertEqual(-3, rcp_lib.seq_diff(2**32 - 2, 1))
+        self.assertEqual(0, rcp_lib.seq_diff(7, 7))
+
+    def test_fec_rebuilds_lost_packets(self):
+        symbols = [b'\x00\x05hello', b'\x00\x00', b'\x00\x03abc', b'\x00\x01z']
+        parities = dict(enumerate(rcp_lib.fec_encode(symbols, 3)))
+        del parities[1]
+        rebuilt = rcp_lib.fec_decode({1: symbols[1], 3: symbols[3]},
+                                     parities, [0, 2])
+        self.assertEqual(symbols[0], rebuilt[0])
+        self.assertEqual(symbols[2], rebuilt[2].rstrip(b'\x00'))
+
+
+class FakeIPCxn(object):
+    """
+    Stand-in for the IP layer -- tests drive the connection's clock by
+    calling its _poll and _process_ack themselves rather than starting it
+    """
+    def mtu(self):
+        return rcp_lib.DEFAULT_MTU
+
+
+class FakeClock(object):
+    """
+    Stands in for rcp_lib's time module so sessions run on simulated time
+    """
+    def __init__(self):
+        self.now = 0.
+
+    def monotonic(self):
+        return self.now
+
+    def time(self):
+        return self.now
+
+
+class Wire(object):
+    """
+    Two RCPCxns, a and b, joined by an in-memory link on a simulated clock
+
+    Every packet put on the wire is logged as (time, sender, packet) and
+    drop(sender, packet) decides whether it's lost on the way.
+    """
+    def __init__(self, test, latency=.01, drop=None, b_kwargs=None,
+                 **kwargs):
+        self.clock = FakeClock()
+        patch = mock.patch.object(rcp_lib, 'time', self.clock)
+        patch.start()
+        test.addCleanup(patch.stop)
+        self.latency = latency
+        self.drop = drop or (lambda sender, packet: False)
+        kwargs.setdefault('mss', 64)
+        self.a = rcp_lib.RCPCxn(FakeIPCxn(), **kwargs)
+        self.b = rcp_lib.RCPCxn(FakeIPCxn(), **dict(kwargs, **(b_kwargs or
+                                                                {})))
+        self.names = {self.a: 'a', self.b: 'b'}
+        self.log = []
+        self.arrivals = []  # (time, sender, packet)
+        self.in_flight = []  # (arrival time, receiver, encoded packet)
+
+    def step(self):
+        now = self.clock.now
+        arrived = [p for p in self.in_flight if p[0] <= now]
+        self.in_flight = [p for p in self.in_flight if p[0] > now]
+        for _, receiver, encoded in arrived:
+            packet = rcp_lib.RCPPacket.from_bytes(encoded)
+            sender = 'a' if receiver is self.b else 'b'
+            self.arrivals.append((now, sender, packet))
+            receiver._on_packet(packet)
+        for sender, receiver in ((self.a, self.b), (self.b, self.a)):
+            name = self.names[sender]
+            for packet in sender._poll(now):
+                self.log.append((now, name, packet))
+                if not self.drop(name, packet):
+                    self.in_flight.append(
+                        (now + self.latency, receiver, packet.to_bytes()))
+
+    def run(self, seconds, dt=.001):
+        end = self.clock.now + seconds
+        while self.clock.now < end:
+            self.step()
+            self.clock.now = round(self.clock.now + dt, 9)
+
+    def sent(self, name, ptype=None):
+        return [(at, packet) for at, sender, packet in self.log
+                if sender == name and (ptype is None or packet.ptype is ptype)]
+
+
+def drop_first(sender, *indices):
+    """
+    Lose the first transmission of each of the sender's SYN packets at
+    indices
+    """
+    to_drop = set(indices)
+
+    def drop(name, packet):
+        if (name != sender or packet.ptype is not rcp_lib.RCPPacketType.SYN
+                or packet.index not in to_drop):
+            return False
+        to_drop.remove(packet.index)
+        return True
+
+    return drop
+
+
+def read_ready(cxn, stream=0):
+    """
+    Whatever the stream has ready without blocking
+    """
+    recv_stream = cxn.recv_streams.get(stream)
+    if recv_stream is None or recv_stream.next_ix not in recv_stream.ready:
+        return b''
+    return b''.join(bytes(v) for v in cxn.recv_views(stream))
+
+
+class TestRCPCxnCongestion(unittest.TestCase):
+    MSS = 64
+
+    def make_cxn(self, packets):
+        cxn = rcp_lib.RCPCxn(FakeIPCxn(), timeout=.1, mss=self.MSS)
+        cxn.send(b'x' * self.MSS * packets)
+        return cxn
+
+    def test_first_rtt_sample(self):
+        cxn = self.make_cxn(1)
+        self.assertEqual(1, len(cxn._poll(0.)))
+        cxn._process_ack(1, 0, .1)
+        self.assertAlmostEqual(.1, cxn.srtt)
+        self.assertAlmostEqual(.05, cxn.rttvar)
+        self.assertAlmostEqual(.3, cxn.rto)
+
+    def test_rtt_smoothing(self):
+        cxn = self.make_cxn(2)
+        cxn._poll(0.)
+        cxn._process_ack(1, 0, .1)
+        cxn._process_ack(2, 0, .2)
+        # RTTVAR takes the deviation from the old SRTT before it moves
+        self.assertAlmostEqual(.75 * .05 + .25 * .1, cxn.rttvar)
+        self.assertAlmostEqual(.875 * .1 + .125 * .2, cxn.srtt)
+        self.assertAlmostEqual(cxn.srtt + 4 * cxn.rttvar, cxn.rto)
+
+    def test_rto_is_clamped(self):
+        cxn = self.make_cxn(2)
+        cxn._poll(0.)
+        cxn._process_ack(1, 0, .001)
+        self.assertEqual(rcp_lib.MIN_RTO, cxn.rto)
+        cxn._process_ack(2, 0, 100.)
+        self.assertEqual(rcp_lib.MAX_RTO, cxn.rto)
+
+    def test_karn_ignores_retransmitted_packets(self):
+        cxn = self.make_cxn(1)
+        cxn._poll(0.)
+        retransmitted = cxn._poll(.15)
+        self.assertEqual([0], [p.index for p in retransmitted])
+        self.assertEqual(1, cxn.counters.timeout_retransmits)
+        cxn._process_ack(1, 0, .2)
+        self.assertIsNone(cxn.srtt)
+        self.assertEqual(.1, cxn.rto)
+
+    def test_retransmit_backs_off(self):
+        cxn = self.make_cxn(1)
+        cxn._poll(0.)
+        cxn._poll(.1)
+        self.assertAlmostEqual(.1 + .2, cxn.in_flight[0].deadline)
+        cxn._poll(.31)
+        self.assertAlmostEqual(.31 + .4, cxn.in_flight[0].deadline)
+
+    def test_slow_start(self):
+        cxn = self.make_cxn(16)
+        self.assertEqual(rcp_lib.INITIAL_CWND, len(cxn._poll(0.)))
+        cxn._process_ack(rcp_lib.INITIAL_CWND, 0, .1)
+        self.assertEqual(2 * rcp_lib.INITIAL_CWND, cxn.cwnd)
+        self.assertEqual(rcp_lib.INITIAL_CWND, len(cxn._poll(.1)) // 2)
+
+    def test_congestion_avoidance(self):
+        cxn = self.make_cxn(16)
+        cxn.ssthresh = cxn.cwnd = 4
+        cxn._poll(0.)
+        cxn._process_ack(4, 0, .1)
+        # about one packet per window's worth of ACKs
+        self.assertAlmostEqual(5, cxn.cwnd, delta=.2)
+        self.assertLess(cxn.cwnd, 5)
+
+    def test_timeout_halves_window(self):
+        cxn = self.make_cxn(16)
+        cxn.cwnd = 8
+        cxn._poll(0.)
+        cxn._poll(.15)
+        self.assertEqual(4, cxn.cwnd)
+        self.assertEqual(4, cxn.ssthresh)
+        self.assertEqual(1, cxn.counters.window_cuts)
+
+    def test_window_never_below_minimum(self):
+        cxn = self.make_cxn(4)
+        cxn.cwnd = 2
+        cxn._poll(0.)
+        cxn._poll(.15)
+        self.assertEqual(rcp_lib.MIN_CWND, cxn.cwnd)
+
+    def test_fast_retransmit_after_three_duplicates(self):
+        cxn = self.make_cxn(4)
+        cxn._poll(0.)
+        # packets 1-3 arrive but 0 doesn't
+        cxn._process_ack(0, 0b1110, .05)
+        self.assertTrue(cxn.in_flight[0].lost)
+        self.assertEqual(1, cxn.counters.window_cuts)
+        retransmitted = cxn._poll(.05)
+        self.assertEqual([0], [p.index for p in retransmitted])
+        self.assertEqual(1, cxn.counters.fast_retransmits)
+        self.assertEqual(0, cxn.counters.timeout_retransmits)
+
+    def test_no_fast_retransmit_below_threshold(self):
+        cxn = self.make_cxn(4)
+        cxn._poll(0.)
+        cxn._process_ack(0, 0b0110, .05)
+        self.assertFalse(cxn.in_flight[0].lost)
+        self.assertEqual(0, cxn.counters.window_cuts)
+        self.assertEqual([], cxn._poll(.05))
+
+    def test_one_cut_per_window_of_losses(self):
+        cxn = self.make_cxn(8)
+        cxn.cwnd = 8
+        cxn._poll(0.)
+        # 0 and 1 both lost from the same flight
+        cxn._process_ack(0, 0b11111100, .05)
+        self.assertTrue(cxn.in_flight[0].lost)
+        self.assertTrue(cxn.in_flight[1].lost)
+        self.assertEqual(1, cxn.counters.window_cuts)
+        cxn._poll(.05)
+        cxn._poll(.5)
+        self.assertEqual(1, cxn.counters.window_cuts)
+
+
+class TestRCPCxnOnAck(unittest.TestCase):
+    MSS = 64
+
+    def make_cxn(self, packets, start=0):
+        cxn = rcp_lib.RCPCxn(FakeIPCxn(), mss=self.MSS)
+        cxn.send_ix = cxn.send_una = cxn.send_nxt = start
+        cxn.peer_ix = cxn.recover_ix = start
+        cxn.cwnd = packets
+        cxn.send(b'x' * self.MSS * packets)
+        self.assertEqual(packets, len(cxn._poll(time.monotonic())))
+        return cxn
+
+    def ack(self, cxn, index, acks):
+        packet = rcp_lib.RCPPacket(rcp_lib.RCPPacketType.ACK,
+                                   index % rcp_lib.SEQ_MODULUS,
+                                   acks,
+                                   b'',
+                                   window=64,
+                                   mss=self.MSS)
+        cxn._on_packet(rcp_lib.RCPPacket.from_bytes(packet.to_bytes()))
+
+    def test_bitmap_removes_exactly_acked_packets(self):
+        cxn = self.make_cxn(6)
+        # 0 and 3 missing
+        self.ack(cxn, 0, 0b110110)
+        self.assertEqual([0, 3], sorted(cxn.send_buffer))
+        self.assertEqual([0, 3], sorted(cxn.in_flight))
+        self.assertEqual(0, cxn.send_una)
+
+    def test_filling_gap_advances_past_acked(self):
+        cxn = self.make_cxn(6)
+        self.ack(cxn, 0, 0b110110)
+        # 0 fills in but 3 is still missing
+        self.ack(cxn, 3, 0b110)
+        self.assertEqual([3], sorted(cxn.send_buffer))
+        self.assertEqual(3, cxn.send_una)
+        self.ack(cxn, 6, 0)
+        self.assertEqual({}, cxn.send_buffer)
+        self.assertEqual(6, cxn.send_una)
+        self.assertEqual(cxn.send_nxt, cxn.send_una)
+
+    def test_packets_are_acked_once(self):
+        cxn = self.make_cxn(4)
+        cwnd = cxn.cwnd
+        self.ack(cxn, 0, 0b0110)
+        self.ack(cxn, 0, 0b0110)
+        self.ack(cxn, 3, 0)
+        # in slow start each packet acked grows the window by one
+        self.assertEqual(cwnd + 3, cxn.cwnd)
+        self.assertEqual([3], sorted(cxn.send_buffer))
+        self.assertEqual(3, cxn.send_una)
+
+    def test_bitmap_past_send_nxt_is_ignored(self):
+        cxn = self.make_cxn(2)
+        cxn.send(b'x' * self.MSS)
+        self.ack(cxn, 0, 0b110)
+        # 2 was never sent so can't have been received
+        self.assertEqual([0, 2], sorted(cxn.send_buffer))
+
+    def test_wraps_around(self):
+        start = rcp_lib.SEQ_MODULUS - 2
+        cxn = self.make_cxn(4, start=start)
+        self.assertEqual(2, cxn.send_nxt)
+        # the packets either side of the wrap arrived
+        self.ack(cxn, start, 0b0110)
+        self.assertEqual([1, start], sorted(cxn.send_buffer))
+        self.assertEqual(start, cxn.send_una)
+        self.ack(cxn, start + 1, 0b10)
+        self.assertEqual([1], sorted(cxn.send_buffer))
+        self.assertEqual(1, cxn.send_una)
+        self.assertEqual(start + 1, cxn.peer_ix)
+        self.ack(cxn, 2, 0)
+        self.assertEqual({}, cxn.send_buffer)
+        self.assertEqual(2, cxn.send_una)
+        self.assertEqual(2, cxn.peer_ix)
+
+
+class TestRCPCxnStats(unittest.TestCase):
+    def make_cxn(self, packets):
+        cxn = rcp_lib.RCPCxn(FakeIPCxn(), timeout=.1, mss=64)
+        cxn.send(b'x' * 64 * packets + b'tail')
+        return cxn
+
+    def test_stats_track_windows(self):
+        cxn = self.make_cxn(6)
+        cxn._poll(0.)
+        stats = cxn.stats()
+        self.assertEqual(rcp_lib.INITIAL_CWND, stats["packets_in_flight"])
+        self.assertEqual(64 * rcp_lib.INITIAL_CWND, stats["bytes_in_flight"])
+        self.assertEqual(2, stats["packets_queued"])
+        self.assertEqual(4, stats["bytes_pending"])
+        self.assertEqual(rcp_lib.INITIAL_CWND / stats["send_window"],
+                         stats["send_window_occupancy"])
+        self.assertEqual(64 * 6 + 4, stats["bytes_queued"])
+        self.assertIsNone(stats["srtt"])
+        self.assertIsNone(stats["app_recv_idle_s"])
+        self.assertGreaterEqual(stats["app_send_idle_s"], 0)
+        json.dumps(stats)
+
+    def test_stats_after_ack(self):
+        cxn = self.make_cxn(2)
+        cxn._poll(0.)
+        cxn._process_ack(2, 0, .1)
+        stats = cxn.stats()
+        self.assertEqual(0, stats["packets_in_flight"])
+        self.assertAlmostEqual(.1, stats["rtt_last"])
+        self.assertAlmostEqual(.1, stats["rtt_min"])
+        self.assertAlmostEqual(.1, stats["srtt"])
+
+    def test_observer_sees_loss_events(self):
+        cxn = self.make_cxn(4)
+        events = []
+        cxn.observer = lambda c, event, index: events.append((event, index))
+        cxn._poll(0.)
+        cxn._process_ack(0, 0b1110, .05)
+        cxn._poll(.05)
+        self.assertEqual([("window_cut", 0), ("fast_retransmit", 0)], events)
+        del events[:]
+        cxn._poll(1.)
+        self.assertEqual([("retransmit", 0)], events)
+
+    def test_stats_dumper_logs_json(self):
+        cxn = self.make_cxn(1)
+        logged = []
+        dumped = threading.Event()
+
+        def log(fmt, payload):
+            logged.append(json.loads(payload))
+            dumped.set()
+
+        dumper = rcp_lib.StatsDumper(cxn, interval=.01, log=log)
+        dumper.start()
+        self.assertTrue(dumped.wait(1))
+        dumper.stop()
+        self.assertEqual(64 + 4, logged[0]["bytes_queued"])
+
+
+class TestRCPCxnAcks(unittest.TestCase):
+    SYN = rcp_lib.RCPPacketType.SYN
+    ACK = rcp_lib.RCPPacketType.ACK
+    SYN_ACK = rcp_lib.RCPPacketType.SYN_ACK
+
+    def test_idle_session_sends_nothing(self):
+        wire = Wire(self)
+        wire.run(2.)
+        self.assertEqual([], wire.log)
+        self.assertIsNone(wire.a.deadline)
+        self.assertIsNone(wire.b.deadline)
+
+    def test_in_order_data_gets_one_delayed_ack(self):
+        wire = Wire(self, nodelay=True)
+        for _ in range(3):
+            wire.a.send(b'x' * 64)
+        wire.run(.5)
+        arrived = [at for at, sender, _ in wire.arrivals if sender == 'a']
+        acks = wire.sent('b', self.ACK)
+        self.assertEqual(1, len(acks))
+        self.assertAlmostEqual(arrived[0] + rcp_lib.ACK_DELAY, acks[0][0],
+                               delta=.0015)
+        self.assertEqual(b'x' * 64 * 3, read_ready(wire.b))
+        # nothing more to say once everything is acked
+        self.assertEqual(3, len(wire.sent('a', self.SYN)))
+
+    def test_gap_is_acked_immediately(self):
+        wire = Wire(self, nodelay=True, drop=drop_first('a', 0))
+        for _ in range(4):
+            wire.a.send(b'x' * 64)
+        wire.run(.02)
+        first_arrival = min(at for at, sender, _ in wire.arrivals
+                            if sender == 'a')
+        acks = wire.sent('b', self.ACK)
+        self.assertEqual(first_arrival, acks[0][0])
+        self.assertEqual(0, acks[0][1].index)
+        self.assertEqual(0b1110, acks[0][1].acks)
+
+    def test_duplicate_is_acked_immediately(self):
+        wire = Wire(self, nodelay=True)
+        wire.a.send(b'x' * 64)
+        wire.run(.1)
+        syn = wire.sent('a', self.SYN)[0][1]
+        acks = len(wire.sent('b', self.ACK))
+        # as if our ACK had been lost and the packet retransmitted
+        wire.in_flight.append(
+            (wire.clock.now, wire.b, syn.to_bytes()))
+        wire.step()
+        self.assertEqual(acks + 1, len(wire.sent('b', self.ACK)))
+        self.assertEqual(1, wire.b.counters.duplicate_packets)
+
+    def test_ack_rides_on_data(self):
+        wire = Wire(self, nodelay=True)
+        wire.a.send(b'ping')
+        wire.run(.012)
+        # b answers within the ACK delay so no ACK packet of its own
+        wire.b.send(b'pong')
+        wire.run(.2)
+        self.assertEqual([], wire.sent('b', self.ACK))
+        syn_acks = wire.sent('b', self.SYN_ACK)
+        self.assertEqual(1, len(syn_acks))
+        # b's application hasn't read the ping yet
+        self.assertEqual(0, syn_acks[0][1].ack_index)
+        self.assertEqual(1, syn_acks[0][1].acks)
+        self.assertEqual(1, wire.b.counters.piggybacked_acks)
+        self.assertEqual({}, wire.a.send_buffer)
+        self.assertEqual(b'pong', read_ready(wire.a))
+
+    def test_full_window_is_probed(self):
+        wire = Wire(self, nodelay=True, b_kwargs={'window': 2})
+        # let a hear how small b's window is
+        wire.a.send(b'y')
+        wire.run(.1)
+        self.assertEqual(b'y', read_ready(wire.b))
+        wire.run(.1)
+        for _ in range(4):
+            wire.a.send(b'x' * 64)
+        # b's application isn't reading so its window stays full
+        wire.run(1.)
+        self.assertEqual({}, wire.a.in_flight)
+        probes = wire.a.counters.window_probes
+        self.assertGreaterEqual(probes, 2)
+        # backed off rather than sent every RTO
+        self.assertLessEqual(probes, 5)
+        self.assertEqual(0, wire.a.counters.timeout_retransmits)
+        # and each one answered straight away
+        self.assertEqual(probes, wire.b.counters.out_of_window_packets)
+        data = b''
+        for _ in range(40):
+            data += read_ready(wire.b)
+            wire.run(.1)
+        self.assertEqual(b'x' * 64 * 4, data)
+
+
+class TestRCPCxnSend(unittest.TestCase):
+    SYN = rcp_lib.RCPPacketType.SYN
+
+    def sizes(self, wire, name='a'):
+        return [len(packet.data) for _, packet in wire.sent(name, self.SYN)]
+
+    def test_splits_into_mss_packets(self):
+        wire = Wire(self)
+        wire.a.send(b'x' * 150)
+        # full packets are queued straight away
+        self.assertEqual(2, len(wire.a.send_buffer))
+        wire.run(.1)
+        self.assertEqual([64, 64, 22], self.sizes(wire))
+        self.assertEqual(b'x' * 150, read_ready(wire.b))
+
+    def test_partial_packet_waits_to_coalesce(self):
+        wire = Wire(self, coalesce_delay=.005)
+        wire.a.send(b'ab')
+        wire.run(.003)
+        self.assertEqual([], wire.sent('a'))
+        wire.a.send(b'cd')
+        wire.run(.1)
+        syns = wire.sent('a', self.SYN)
+        self.assertEqual([b'abcd'], [packet.data for _, packet in syns])
+        # held from the first send, not the last
+        self.assertAlmostEqual(.005, syns[0][0], delta=.0015)
+
+    def test_nodelay_sends_immediately(self):
+        wire = Wire(self, nodelay=True)
+        wire.a.send(b'ab')
+        wire.step()
+        self.assertEqual([(0., b'ab')], [(at, packet.data)
+                                         for at, packet in wire.sent('a')])
+        self.assertIsNone(wire.a.flush_at)
+
+    def test_flush_sends_pending_packet(self):
+        wire = Wire(self)
+        wire.a.send(b'ab', stream=1)
+        wire.a.send(b'cd', stream=2)
+        self.assertIsNotNone(wire.a.flush_at)
+        wire.a.flush()
+        self.assertIsNone(wire.a.flush_at)
+        wire.step()
+        self.assertEqual([b'ab', b'cd'], sorted(
+            packet.data for _, packet in wire.sent('a', self.SYN)))
+
+    def test_uses_smaller_of_own_and_peer_mss(self):
+        wire = Wire(self, nodelay=True, b_kwargs={'mss': 32})
+        # b's packets tell a its MSS
+        wire.b.send(b'hi')
+        wire.run(.1)
+        self.assertEqual(32, wire.a.peer_mss)
+        wire.a.send(b'x' * 80)
+        wire.b.send(b'y' * 80)
+        wire.run(.1)
+        self.assertEqual([32, 32, 16], self.sizes(wire, 'a'))
+        self.assertEqual([2, 32, 32, 16], self.sizes(wire, 'b'))
+
+
+class TestRCPCxnStreams(unittest.TestCase):
+    def test_loss_on_one_stream_does_not_hold_up_another(self):
+        wire = Wire(self, nodelay=True, drop=drop_first('a', 0))
+        wire.a.send(b'one', stream=1)
+        wire.a.send(b'two', stream=2)
+        delivered = {}
+        for _ in range(200):
+            wire.run(.001)
+            for stream in (1, 2):
+                if stream not in delivered and read_ready(wire.b, stream):
+                    delivered[stream] = wire.clock.now
+        retransmitted = [
+            at for at, packet in wire.sent('a', rcp_lib.RCPPacketType.SYN)
+            if packet.index == 0
+        ][1]
+        self.assertLess(delivered[2], retransmitted)
+        self.assertGreater(delivered[1], retransmitted)
+
+    def test_unread_stream_fills_shared_window(self):
+        wire = Wire(self, nodelay=True, b_kwargs={'window': 4})
+        wire.a.send(b'y')
+        wire.run(.1)
+        read_ready(wire.b)
+        for _ in range(4):
+            wire.a.send(b'x' * 64, stream=1)
+        wire.a.send(b'z', stream=2)
+        wire.run(1.)
+        self.assertEqual(b'', read_ready(wire.b, 2))
+        read_ready(wire.b, 1)
+        wire.run(1.)
+        self.assertEqual(b'z', read_ready(wire.b, 2))
+
+
+class TestRCPCxnFec(unittest.TestCase):
+    def loss_ack(self, loss):
+        return rcp_lib.RCPPacket(
+            rcp_lib.RCPPacketType.ACK,
+            0,
+            0,
+            rcp_lib.FEC_LOSS.pack(round(loss * rcp_lib._FEC_LOSS_SCALE)),
+            window=1024,
+            mss=1024)
+
+    def test_parity_count(self):
+        cxn = rcp_lib.RCPCxn(FakeIPCxn(), fec=True)
+        self.assertEqual(rcp_lib.FEC_INITIAL_LOSS, cxn.fec_loss)
+        self.assertEqual([1, 2, 3], [cxn._fec_parity_count(n)
+                                     for n in (1, 4, 16)])
+        # never more parity than data
+        cxn.fec_loss = .9
+        self.assertEqual(4, cxn._fec_parity_count(4))
+        cxn.fec_loss = 0.
+        self.assertEqual(1, cxn._fec_parity_count(16))
+
+    def test_parity_count_follows_reported_loss(self):
+        cxn = rcp_lib.RCPCxn(FakeIPCxn(), fec=True)
+        counts = []
+        for loss in (0., .05, .2, .5):
+            cxn._on_packet(self.loss_ack(loss))
+            self.assertAlmostEqual(loss, cxn.fec_loss, places=4)
+            counts.append(cxn._fec_parity_count(rcp_lib.FEC_GROUP_SIZE))
+        self.assertEqual(sorted(set(counts)), counts)
+        cxn._on_packet(self.loss_ack(.05))
+        self.assertEqual(counts[1],
+                         cxn._fec_parity_count(rcp_lib.FEC_GROUP_SIZE))
+
+    def test_lossy_link_without_timeouts(self):
+        # every tenth packet is lost the first time it's sent
+        wire = Wire(self,
+                    nodelay=True,
+                    fec=True,
+                    window=64,
+                    drop=drop_first('a', *range(3, 64, 10)))
+        sent = [bytes([i]) * 40 for i in range(64)]
+        for data in sent:
+            wire.a.send(data)
+        received = b''
+        for _ in range(100):
+            wire.run(.01)
+            received += read_ready(wire.b)
+        self.assertEqual(b''.join(sent), received)
+        self.assertEqual(0, wire.a.counters.timeout_retransmits)
+        # most are rebuilt from parity, the rest fast retransmitted
+        self.assertGreaterEqual(wire.b.counters.fec_recovered, 5)
+
+
+class TestRCPCxnRecv(unittest.TestCase):
+    def make_cxn(self, window=4):
+        return rcp_lib.RCPCxn(FakeIPCxn(), window=window, mss=64)
+
+    def syn(self, index, data):
+        return rcp_lib.RCPPacket(
+            rcp_lib.RCPPacketType.SYN,
+            index,
+            0,
+            data,
+            window=4,
+            mss=64,
+            stream_index=index,
+        ).to_bytes()
+
+    def deliver(self, cxn, index, data):
+        cxn._on_packet(rcp_lib.RCPPacket.from_bytes(self.syn(index, data)))
+
+    def test_reorders_packets(self):
+        cxn = self.make_cxn()
+        self.deliver(cxn, 1, b'world')
+        self.deliver(cxn, 0, b'hello ')
+        self.assertEqual([b'hello ', b'world'],
+                         [bytes(v) for v in cxn.recv_views()])
+        self.assertEqual(2, cxn.recv_ix)
+        self.assertEqual(0, cxn.recv_acks)
+
+    def test_recv_waits_for_head_of_queue(self):
+        cxn = self.make_cxn()
+        received = []
+        reader = threading.Thread(
+            target=lambda: received.extend(cxn.recv_views()))
+        reader.start()
+        self.deliver(cxn, 1, b'b')
+        reader.join(.05)
+        self.assertTrue(reader.is_alive())
+        self.deliver(cxn, 0, b'a')
+        reader.join(1)
+        self.assertFalse(reader.is_alive())
+        self.assertEqual([b'a', b'b'], [bytes(v) for v in received])
+
+    def test_ring_buffer_wraps(self):
+        cxn = self.make_cxn(window=4)
+        data = []
+        for index in range(10):
+            self.deliver(cxn, index, bytes([index]))
+            data.extend(bytes(v) for v in cxn.recv_views())
+        self.assertEqual([bytes([i]) for i in range(10)], data)
+        self.assertEqual(10 % 4, cxn.recv_head)
+
+    def test_recv_loop_drops_malformed_packets(self):
+        class Stop(Exception):
+            pass
+
+        datagrams = [b'\x09garbage', b'', self.syn(0, b'ok')]
+
+        def recv_data():
+            if not datagrams:
+                raise Stop()
+            return datagrams.pop(0)
+
+        cxn = self.make_cxn()
+        cxn.ipcxn.recv_data = recv_data
+        with self.assertRaises(Stop):
+            cxn._recv_loop()
+        self.assertEqual([b'ok'], [bytes(v) for v in cxn.recv_views()])
+
+    def test_recv_returns_on_close(self):
+        cxn = self.make_cxn()
+        cxn._close()
+        self.assertEqual([], cxn.recv_views())
+        self.assertEqual([], list(cxn.recv()))
+
+
+class TestTimerWheel(unittest.TestCase):
+    def setUp(self):
+        self.wheel = rcp_lib.TimerWheel(tick=.01, size=8)
+        # half way through the current tick so float rounding can't move
+        # the test's deadlines across tick boundaries
+        self.now = (self.wheel.current + .5) * self.wheel.tick
+
+    def test_expires_due_entries(self):
+        self.wheel.add(self.now + .025, 'a')
+        self.wheel.add(self.now + .055, 'b')
+        self.assertEqual([], self.wheel.expire(self.now + .02))
+        self.assertEqual(['a'], self.wheel.expire(self.now + .03))
+        self.assertEqual([], self.wheel.expire(self.now + .03))
+        self.assertEqual(['b'], self.wheel.expire(self.now + .06))
+
+    def test_entry_expires_within_its_tick(self):
+        self.wheel.add(self.now + .025, 'a')
+        self.assertEqual([], self.wheel.expire(self.now + .0249))
+        self.assertEqual(['a'], self.wheel.expire(self.now + .025))
+
+    def test_past_deadlines_land_in_current_slot(self):
+        self.wheel.add(self.now - 1, 'late')
+        self.assertEqual(0, self.wheel.next_timeout(self.now))
+        self.assertEqual(['late'], self.wheel.expire(self.now))
+
+    def test_deadlines_beyond_one_turn(self):
+        # 8 slots of 10ms so these land in the same slot
+        self.wheel.add(self.now + .125, 'far')
+        self.wheel.add(self.now + .045, 'near')
+        self.assertEqual(['near'], self.wheel.expire(self.now + .05))
+        self.assertEqual([], self.wheel.expire(self.now + .12))
+        self.assertEqual(['far'], self.wheel.expire(self.now + .13))
+
+    def test_next_timeout(self):
+        self.assertIsNone(self.wheel.next_timeout(self.now))
+        self.wheel.add(self.now + .002, 'a')
+        self.assertAlmostEqual(.002, self.wheel.next_timeout(self.now))
+        self.wheel.expire(self.now + .005)
+        self.wheel.add(self.now + .047, 'b')
+        self.assertAlmostEqual(.042, self.wheel.next_timeout(self.now + .005))
+
+    def test_next_timeout_beyond_one_turn(self):
+        # 8 slots of 10ms so this is in the current slot a turn later
+        self.wheel.add(self.now + .08, 'far')
+        self.assertAlmostEqual(.08, self.wheel.next_timeout(self.now))
+        self.wheel.add(self.now + .25, 'farther')
+        self.assertAlmostEqual(.08, self.wheel.next_timeout(self.now))
+        self.assertEqual(['far'], self.wheel.expire(self.now + .08))
+        self.assertAlmostEqual(.17, self.wheel.next_timeout(self.now + .08))
+
+
+class FakeEventIPCxn(FakeIPCxn):
+    def __init__(self):
+        self.src_addr = rcp_lib.IPAddr("10.0.0.1")
+        self.dst_addr = rcp_lib.IPAddr("10.0.0.2")
+        self.sent = []
+
+    def send_data(self, data):
+        self.sent.append(data)
+
+
+class TestRCPEventLoop(unittest.TestCase):
+    def make_session(self, loop):
+        cxn = rcp_lib.RCPCxn(FakeEventIPCxn(), mss=64)
+        key = (cxn.ipcxn.src_addr.to_bytes(), cxn.ipcxn.dst_addr.to_bytes())
+        loop.sessions[key] = cxn
+        return key, cxn
+
+    def test_service_sends_and_schedules(self):
+        loop = rcp_lib.RCPEventLoop()
+        _, cxn = self.make_session(loop)
+        cxn.send(b'x' * 64)
+        now = time.monotonic()
+        loop._service(cxn, now)
+        self.assertEqual(1, len(cxn.ipcxn.sent))
+        # the retransmission timer is in the wheel
+        self.assertEqual(cxn.deadline, loop._deadlines[cxn])
+        self.assertEqual([cxn], loop.wheel.expire(cxn.deadline))
+
+    def test_idle_session_has_no_timer(self):
+        loop = rcp_lib.RCPEventLoop()
+        _, cxn = self.make_session(loop)
+        loop._service(cxn, time.monotonic())
+        self.assertNotIn(cxn, loop._deadlines)
+        self.assertIsNone(loop.wheel.next_timeout(time.monotonic()))
+
+    def test_session_timeout(self):
+        loop = rcp_lib.RCPEventLoop(session_timeout=1.)
+        key, cxn = self.make_session(loop)
+        loop._service(cxn, cxn.last_recv)
+        self.assertEqual(cxn.last_recv + 1., loop._deadlines[cxn])
+        loop._service(cxn, cxn.last_recv + 1.)
+        self.assertNotIn(key, loop.sessions)
+        self.assertNotIn(cxn, loop._deadlines)
+        self.assertTrue(cxn.closed)
+
+    def test_idle_loop_wakes_for_timeout_beyond_one_turn(self):
+        # a 20ms wheel so the session timeout is a couple of turns out
+        loop = rcp_lib.RCPEventLoop(session_timeout=.05,
+                                    tick=.005,
+                                    wheel_size=4)
+        key, cxn = self.make_session(loop)
+        loop._service(cxn, time.monotonic())
+        self.assertIsNotNone(loop.wheel.next_timeout(time.monotonic()))
+        threading.Thread(target=loop.run_forever, daemon=True).start()
+        deadline = time.monotonic() + 2
+        while not cxn.closed and time.monotonic() < deadline:
+            time.sleep(.01)
+        self.assertTrue(cxn.closed)
+        self.assertNotIn(key, loop.sessions)
+
+    def test_mark_ready_wakes_loop(self):
+        loop = rcp_lib.RCPEventLoop()
+        _, cxn = self.make_session(loop)
+        loop._mark_ready(cxn)
+        self.assertEqual({cxn}, loop._ready)
+        events = loop.selector.select(0)
+        self.assertEqual([loop._waker_r], [key.fileobj for key, _ in events])
+        loop._drain_waker()
+        self.assertEqual([], loop.selector.select(0))
+
+
+class TestBatchedSocket(unittest.TestCase):
+    def make_pair(self, **kwargs):
+        a, b = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.addCleanup(a.close)
+        self.addCleanup(b.close)
+        return rcp_lib.BatchedSocket(a, **kwargs), rcp_lib.BatchedSocket(
+            b, **kwargs)
+
+    def check_round_trip(self):
+        a, b = self.make_pair(batch_size=4, buffer_size=64)
+        self.assertEqual([], b.recv_batch())
+        for i in range(6):
+            a.send(bytes([i]) * (i + 1))
+        # nothing goes out until the outbox is flushed
+        self.assertEqual([], b.recv_batch())
+        a.flush()
+        self.assertEqual([], a.outbox)
+        first = [bytes(v) for v in b.recv_batch()]
+        self.assertEqual([bytes([i]) * (i + 1) for i in range(4)], first)
+        rest = [bytes(v) for v in b.recv_batch()]
+        self.assertEqual([b'\x04' * 5, b'\x05' * 6], rest)
+        self.assertEqual([], b.recv_batch())
+
+    @unittest.skipIf(rcp_lib._libc is None, "libc has no recvmmsg/sendmmsg")
+    def test_round_trip_mmsg(self):
+        self.check_round_trip()
+
+    def test_round_trip_without_mmsg(self):
+        with mock.patch.object(rcp_lib, '_libc', None):
+            self.check_round_trip()
+
+    def test_flush_keeps_what_socket_wont_take(self):
+        a, b = self.make_pair(batch_size=4, buffer_size=2**16)
+        data = b'x' * 2**15
+        for _ in range(256):
+            a.send(data)
+        a.flush()
+        self.assertTrue(a.outbox)
+        received = 0
+        while True:
+            batch = b.recv_batch()
+            if not batch:
+                if not a.outbox:
+                    break
+                a.flush()
+                continue
+            received += len(batch)
+        self.assertEqual(256, received)
+
+
+def ip(dotdec):
+    return struct.unpack(">I", socket.inet_aton(dotdec))[0]
+
+
+class TestRoutingTable(unittest.TestCase):
+    def test_longest_prefix_wins(self):
+        table = rcp_lib.RoutingTable({
+            "0.0.0.0/0": "default",
+            "10.0.0.0/8": "ten",
+            "10.1.0.0/16": "ten-one",
+            "10.1.2.3": "host",
+        })
+        self.assertEqual("host", table.lookup(ip("10.1.2.3")))
+        self.assertEqual("ten-one", table.lookup(ip("10.1.2.4")))
+        self.assertEqual("ten", table.lookup(ip("10.2.0.1")))
+        self.assertEqual("default", table.lookup(ip("192.168.0.1")))
+
+    def test_no_route(self):
+        table = rcp_lib.RoutingTable({"10.0.0.0/8": "ten"})
+        self.assertIsNone(table.lookup(ip("11.0.0.1")))
+        self.assertIsNone(rcp_lib.RoutingTable().lookup(ip("10.0.0.1")))
+
+    def test_host_bits_of_rule_are_ignored(self):
+        table = rcp_lib.RoutingTable({"192.168.1.77/24": "lan"})
+        self.assertEqual("lan", table.lookup(ip("192.168.1.1")))
+
+    def test_add_after_construction(self):
+        table = rcp_lib.RoutingTable({"10.0.0.0/8": "ten"})
+        table.add("10.0.0.0/24", "narrow")
+        self.assertEqual("narrow", table.lookup(ip("10.0.0.9")))
+        self.assertEqual("ten", table.lookup(ip("10.0.1.9")))
+        table.add("10.0.0.0/24", "replaced")
+        self.assertEqual("replaced", table.lookup(ip("10.0.0.9")))
+
+
+class TestLinkModel(unittest.TestCase):
+    def test_lossless_by_default(self):
+        link = rcp_lib.LinkModel()
+        self.assertFalse(any(link.drop() for _ in range(1000)))
+        self.assertEqual(0, link.delay())
+
+    def test_total_loss(self):
+        link = rcp_lib.LinkModel(loss=1.)
+        self.assertTrue(all(link.drop() for _ in range(1000)))
+
+    def test_loss_rate(self):
+        link = rcp_lib.LinkModel(loss=.2)
+        link._random.seed(7)
+        drops = sum(link.drop() for _ in range(10000))
+        self.assertAlmostEqual(.2, drops / 10000, delta=.02)
+
+    def test_fixed_latency(self):
+        link = rcp_lib.LinkModel(latency=.05)
+        self.assertEqual(.05, link.delay())
+
+    def test_jitter(self):
+        link = rcp_lib.LinkModel(latency=.05, jitter=.01)
+        link._random.seed(7)
+        delays = [link.delay() for _ in range(1000)]
+        self.assertTrue(all(.04 <= d <= .06 for d in delays))
+        self.assertAlmostEqual(.05, sum(delays) / len(delays), delta=.002)
+
+    def test_delay_is_never_negative(self):
+        link = rcp_lib.LinkModel(latency=.001, jitter=.01)
+        self.assertTrue(all(link.delay() >= 0 for _ in range(1000)))
+
+
+def run_bpf(program, packet):
+    """
+    Interpret the handful of classic BPF instructions src_filter_program
+    emits, returning how many bytes of packet the filter keeps
+    """
+    acc = 0
+    pc = 0
+    while True:
+        code, jt, jf, k = program[pc]
+        if code == rcp_lib.BPF_LD | rcp_lib.BPF_W | rcp_lib.BPF_ABS:
+            acc = struct.unpack_from(">I", packet, k)[0]
+        elif code == rcp_lib.BPF_JMP | rcp_lib.BPF_JEQ | rcp_lib.BPF_K:
+            pc += jt if acc == k else jf
+        elif code == rcp_lib.BPF_RET | rcp_lib.BPF_K:
+            return k
+        else:
+            raise ValueError("unexpected instruction {}".format(code))
+        pc += 1
+
+
+class TestSrcFilter(unittest.TestCase):
+    ALLOWED = [socket.inet_aton("10.0.0.1"), socket.inet_aton("10.0.0.3")]
+
+    def test_program_layout(self):
+        program = rcp_lib.src_filter_program(self.ALLOWED)
+        # a load, a comparison per address, then drop and accept
+        self.assertEqual(len(self.ALLOWED) + 3, len(program))
+        self.assertEqual((rcp_lib.BPF_LD | rcp_lib.BPF_W | rcp_lib.BPF_ABS,
+                          0, 0, 0), program[0])
+        self.assertEqual([ip("10.0.0.1"), ip("10.0.0.3")],
+                         [k for _, _, _, k in program[1:-2]])
+        self.assertEqual((rcp_lib.BPF_RET | rcp_lib.BPF_K, 0, 0, 0),
+                         program[-2])
+        self.assertEqual(
+            (rcp_lib.BPF_RET | rcp_lib.BPF_K, 0, 0, 0xffffffff), program[-1])
+
+    def test_program_accepts_only_sources(self):
+        program = rcp_lib.src_filter_program(self.ALLOWED)
+        for dotdec, kept in (("10.0.0.1", True), ("10.0.0.2", False),
+                             ("10.0.0.3", True), ("0.0.0.0", False)):
+            packet = socket.inet_aton(dotdec) + b'\x00' * 4 + b'data'
+            self.assertEqual(kept, run_bpf(program, packet) > 0, dotdec)
+
+    def test_empty_program_drops_everything(self):
+        program = rcp_lib.src_filter_program([])
+        self.assertEqual(0, run_bpf(program, b'\x0a\x00\x00\x01'))
+
+    def test_kernel_applies_filter(self):
+        # socket filters apply to Unix datagram sockets too, so this needs
+        # no raw socket privileges
+        tx, rx = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.addCleanup(tx.close)
+        self.addCleanup(rx.close)
+        if not rcp_lib.attach_src_filter(rx, self.ALLOWED):
+            self.skipTest("kernel refused the filter")
+        for last in range(1, 5):
+            tx.send(bytes([10, 0, 0, last]) + b'data')
+        rx.setblocking(False)
+        received = []
+        try:
+            while True:
+                received.append(rx.recv(64)[:4])
+        except BlockingIOError:
+            pass
+        self.assertEqual(self.ALLOWED, received)
+
+
+class TestPacketRing(unittest.TestCase):
+    # ethernet header with an experimental ethertype ahead of the payload
+    FRAME = b'\x00' * 12 + b'\x88\xb5' + b'packet ring test'
+
+    def raw_socket(self):
+        try:
+            sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW,
+                                 socket.htons(rcp_lib.ETH_P_ALL))
+        except (PermissionError, AttributeError):
+            self.skipTest("raw sockets need CAP_NET_RAW on Linux")
+        self.addCleanup(sock.close)
+        sock.bind(("lo", 0))
+        return sock
+
+    def make_ring(self, **kwargs):
+        try:
+            return rcp_lib.PacketRing(self.raw_socket(), **kwargs)
+        except OSError as e:
+            self.skipTest("kernel refused the ring: {}".format(e))
+
+    def test_recv_block(self):
+        ring = self.make_ring(block_size=2**16, block_nr=4)
+        self.raw_socket().send(self.FRAME)
+        deadline = time.monotonic() + 5
+        while time.monotonic() < deadline:
+            frames = [(pkttype, bytes(view))
+                      for pkttype, view in ring.recv_block(timeout=1)]
+            ring.release()
+            if (socket.PACKET_HOST, self.FRAME) in frames:
+                break
+        else:
+            self.fail("frame never arrived on the ring")
+        packets, _ = ring.stats()
+        self.assertGreaterEqual(packets, 1)
+
+    def test_send_and_flush(self):
+        ring = self.make_ring(block_size=2**16, block_nr=4)
+        if not ring._tx_frame_nr:
+            self.skipTest("kernel refused the TX ring")
+        rx = self.raw_socket()
+        rx.settimeout(1)
+        for _ in range(3):
+            ring.send(self.FRAME)
+        ring.flush()
+        self.assertEqual(0, ring._tx_pending)
+        received = 0
+        deadline = time.monotonic() + 5
+        while received < 3 and time.monotonic() < deadline:
+            data, addr = rx.recvfrom(rcp_lib.MAX_PACKET_SIZE)
+            if data == self.FRAME and addr[2] == socket.PACKET_HOST:
+                received += 1
+        self.assertEqual(3, received)
+
+    def test_send_rejects_oversized_frames(self):
+        ring = self.make_ring(block_size=2**16, block_nr=4)
+        if not ring._tx_frame_nr:
+            self.skipTest("kernel refused the TX ring")
+        with self.assertRaises(OSError):
+            ring.send(b'\x00' * ring._tx_frame_size)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,8 +1,10 @@
 def draw(d):
     # type -> 1 byte
     # seq number -> 4 bytes
-    # acks -> 4 bytes
-    # data -> up to 256 bytes
+    # window -> 2 bytes
+    # mss -> 2 bytes
+    # acks -> window bits (ACK packets only)
+    # data -> up to the peer's mss
 
     d['']("")("Byte Offset")("rjust")
 
@@ -11,7 +13,7 @@ def draw(d):
         d['']("")("RCP Packet")("ljust")
 
     with d.nested():
-        for offset in [0, 1, 5, 9]:
+        for offset in [0, 1, 5, 7, 9]:
             d.move(down=d['boxht'])
             d['']("")(str(offset))("rjust")
 
@@ -33,6 +35,24 @@ def draw(d):
         d.move(to=d.SN.c)
         d['']("")("(4 bytes)")("below")
 
+    d.move(down=d['boxht'])
+    with d.nested():
+        d.move(right=d['boxwid'] * .2)
+        d.Window = d.box(wid=d['boxwid'] * 2)
+        d.move(to=d.Window.c)
+        d['']("")("WINDOW")("above")
+        d.move(to=d.Window.c)
+        d['']("")("(2 bytes)")("below")
+
+    d.move(down=d['boxht'])
+    with d.nested():
+        d.move(right=d['boxwid'] * .2)
+        d.MSS = d.box(wid=d['boxwid'] * 2)
+        d.move(to=d.MSS.c)
+        d['']("")("MSS")("above")
+        d.move(to=d.MSS.c)
+        d['']("")("(2 bytes)")("below")
+
     d.move(down=d['boxht'])
     with d.nested():
         d.move(right=d['boxwid'] * .2)
@@ -40,7 +60,7 @@ def draw(d):
         d.move(to=d.ACKS.c)
         d['']("")("ACKS")("above")
         d.move(to=d.ACKS.c)
-        d['']("")("(4 bytes)")("below")
+        d['']("")("(WINDOW bits, ACK only)")("below")
 
     d.move(down=d['boxht'] * 1.5)
     with d.nested():
@@ -49,4 +69,4 @@ def draw(d):
         d.move(to=d.Data.c)
         d['']("")("DATA")("above")
         d.move(to=d.Data.c)
-        d['']("")("(up to 256 bytes)")("below")
+        d['']("")("(up to peer's MSS)")("below")
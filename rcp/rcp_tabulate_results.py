@@ -1,21 +1,81 @@
+import collections
 import json
+import math
+import statistics
+import sys
+
+DEFAULT_STORE = "results.jsonl"
+
+
+def load(location):
+    with open(location) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def median_ci(values, confidence=.95):
+    """
+    Median of values with a distribution-free confidence interval from the
+    order statistics -- too few values to reach the confidence gives the
+    full range
+    """
+    xs = sorted(values)
+    n = len(xs)
+    alpha = (1 - confidence) / 2
+    # find the largest rank j with P(Binomial(n, 1/2) < j) <= alpha
+    j, cdf = 0, 1 / 2**n
+    while cdf <= alpha:
+        j += 1
+        cdf += math.comb(n, j) / 2**n
+    if j == 0:
+        return statistics.median(xs), xs[0], xs[-1]
+    return statistics.median(xs), xs[j - 1], xs[n - j]
+
+
+def _fmt(stat, scale=1., precision=1):
+    median, lo, hi = stat
+    return (f"{median * scale:.{precision}f} "
+            f"[{lo * scale:.{precision}f}, {hi * scale:.{precision}f}]")
+
+
+def report(results):
+    groups = collections.defaultdict(list)
+    for result in results:
+        # runs with and without pauses between sends aren't comparable
+        gap_ms = result.get("send_gap_ms")
+        workload = "{:g}-{:g}ms gaps".format(*gap_ms) if gap_ms else \
+            "back-to-back"
+        key = (result["variant"], json.dumps(result["router_args"],
+                                             sort_keys=True), workload,
+               result["loss"], result["msg_size"])
+        groups[key].append(result)
+
+    print("| variant | args | sends | loss | msg size | runs | failed "
+          "| seconds | goodput KB/s | throughput KB/s | packets sent |")
+    print("|---|---|---|---|---|---|---|---|---|---|---|")
+    for key in sorted(groups):
+        variant, router_args, workload, loss, msg_size = key
+        ok = [result for result in groups[key] if result["ok"]]
+        failed = len(groups[key]) - len(ok)
+        if not ok:
+            print(f"| {variant} | {router_args} | {workload} | {loss:.0%} "
+                  f"| {msg_size} | 0 | {failed} | - | - | - | - |")
+            continue
+        seconds = median_ci([result["seconds"] for result in ok])
+        goodput = median_ci(
+            [result["payload_bytes"] / result["seconds"] for result in ok])
+        throughput = median_ci(
+            [result["wire_bytes"] / result["seconds"] for result in ok])
+        packets = median_ci([result["packets_sent"] for result in ok])
+        print(f"| {variant} | {router_args} | {workload} | {loss:.0%} "
+              f"| {msg_size} | {len(ok)} | {failed} "
+              f"| {_fmt(seconds, precision=2)} "
+              f"| {_fmt(goodput, 1 / 1024)} | {_fmt(throughput, 1 / 1024)} "
+              f"| {_fmt(packets, precision=0)} |")
 
 
 def main():
-    mean = lambda l: sum(l) / len(l)
-    with open("results-window.json") as f:
-        window_res = json.load(f)
-    with open("results-fence.json") as f:
-        fence_res = json.load(f)
-
-    for key in sorted(window_res):
-        wind_packets = int(mean([pckt for pckt, secs in window_res[key]]))
-        wind_seconds = mean([secs for pckt, secs in window_res[key]])
-        fence_packets = int(mean([pckt for pckt, secs in fence_res[key]]))
-        fence_seconds = mean([secs for pckt, secs in fence_res[key]])
-        print(
-            f"| {key}% | {wind_packets} | {fence_packets} | {wind_seconds:.1f} | {fence_seconds:.1f} |"
-        )
+    location = sys.argv[1] if len(sys.argv) > 1 else DEFAULT_STORE
+    report(load(location))
 
 
 if __name__ == "__main__":